@@ -0,0 +1,227 @@
+# Running commands in subprocesses, several at once and with timeouts
+
+import os, time, errno, select, signal, collections
+from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+
+
+class Command(object):
+    '''
+    A command line to run, and its result once finished
+
+    'timeout' is the number of seconds after which the command is
+    killed, or None to let it run forever.  'on_output(command, name,
+    data)' is called with each chunk of 'stdout' or 'stderr' output
+    as it is read.  The output read so far is kept in 'stdout' and
+    'stderr', also when the command times out.
+    '''
+
+    def __init__(self,cmd,timeout=None,on_output=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.on_output = on_output
+        self.returncode = None
+        self.stdout = ''
+        self.stderr = ''
+        self.timed_out = False
+        self.start = None
+        self.wall = None
+
+        # set while running; see CommandEngine
+        self.proc = None
+        self.streams = {}
+        self.deadline = None
+        self.signals = [signal.SIGTERM, signal.SIGKILL]
+
+    @property
+    def result(self):
+        return (self.returncode, self.stdout, self.stderr)
+
+    def output(self,name,data):
+        setattr(self, name, getattr(self, name) + data)
+        if self.on_output is not None:
+            self.on_output(self, name, data)
+
+    def finish(self,returncode):
+        self.returncode = returncode
+        self.wall = time.time() - self.start
+        self.proc = None
+
+
+class CommandEngine(object):
+    '''
+    Run commands in subprocesses, reading the output of all running
+    commands in the calling thread with poll(2), so a batch of
+    commands runs concurrently without a thread per command
+
+    A command still running at its timeout is sent SIGTERM, then
+    SIGKILL 'kill_grace' seconds later; if it still hasn't exited
+    'kill_grace' seconds after that, e.g. stuck in the kernel, it is
+    abandoned.  Commands may instead be run by an executor function
+    'executor(cmd)' returning (returncode, stdout, stderr), as set
+    with Util.set_executor(); those run in threads and can't be timed
+    out.
+    '''
+
+    kill_grace = 2
+    # how often to check for exit of commands that closed their output
+    exit_interval = 0.01
+    read_size = 65536
+
+    def __init__(self,executor=None):
+        self.executor = executor
+
+    def run(self,command):
+        for c in self.run_batch([command]):
+            pass
+        return command
+
+    def run_batch(self,commands,max_running=None):
+        '''
+        Run commands, at most max_running at a time (default all at
+        once), yielding each command as it finishes
+        '''
+        if max_running is None or max_running < 1:
+            max_running = max(1, len(commands))
+        if self.executor is not None:
+            return self.run_executor(commands,max_running)
+        return self.run_subprocesses(commands,max_running)
+
+    def run_executor(self,commands,max_running):
+        def run(command):
+            command.start = time.time()
+            (returncode, stdout, stderr) = self.executor(command.cmd)
+            command.output('stdout', stdout)
+            command.output('stderr', stderr)
+            command.finish(returncode)
+            return command
+
+        if len(commands) == 1:
+            # no need for threads
+            yield run(commands[0])
+            return
+        pool = ThreadPool(min(max_running, len(commands)))
+        try:
+            for command in pool.imap_unordered(run, commands):
+                yield command
+        finally:
+            pool.close()
+            pool.join()
+
+    def start(self,command,poller,fds):
+        command.start = time.time()
+        if command.timeout:
+            command.deadline = command.start + command.timeout
+        try:
+            # commands never read our stdin, e.g. the sudo helper's
+            # request pipe
+            with open(os.devnull,'r') as devnull:
+                command.proc = Popen(command.cmd, stdin=devnull,
+                                     stdout=PIPE, stderr=PIPE,
+                                     close_fds=True)
+        except OSError, e:
+            # e.g. no such command; fail like the shell would
+            command.output('stderr', "%s: %s\n" % (command.cmd[0], e))
+            command.finish(127)
+            return
+        for (name, f) in (('stdout', command.proc.stdout),
+                          ('stderr', command.proc.stderr)):
+            command.streams[f.fileno()] = (name, f)
+            fds[f.fileno()] = command
+            poller.register(f.fileno(), select.POLLIN | select.POLLPRI)
+
+    def close(self,command,fd,poller,fds):
+        poller.unregister(fd)
+        del fds[fd]
+        command.streams.pop(fd)[1].close()
+
+    def expire(self,command,poller,fds):
+        '''
+        Signal a command past its deadline, or give up on it
+        '''
+        command.timed_out = True
+        if not command.signals or command.proc.poll() is not None:
+            # a child left behind may still hold the pipes open
+            for fd in command.streams.keys():
+                self.close(command,fd,poller,fds)
+            if command.proc.poll() is None:
+                command.finish(-signal.SIGKILL)
+            return
+        sig = command.signals.pop(0)
+        try:
+            os.kill(command.proc.pid, sig)
+        except OSError:
+            # already gone, or not ours to signal; give up in time
+            pass
+        command.deadline = time.time() + self.kill_grace
+
+    def poll(self,poller,timeout):
+        if timeout is not None:
+            timeout = max(0, int(timeout * 1000))
+        while True:
+            try:
+                return poller.poll(timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def run_subprocesses(self,commands,max_running):
+        pending = collections.deque(commands)
+        running = []
+        # pipe file descriptor -> command
+        fds = {}
+        poller = select.poll()
+        try:
+            while pending or running:
+                while pending and len(running) < max_running:
+                    command = pending.popleft()
+                    self.start(command,poller,fds)
+                    running.append(command)
+
+                # reap commands that exited after closing their output
+                for command in list(running):
+                    if command.proc is not None and not command.streams:
+                        returncode = command.proc.poll()
+                        if returncode is not None:
+                            command.finish(returncode)
+                    if command.proc is None:
+                        running.remove(command)
+                        yield command
+                if not running:
+                    continue
+
+                now = time.time()
+                for command in running:
+                    if command.deadline is not None and \
+                            command.deadline <= now:
+                        self.expire(command,poller,fds)
+                if [c for c in running if c.proc is None]:
+                    continue
+
+                deadlines = [c.deadline - now for c in running
+                             if c.deadline is not None]
+                if [c for c in running if not c.streams]:
+                    deadlines.append(self.exit_interval)
+                timeout = None
+                if deadlines:
+                    timeout = max(0, min(deadlines))
+
+                for (fd, event) in self.poll(poller,timeout):
+                    command = fds[fd]
+                    (name, f) = command.streams[fd]
+                    data = os.read(fd, self.read_size)
+                    if data:
+                        command.output(name, data)
+                    else:
+                        self.close(command,fd,poller,fds)
+        finally:
+            # the caller stopped early, e.g. on error; don't leave
+            # commands running behind its back
+            for command in running:
+                for fd in command.streams.keys():
+                    self.close(command,fd,poller,fds)
+                if command.proc is not None and command.proc.poll() is None:
+                    try:
+                        command.proc.kill()
+                    except OSError:
+                        pass
@@ -0,0 +1,125 @@
+# Resident snaplayers daemon serving hook runs over a Unix socket
+
+import os, sys, json, signal, socket, struct, threading, traceback
+
+from util import Util
+from stack import Stack
+from main import run
+
+# from <sys/socket.h>; not in the Python 2 socket module
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+class SocketStream(object):
+    '''
+    File-like object sending each write to the client as a JSON line
+    tagged with the stream name, e.g. {"stdout": "OK ...\n"}
+    '''
+
+    def __init__(self,conn,name,lock):
+        self.conn = conn
+        self.name = name
+        # stdout and stderr share the socket
+        self.lock = lock
+
+    def write(self,text):
+        with self.lock:
+            self.conn.sendall(json.dumps({ self.name : text }) + '\n')
+
+    def flush(self):
+        pass
+
+
+class Daemon(Util):
+    '''
+    Run script-snaplayers hooks in one long-running process
+
+    Layer modules stay imported, and Ceph and libvirt connections and
+    the state DB stay open between hooks.  Each client sends one JSON
+    line, {"argv": [...]}; the hook's stdout and stderr are streamed
+    back as JSON lines, followed by {"exit": <status>}.  Each request
+    runs in its own thread, logging to its own log file.
+    '''
+
+    def __init__(self,socket_path,debug=False,logfile=None):
+        super(Daemon, self).__init__(debug=debug, logfile=logfile)
+        self.socket_path = socket_path
+
+    def peer_uid(self,conn):
+        creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1]
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only our own user may connect
+        old_umask = os.umask(0177)
+        try:
+            sock.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(16)
+        return sock
+
+    def serve_forever(self):
+        # clean up on SIGTERM as on ^C
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        sock = self.listen()
+        self.infomsg("Listening on %s @ %s" % (self.socket_path, self.timestr))
+        try:
+            while True:
+                (conn, addr) = sock.accept()
+                thread = threading.Thread(target=self.handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            sock.close()
+            os.unlink(self.socket_path)
+            Stack.shutdown()
+            self.infomsg("Shut down @ %s" % self.timestr)
+
+    def handle(self,conn):
+        try:
+            if self.peer_uid(conn) != os.getuid():
+                self.infomsg("Rejected connection from uid %d" %
+                             self.peer_uid(conn))
+                return
+            request = json.loads(conn.makefile('r').readline())
+            argv = [str(arg) for arg in request['argv']]
+            self.debugmsg("Request @ %s:  %s" % (self.timestr, ' '.join(argv)))
+            status = self.run_request(conn,argv)
+            conn.sendall(json.dumps({ 'exit' : status }) + '\n')
+            self.debugmsg("Request exit status %d @ %s" %
+                          (status, self.timestr))
+        except (socket.error, ValueError, KeyError, TypeError), e:
+            self.infomsg("Request failed:  %s" % e)
+        finally:
+            conn.close()
+
+    def run_request(self,conn,argv):
+        lock = threading.Lock()
+        stdout = SocketStream(conn, 'stdout', lock)
+        stderr = SocketStream(conn, 'stderr', lock)
+        self.set_thread_context({ 'active' : True,
+                                  'stdout' : stdout,
+                                  'stderr' : stderr })
+        try:
+            try:
+                return run(argv)
+            except SystemExit, e:
+                if e.code is None:
+                    return 0
+                elif isinstance(e.code, int):
+                    return e.code
+                stderr.write("%s\n" % e.code)
+                return 1
+            except Exception:
+                stderr.write(traceback.format_exc())
+                return 1
+        finally:
+            log = self.log_parms.get('log',None)
+            if log not in (None, stdout, stderr):
+                log.close()
+            self.set_thread_context({})
@@ -0,0 +1,90 @@
+# Disk target names reserved for volumes attached to the backup VM
+
+import os, errno, string
+from statedb import StateDB
+
+
+StateDB.schema['device_targets'] = (
+    'CREATE TABLE IF NOT EXISTS device_targets ('
+    'vm TEXT, '
+    'target TEXT, '
+    'device TEXT, '
+    'pid INTEGER, '
+    'PRIMARY KEY (vm, target))')
+
+
+class DeviceTargets(object):
+    '''
+    Allocator of VM disk target names, like 'vdc', reserved in the
+    state database so that concurrent script processes and threads
+    attaching volumes to the same VM never pick the same name
+
+    A volume keeps its reservation from set-up until its disk is
+    detached.  Reservations of processes that died before attaching
+    their disk are reclaimed.
+    '''
+
+    # 'vda'..'vdz', then 'vdaa'..'vdzz', as the Linux virtio driver
+    # names disks
+    max_letters = 2
+
+    def __init__(self,state_db):
+        self.db = state_db
+
+    def target_names(self,prefix):
+        names = list(string.ascii_lowercase)
+        for i in range(self.max_letters):
+            for name in names:
+                yield prefix + name
+            names = [a + b for a in string.ascii_lowercase for b in names]
+
+    def pid_alive(self,pid):
+        try:
+            os.kill(pid,0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
+
+    def reserve(self,vm,device,prefix,taken):
+        '''
+        Return the target name reserved for attaching 'device' to the
+        VM, reserving the first free name if it has none; 'taken(target)'
+        tells whether a name is used by another disk.  Returns None if
+        all names are in use.
+        '''
+        with self.db.transaction():
+            reserved = set()
+            for (target, owner, pid) in self.db.execute(
+                    'SELECT target, device, pid FROM device_targets '
+                    'WHERE vm = ?', (vm,)):
+                if owner == device and not taken(target):
+                    return target
+                if owner == device or \
+                        (not taken(target) and not self.pid_alive(pid)):
+                    # another disk sits on our reserved name, or the
+                    # owner died before attaching its disk
+                    self.release_target(vm,target)
+                else:
+                    reserved.add(target)
+
+            for target in self.target_names(prefix):
+                if target not in reserved and not taken(target):
+                    self.db.execute(
+                        'INSERT INTO device_targets (vm, target, device, pid) '
+                        'VALUES (?, ?, ?, ?)',
+                        (vm, target, device, os.getpid()))
+                    return target
+        return None
+
+    def release_target(self,vm,target):
+        self.db.execute(
+            'DELETE FROM device_targets WHERE vm = ? AND target = ?',
+            (vm, target))
+
+    def release(self,vm,device):
+        '''
+        Release the names reserved for a device once its disk is detached
+        '''
+        self.db.execute(
+            'DELETE FROM device_targets WHERE vm = ? AND device = ?',
+            (vm, device))
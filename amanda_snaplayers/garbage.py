@@ -0,0 +1,230 @@
+# Garbage collection of resources left behind by crashed runs
+
+import os, traceback
+from multiprocessing.pool import ThreadPool
+
+from util import Util
+from params import Params
+from stack import Stack
+from layers import Snapdb
+
+
+Params.add_option(
+    "--gc_orphans", "--gc-orphans", type="int", default=0,
+    help=("with the 'gc' entry point, also remove snapshots and clones "
+          "missing from the state db; only safe while no other hooks "
+          "run; param is 0 or 1"))
+Params.add_option(
+    "--gc_dry_run", "--gc-dry-run", type="int", default=0,
+    help=("with the 'gc' entry point, only list what would be removed; "
+          "param is 0 or 1"))
+
+
+class Leak(object):
+    '''
+    A resource a crashed run may have left behind, found by a layer
+    class's find_leaks() and removed by its remove_leak() method
+
+    The layer's 'leak_tier' orders removal:  a leak sits on the leaks
+    of lower tiers named in 'parents', e.g. a mount on an attached
+    disk, and is removed before them.  'snapdb_device' is the
+    resource's key in the snapshot db, for layers recording one.  A
+    leak with 'needs_parent' is only ours if it sits on another leak,
+    e.g. an md array assembled from snapshot LVs.  An 'orphaned' leak,
+    e.g. a mount of a vanished device, is always collected.  Any other
+    keyword arguments are kept as attributes for remove_leak().
+    '''
+
+    def __init__(self,layer,device,parents=(),snapdb_device=None,
+                 needs_parent=False,orphaned=False,**info):
+        self.layer = layer
+        self.tier = layer.leak_tier
+        self.device = device
+        self.parents = list(parents)
+        self.snapdb_device = snapdb_device
+        self.needs_parent = needs_parent
+        self.orphaned = orphaned
+        self.__dict__.update(info)
+
+        # filled in by GarbageCollector.select()
+        self.parent_leaks = []
+        self.child_leaks = []
+        self.collect = False
+
+    def __repr__(self):
+        return "%s '%s'" % (self.layer.name, self.device)
+
+
+class GarbageCollector(Util):
+    '''
+    Find the snapshots, clones, md arrays, attached disks and mounts
+    that stacks left behind, and remove the stale ones
+
+    Each layer class with a find_leaks() class method lists the
+    resources of its kind bearing the snaplayers suffixes or living
+    under the mount base.  Those whose snapshot db entry is older than
+    --stale-seconds are removed, along with everything sitting on
+    them, top tier first, each tier in parallel.
+    '''
+
+    def __init__(self,params):
+        super(GarbageCollector, self).__init__(debug=params.debug)
+        self.params = params
+        self.snapdb = Snapdb(params)
+
+    @property
+    def max_workers(self):
+        return max(1, self.params.max_workers)
+
+    def layer_classes(self):
+        classes = []
+        for name in sorted(Stack.layer_modules):
+            try:
+                layer_class = Stack.layer_class(name)
+            except ImportError, e:
+                # e.g. lxml isn't installed
+                self.debugmsg("  Skipping '%s' layers:  %s" % (name, e))
+                continue
+            if layer_class is not None and \
+                    hasattr(layer_class, 'find_leaks'):
+                classes.append(layer_class)
+        return classes
+
+    def find_leaks(self):
+        leaks = {}
+        # subclasses like the xenvdi layer share their parent's finder
+        finders = set()
+        for layer_class in self.layer_classes():
+            finder = layer_class.find_leaks
+            if finder.im_func in finders:
+                continue
+            finders.add(finder.im_func)
+            try:
+                with self.span('gc.find_leaks', layer=layer_class.name):
+                    found = finder(self)
+            except SystemExit:
+                self.infomsg("Unable to look for leaked '%s' resources" %
+                             layer_class.name)
+                continue
+            except Exception, e:
+                self.infomsg("Unable to look for leaked '%s' resources:  %s" %
+                             (layer_class.name, e))
+                continue
+            for leak in found:
+                leaks.setdefault(leak.device, leak)
+        return leaks
+
+    def device_keys(self,device):
+        '''
+        Names a device may go by, e.g. '/dev/vg/lv', '/dev/dm-3' and
+        'dm-3', the kernel name listed in sysfs
+        '''
+        if not device.startswith('/'):
+            return [device]
+        real = os.path.realpath(device)
+        return [device, real, os.path.basename(real)]
+
+    def is_stale(self,leak):
+        if leak.snapdb_device is None:
+            return False
+        expired = self.snapdb.is_expired(leak.snapdb_device,
+                                         self.params.stale_seconds)
+        if expired is None:
+            # not in the db:  set-up crashed, or is still running
+            return self.params.gc_orphans == 1
+        return expired
+
+    def select(self,leaks):
+        '''
+        Link leaks to the leaks they sit on, and return those to be
+        collected, lowest tier first
+        '''
+        index = {}
+        for leak in leaks.values():
+            for key in self.device_keys(leak.device):
+                index.setdefault(key, leak)
+        for leak in leaks.values():
+            for parent in leak.parents:
+                for key in self.device_keys(parent):
+                    p = index.get(key,None)
+                    if p is not None and p is not leak and \
+                            p not in leak.parent_leaks:
+                        leak.parent_leaks.append(p)
+                        p.child_leaks.append(leak)
+
+        leaks = sorted(leaks.values(), key=lambda l: (l.tier, l.device))
+        for leak in leaks:
+            if leak.needs_parent and not leak.parent_leaks:
+                continue
+            leak.collect = leak.orphaned or \
+                bool([p for p in leak.parent_leaks if p.collect]) or \
+                self.is_stale(leak)
+        return [leak for leak in leaks if leak.collect]
+
+    def remove(self,leak):
+        '''
+        Remove one leak; return True on success
+        '''
+        self.infomsg("Removing stale %s" % leak)
+        try:
+            with self.span('gc.remove', layer=leak.layer.name,
+                           device=leak.device):
+                leak.layer.remove_leak(leak)
+        except SystemExit:
+            return False
+        except Exception, e:
+            # e.g. a libvirtError; the other leaks are still removed
+            self.infomsg("Unable to remove %s:  %s: %s" %
+                         (leak, e.__class__.__name__, e))
+            self.debugmsg(traceback.format_exc())
+            return False
+        if leak.snapdb_device is not None:
+            self.snapdb.delete_snap(leak.snapdb_device)
+        return True
+
+    def remove_tier(self,leaks):
+        # workers log to the same place as this thread
+        context = self.thread_context()
+        def remove(leak):
+            self.set_thread_context(context)
+            return self.remove(leak)
+
+        pool = ThreadPool(max(1, min(self.max_workers, len(leaks))))
+        try:
+            return pool.map(remove, leaks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def collect(self):
+        collected = self.select(self.find_leaks())
+        if not collected:
+            self.infomsg("No stale resources found")
+            return
+        self.infomsg("Found %d stale resources:\n  %s\n" %
+                     (len(collected),
+                      '\n  '.join([str(l) for l in reversed(collected)])))
+        if self.params.gc_dry_run == 1:
+            return
+
+        # leaks that weren't removed, or sit under ones that weren't
+        failed = set()
+        for tier in sorted(set([l.tier for l in collected]), reverse=True):
+            leaks = []
+            for leak in [l for l in collected if l.tier == tier]:
+                if [c for c in leak.child_leaks if c in failed]:
+                    self.infomsg("Not removing %s; it is still in use" % leak)
+                    failed.add(leak)
+                else:
+                    leaks.append(leak)
+            if not leaks:
+                continue
+            for (leak, res) in zip(leaks, self.remove_tier(leaks)):
+                if not res:
+                    failed.add(leak)
+
+        if failed:
+            self.error("Failed to remove %d of %d stale resources:\n  %s" %
+                       (len(failed), len(collected),
+                        '\n  '.join([str(l) for l in failed])))
+        self.infomsg("Removed %d stale resources" % len(collected))
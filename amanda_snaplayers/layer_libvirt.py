@@ -1,8 +1,12 @@
 # Libvirt volumes attached to an amanda server VM
 
 from stack import Stack
-from layers import SnapLayer
-from params import Params
+from layers import SnapLayer, memoized_property
+from mounts import MountTable
+from wait import wait_for_path
+from statedb import StateDB
+from device_targets import DeviceTargets
+from garbage import Leak
 
 have_libvirt = True
 try:
@@ -10,43 +14,34 @@ try:
 except:
     have_libvirt = False
 
-import os.path,platform,time
+import os.path,platform,threading
 from lxml import etree
 from pprint import pformat
 
-Params.add_option(
-    "--qemu_url", "--qemu-url",
-    default="qemu:///system",
-    help=("qemu URL"))
 
-Params.add_option(
-    "--libvirt_auth_file", "--libvirt-auth-file",
-    default="/var/lib/amanda/libvirt-authfile",
-    help=("Libvirt authentication file"))
-
-Params.add_option(
-    "--libvirt_vm_hostname", "--libvirt-vm-hostname",
-    help=("Amanda server VM name"))
-
-Params.add_option(
-    "--ceph_auth_user", "--ceph-auth-user",
-    default="admin",
-    help=("Ceph user"))
-
-Params.add_option(
-    "--libvirt_secret_uuid", "--libvirt-secret-uuid",
-    help=("Libvirt storage secret UUID"))
-
-Params.add_option(
-    "--disk_device_prefix", "--disk-device-prefix",
-    default='/dev/vd',
-    help=("Attached disk device filename prefix; default '/dev/vd'"))
+class DomainDisks(object):
+    '''
+    The disks of a domain's XML description, indexed by source name
+    and by target device
+    '''
 
-Params.add_option(
-    "--libvirt_attach_timeout", "--libvirt-attach-timeout",
-    type="int", default=30,
-    help=("Maximum time to wait for a libvirt volume to be attached "
-          "to the backup VM"))
+    def __init__(self,xml):
+        self.by_source = {}
+        self.by_target = {}
+        self.rbd_names = []
+        # target device -> <disk> element, e.g. for detaching it
+        self.disk_xml = {}
+        for disk in etree.XML(xml).xpath("/domain/devices/disk"):
+            (source, target) = (disk.find('source'), disk.find('target'))
+            name = source is not None and source.get('name') or None
+            dev = target is not None and target.get('dev') or None
+            if name is not None:
+                self.by_source.setdefault(name,[]).append(dev)
+                if source.get('protocol') == 'rbd':
+                    self.rbd_names.append(name)
+            if dev is not None:
+                self.by_target.setdefault(dev,[]).append(name)
+                self.disk_xml[dev] = etree.tostring(disk)
 
 
 class LibvirtVolLayer(SnapLayer):
@@ -65,6 +60,19 @@ class LibvirtVolLayer(SnapLayer):
 
     name = 'libvirt'
     insert_parent = 'rbd_clone'
+    # attached disks sit on RBD clones; see garbage.py
+    leak_tier = 2
+    # libvirtd connections shared across instances, by URL
+    libvirt_conns = {}
+    libvirt_conns_lock = threading.Lock()
+    # parsed domain disks shared across instances, by (URL, VM name);
+    # dropped after attaching or detaching a disk, on libvirt device
+    # events and at the end of each run
+    domain_index = {}
+    domain_index_lock = threading.Lock()
+    # domains with device event callbacks, by (URL, VM name)
+    domain_events = {}
+    event_loop = { 'thread' : None }
     ceph_vol_xml_template = '''
         <disk type='network' device='disk'>
           <driver name='qemu' type='raw'/>
@@ -90,11 +98,47 @@ class LibvirtVolLayer(SnapLayer):
         '''
         Connection to libvirtd
         '''
-        if not hasattr(self,'_libvirt_conn'):
-            self._libvirt_conn = libvirt.open(self.qemu_url)
-            self.debugmsg("      set up libvirt connection to '%s'" %
-                          self.params.qemu_url)
-        return self._libvirt_conn
+        with self.libvirt_conns_lock:
+            conn = self.libvirt_conns.get(self.qemu_url,None)
+            if conn is None or not conn.isAlive():
+                if self.params.libvirt_events:
+                    self.start_event_loop()
+                with self.span('libvirt.open', url=self.params.qemu_url):
+                    conn = libvirt.open(self.qemu_url)
+                self.libvirt_conns[self.qemu_url] = conn
+                self.debugmsg("      set up libvirt connection to '%s'" %
+                              self.params.qemu_url)
+        return conn
+
+    @classmethod
+    def close_libvirt_conns(cls):
+        with cls.libvirt_conns_lock:
+            for conn in cls.libvirt_conns.values():
+                conn.close()
+            cls.libvirt_conns.clear()
+            cls.domain_events.clear()
+        cls.clear_domain_index()
+
+    def start_event_loop(self):
+        '''
+        Run the default libvirt event loop in a daemon thread; must be
+        started before opening the connections delivering the events
+        '''
+        if self.event_loop['thread'] is not None:
+            return
+        if not hasattr(libvirt,'virEventRegisterDefaultImpl'):
+            self.debugmsg("      libvirt events not supported; "
+                          "re-reading domain XML after each change")
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        def run_loop():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+        thread = threading.Thread(target=run_loop,
+                                  name='libvirt-events')
+        thread.daemon = True
+        thread.start()
+        self.event_loop['thread'] = thread
 
     @property
     def libvirt_vm_hostname(self):
@@ -110,15 +154,65 @@ class LibvirtVolLayer(SnapLayer):
     @property
     def libvirt_vm(self):
         if not hasattr(self,'_libvirt_vm'):
-            self._libvirt_vm = \
-                self.libvirt_conn.lookupByName(self.libvirt_vm_hostname)
+            conn = self.libvirt_conn
+            with self.span('libvirt.lookupByName',
+                           vm=self.libvirt_vm_hostname):
+                self._libvirt_vm = conn.lookupByName(self.libvirt_vm_hostname)
             self.debugmsg("      set up libvirt object for vm '%s'" %
                           self.libvirt_vm_hostname)
+            if self.event_loop['thread'] is not None:
+                self.register_domain_events(conn)
         return self._libvirt_vm
 
     @property
-    def libvirt_vm_xml(self):
-        return etree.XML(self.libvirt_vm.XMLDesc(0))
+    def domain_key(self):
+        return (self.qemu_url, self.libvirt_vm_hostname)
+
+    def register_domain_events(self,conn):
+        '''
+        Drop the VM's parsed disks when libvirt reports a disk added
+        or removed by anyone, e.g. another amanda process
+        '''
+        key = self.domain_key
+        with self.libvirt_conns_lock:
+            if key in self.domain_events:
+                return
+            self.domain_events[key] = conn
+        def device_changed(conn,dom,dev,opaque):
+            self.clear_domain_disks(key)
+        for event in ('VIR_DOMAIN_EVENT_ID_DEVICE_ADDED',
+                      'VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED'):
+            # DEVICE_ADDED is only in libvirt 1.2.15 and later
+            if hasattr(libvirt,event):
+                conn.domainEventRegisterAny(
+                    self._libvirt_vm, getattr(libvirt,event),
+                    device_changed, None)
+
+    @classmethod
+    def clear_domain_index(cls):
+        with cls.domain_index_lock:
+            cls.domain_index.clear()
+
+    @classmethod
+    def clear_domain_disks(cls,key):
+        with cls.domain_index_lock:
+            cls.domain_index.pop(key,None)
+
+    @property
+    def domain_disks(self):
+        '''
+        The VM's disks, parsed from one fetch of its XML description
+        '''
+        key = self.domain_key
+        with self.domain_index_lock:
+            disks = self.domain_index.get(key,None)
+        if disks is None:
+            vm = self.libvirt_vm
+            with self.span('libvirt.XMLDesc'):
+                disks = DomainDisks(vm.XMLDesc(0))
+            with self.domain_index_lock:
+                self.domain_index[key] = disks
+        return disks
 
     @property
     def libvirt_storage_pool_name(self):
@@ -127,18 +221,23 @@ class LibvirtVolLayer(SnapLayer):
     @property
     def libvirt_storage_pool(self):
         if not hasattr(self,'_libvirt_storage_pool'):
-            self._libvirt_storage_pool = (
-                self.libvirt_conn.storagePoolLookupByName(
-                    self.libvirt_storage_pool_name))
+            conn = self.libvirt_conn
+            with self.span('libvirt.storagePoolLookupByName',
+                           pool=self.libvirt_storage_pool_name):
+                self._libvirt_storage_pool = conn.storagePoolLookupByName(
+                    self.libvirt_storage_pool_name)
             self.debugmsg("      set up libvirt object for storage pool '%s'" %
                           self.libvirt_storage_pool_name)
         return self._libvirt_storage_pool
 
     def libvirt_storage_pool_refresh(self):
         self.debugmsg("    Refreshing storage pool")
-        self.libvirt_storage_pool.refresh(0)
+        pool = self.libvirt_storage_pool
+        with self.span('libvirt.refresh',
+                       pool=self.libvirt_storage_pool_name):
+            pool.refresh(0)
 
-    @property
+    @memoized_property
     def libvirt_storage_pool_volume_list(self):
         return self.libvirt_storage_pool.listVolumes()
 
@@ -149,10 +248,12 @@ class LibvirtVolLayer(SnapLayer):
     @property
     def libvirt_storage_volume(self):
         if not hasattr(self,'_libvirt_storage_volume'):
+            pool = self.libvirt_storage_pool
             try:
-                self._libvirt_storage_volume = (
-                    self.libvirt_storage_pool.storageVolLookupByName(
-                        self.libvirt_storage_volume_name))
+                with self.span('libvirt.storageVolLookupByName',
+                               volume=self.libvirt_storage_volume_name):
+                    self._libvirt_storage_volume = pool.storageVolLookupByName(
+                        self.libvirt_storage_volume_name)
             except libvirt.libvirtError, e:
                 self.error("Failed to find volume '%s' in pool '%s'" %
                            (self.libvirt_storage_volume_name,
@@ -176,9 +277,7 @@ class LibvirtVolLayer(SnapLayer):
         Check to see if the orig_device is already mapped to an
         existing block device
         '''
-        devs = [t.get('dev') for t in self.libvirt_vm_xml.xpath(
-                "/domain/devices/disk/source[@name='%s']/../target" %
-                self.orig_device)]
+        devs = self.domain_disks.by_source.get(self.orig_device,[])
         # Check for weird cases
         if len(devs) > 1:
             self.error("Found multiple devices mapped to volume '%s': [%s]" %
@@ -191,11 +290,35 @@ class LibvirtVolLayer(SnapLayer):
 
 
     @property
-    def disk_device(self):
-        # There may be a race condition determining the new device
-        # name to attach; reserving the device name should be
-        # addressed here
+    def device_targets(self):
+        state_db = StateDB.open(self.params.snaplayers_state_file, self)
+        return DeviceTargets(state_db)
+
+    @property
+    def disk_device_pattern(self):
+        # strip off initial '/dev/' for libvirt, e.g. '/dev/vd' -> 'vd'
+        prefix = self.params.disk_device_prefix
+        if prefix.startswith('/dev/'):
+            prefix = prefix[5:]
+        return prefix
+
+    def target_taken(self,target):
+        '''
+        True if another disk of the VM, or some local device not
+        attached through libvirt, already uses a target name
+        '''
+        sources = self.domain_disks.by_target.get(target,None)
+        if sources is not None:
+            return sources != [self.orig_device]
+        return os.path.exists('/dev/'+target)
 
+    def reset_state(self):
+        # another stack's layer object may have attached the disk
+        if hasattr(self,'_disk_device'):
+            del self._disk_device
+
+    @property
+    def disk_device(self):
         if not hasattr(self,'_disk_device'):
             # If a device already mapped, select that
             dev = self.mapped_device
@@ -204,22 +327,17 @@ class LibvirtVolLayer(SnapLayer):
                 self.debugmsg("      found existing VM device map to '%s'"
                               % dev)
             else:
-                # Device pattern, e.g. 'vd%s', translating to /dev/vd?
-                dev_pat = self.params.disk_device_prefix + '%s'
-                if dev_pat.startswith('/dev/'):
-                    # strip off initial '/dev/' for libvirt
-                    dev_pat = dev_pat[5:]
-
-                # Look for unused device
-                for dev in [dev_pat%chr(ord('a')+i) for i in range(0,26)]:
-                    if not os.path.exists('/dev/'+dev):
-                        self._disk_device = dev
-                        break
-                else:
+                # Reserve an unused device name in the state db, so
+                # concurrent stacks don't pick the same one
+                dev = self.device_targets.reserve(
+                    self.libvirt_vm_hostname, self.orig_device,
+                    self.disk_device_pattern, self.target_taken)
+                if dev is None:
                     self.error("Unable to find free disk device '%s*'" %
                                self.params.disk_device_prefix)
+                self._disk_device = dev
                 self.debugmsg(
-                        "      selected unused VM target device '%s'" %
+                        "      reserved unused VM target device '%s'" %
                         self._disk_device)
 
         return self._disk_device
@@ -240,8 +358,7 @@ class LibvirtVolLayer(SnapLayer):
         '''
         List of all RBD volume names attached to the backup VM
         '''
-        return [s.get('name') for s in self.libvirt_vm_xml.xpath(
-                "/domain/devices/disk/source[@protocol='rbd']")]
+        return list(self.domain_disks.rbd_names)
 
     def libvirt_storage_volume_attach(self):
         self.debugmsg(
@@ -249,14 +366,18 @@ class LibvirtVolLayer(SnapLayer):
             "to local VM device '%s'" %
             (self.libvirt_storage_volume_name,
              self.device))
+        (vm, xml) = (self.libvirt_vm, self.libvirt_storage_volume_xml)
         try:
-            res = self.libvirt_vm.attachDevice(self.libvirt_storage_volume_xml)
+            with self.span('libvirt.attachDevice', device=self.device):
+                res = vm.attachDevice(xml)
         except libvirt.libvirtError, e:
             self.error("Attaching pool '%s' volume '%s' to VM '%s': \n\t%s" %
                        (self.libvirt_storage_pool_name,
                         self.libvirt_storage_volume_name,
                         self.libvirt_vm_hostname,
                         e))
+        finally:
+            self.clear_domain_disks(self.domain_key)
 
     def libvirt_storage_volume_detach(self):
         self.debugmsg(
@@ -264,14 +385,18 @@ class LibvirtVolLayer(SnapLayer):
             "from local VM device '%s'" %
             (self.libvirt_storage_volume_name,
              self.device))
+        (vm, xml) = (self.libvirt_vm, self.libvirt_storage_volume_xml)
         try:
-            res = self.libvirt_vm.detachDevice(self.libvirt_storage_volume_xml)
+            with self.span('libvirt.detachDevice', device=self.device):
+                res = vm.detachDevice(xml)
         except libvirt.libvirtError, e:
             self.error("Detaching pool '%s' volume '%s' from VM '%s': \n\t%s" %
                        (self.libvirt_storage_pool_name,
                         self.libvirt_storage_volume_name,
                         self.libvirt_vm_hostname,
                         e))
+        finally:
+            self.clear_domain_disks(self.domain_key)
 
 
     @property
@@ -323,16 +448,14 @@ class LibvirtVolLayer(SnapLayer):
         Sanity check: make sure at least the device isn't mounted
         anywhere outside the amanda mount_directory
         '''
-        with open('/proc/mounts','r') as f:
-            for line in f:
-                (dev,mntpt) = line.split()[0:2]
-                # This is a dumb way to check....
-                if dev.startswith(self.device):
-                    if not mntpt.startswith(self.params.mount_directory):
-                        self.error(
-                            "Target device '%s' maps to local VM device '%s' "
-                            "but '%s' is already mounted on '%s'" %
-                            (self.orig_device, self.device, dev, mntpt))
+        for (dev,mntpt) in MountTable(self).mounts():
+            # This is a dumb way to check....
+            if dev.startswith(self.device):
+                if not mntpt.startswith(self.params.mount_base):
+                    self.error(
+                        "Target device '%s' maps to local VM device '%s' "
+                        "but '%s' is already mounted on '%s'" %
+                        (self.orig_device, self.device, dev, mntpt))
         # If we get here, the above check passed.
         return True
 
@@ -343,9 +466,7 @@ class LibvirtVolLayer(SnapLayer):
         'disk' element
         '''
         # find all disk device source names for our target device
-        map = [s.get('name') for s in self.libvirt_vm_xml.xpath(
-                "/domain/devices/disk/target[@dev='%s']/../source" %
-                self.disk_device)]
+        map = self.domain_disks.by_target.get(self.disk_device,[])
         # there should be exactly one and it should match the
         # orig_device
         return len(map) == 1 and map[0] == self.orig_device
@@ -353,25 +474,16 @@ class LibvirtVolLayer(SnapLayer):
 
     def wait_attach(self,detach=False):
         '''
-        Check for disk attachment/detachment once a second up to the
+        Wait for the disk device to appear (or disappear) up to the
         timeout
         '''
-        for t in range(0,self.params.libvirt_attach_timeout):
-            if detach:
-                if not self.device_exists:
-                    self.debugmsg('      detach successful @ %s' %
-                                  self.timestr)
-                    return
-            else:
-                if self.device_exists:
-                    self.debugmsg('      attach successful @ %s' %
-                                  self.timestr)
-                    return
-            self.debugmsg('      waiting for %s; currently %s @ %s' %
-                          (('detach','attach')[detach],
-                           ('detached','attached')[self.device_exists],
-                           self.timestr))
-            time.sleep(1)
+        self.debugmsg('      waiting for %s @ %s' %
+                      (('attach','detach')[detach], self.timestr))
+        if wait_for_path(self.device, present=not detach,
+                         timeout=self.params.libvirt_attach_timeout):
+            self.debugmsg('      %s successful @ %s' %
+                          (('attach','detach')[detach], self.timestr))
+            return
 
         self.error("Failed to attach/detach disk device '%s' "
                    "within %d seconds" %
@@ -386,6 +498,10 @@ class LibvirtVolLayer(SnapLayer):
         self.libvirt_storage_volume_detach()
         # Wait a bit for volume to be detached
         self.wait_attach(detach=True)
+        # the guest may only release the disk once the device is gone
+        self.clear_domain_disks(self.domain_key)
+        self.device_targets.release(self.libvirt_vm_hostname,
+                                    self.orig_device)
 
     def freshen(self):
         '''
@@ -394,6 +510,44 @@ class LibvirtVolLayer(SnapLayer):
         '''
         self.libvirt_storage_pool_refresh()
 
+    @classmethod
+    def find_leaks(cls,collector):
+        '''
+        RBD clones attached to the backup VM
+        '''
+        layer = cls('', collector.params, None)
+        disks = layer.domain_disks
+        leaks = []
+        for name in disks.rbd_names:
+            if not name.endswith(layer.params.rbd_clone_suffix):
+                continue
+            for target in disks.by_source[name]:
+                if target is None:
+                    continue
+                device = '/dev/%s' % target
+                leaks.append(Leak(layer, device, parents=[name],
+                                  snapdb_device=device, source=name,
+                                  xml=disks.disk_xml[target]))
+        return leaks
+
+    def remove_leak(self,leak):
+        try:
+            with self.span('libvirt.detachDevice', device=leak.device):
+                self.libvirt_vm.detachDevice(leak.xml)
+        except libvirt.libvirtError, e:
+            self.error("Detaching '%s' from VM '%s': \n\t%s" %
+                       (leak.device, self.libvirt_vm_hostname, e))
+        finally:
+            self.clear_domain_disks(self.domain_key)
+        if not wait_for_path(leak.device, present=False,
+                             timeout=self.params.libvirt_attach_timeout):
+            self.error("Failed to detach disk device '%s' within %d seconds" %
+                       (leak.device, self.params.libvirt_attach_timeout))
+        self.clear_domain_disks(self.domain_key)
+        self.device_targets.release(self.libvirt_vm_hostname, leak.source)
+
 # Register this layer
 if have_libvirt:
     Stack.register_layer(LibvirtVolLayer)
+    Stack.register_cleanup(LibvirtVolLayer.clear_domain_index)
+    Stack.register_shutdown(LibvirtVolLayer.close_libvirt_conns)
@@ -1,13 +1,22 @@
 # LVM layer snapshots
 
+import json
+
 from stack import Stack
 from layers import SnapLayer
+from garbage import Leak
 
 class LV(SnapLayer):
     lvcreate = '/usr/sbin/lvcreate'
     lvremove = '/usr/sbin/lvremove'
-    lvdisplay = '/usr/sbin/lvdisplay'
+    lvs = '/usr/sbin/lvs'
+    lvs_fields = 'vg_name,lv_name,lv_attr,origin'
     name = 'lv'
+    # LV index shared across instances:  one 'lvs' scan per stack run,
+    # refreshed only after creating or removing a snapshot
+    lv_index = { 'vgs' : None }
+    # snapshot LVs sit on nothing else; see garbage.py
+    leak_tier = 0
 
     @property
     def vg_name(self):
@@ -25,42 +34,140 @@ class LV(SnapLayer):
     def device(self):
         return self.orig_device + self.params.snap_suffix
 
+    @classmethod
+    def clear_lv_index(cls):
+        cls.lv_index['vgs'] = None
+
+    def build_lv_index(self, rebuild=False):
+        '''
+        Scan all LVs with a single 'lvs' run into a per-VG index:
+        { vg_name : { lv_name : { 'lv_attr' : ..., 'origin' : ... } } }
+        '''
+        # concurrent stacks share the index; only one of them scans
+        with self.resource_lock('lvs'):
+            if rebuild or self.lv_index['vgs'] is None:
+                self.lv_index['vgs'] = self._scan_lvs()
+            # another run's cleanup may reset the index once unlocked
+            return self.lv_index['vgs']
+
+    def _scan_lvs(self):
+        cmd = [self.lvs, '--reportformat', 'json', '-o', self.lvs_fields]
+        (res,stdout,stderr) = self.run_cmd(cmd)
+        if not res:
+            self.error("Unable to list logical volumes:  %s" % stderr)
+        try:
+            report = json.loads(stdout)['report']
+        except (ValueError, KeyError):
+            self.error("Unable to parse 'lvs' report:  %s" % stdout)
+
+        vgs = {}
+        for vg_report in report:
+            for lv in vg_report.get('lv',[]):
+                vgs.setdefault(lv['vg_name'],{})[lv['lv_name']] = lv
+        self.debugmsg("    indexed %d LVs in %d VGs" %
+                      (sum([len(v) for v in vgs.values()]), len(vgs)))
+        return vgs
+
+    def lv_record(self, device):
+        '''
+        Look up the index record for a '/dev/<vg>/<lv>' device path;
+        None if no such LV
+        '''
+        (vg_name, lv_name) = device.split('/')[-2:]
+        return self.build_lv_index().get(vg_name,{}).get(lv_name,None)
+
     @property
     def snap_exists(self):
-        cmd = [self.lvdisplay, '-c', self.device]
-        (res,stdout,stderr) = self.run_cmd(cmd)
-        return res
+        return self.lv_record(self.device) is not None
 
     @property
     def orig_exists(self):
-        cmd = [self.lvdisplay, '-c', self.orig_device]
-        (res,stdout,stderr) = self.run_cmd(cmd)
-        return res
+        return self.lv_record(self.orig_device) is not None
 
     @property
     def is_snapshot(self):
-        cmd = ['lvs', '--noheadings', '-o', 'lv_attr', self.device]
-        (res,stdout,stderr) = self.run_cmd(cmd)
-        return stdout.lstrip().rstrip().lower()[0] == 's'
+        rec = self.lv_record(self.device)
+        return rec is not None and rec['lv_attr'][:1].lower() == 's'
 
     @property
     def matches_target(self):
-        cmd = ['lvs', '--noheadings', '-o', 'origin', self.device]
-        (res,stdout,stderr) = self.run_cmd(cmd)
-        return stdout.lstrip().rstrip() == self.lv_name
+        rec = self.lv_record(self.device)
+        return rec is not None and \
+            rec['origin'] == self.orig_device.split('/')[-1]
+
+    @property
+    def lvcreate_cmd(self):
+        return [self.lvcreate, '-s', '-n', self.device,
+                '-L', self.size, self.orig_device]
 
     def create_snapshot(self):
-        cmd = [self.lvcreate, '-s', '-n', self.device,
-               '-L', self.size, self.orig_device]
-        (res,stdout,stderr) = self.run_cmd(cmd)
+        (res,stdout,stderr) = self.run_cmd(self.lvcreate_cmd)
+        self.build_lv_index(rebuild=True)
 
         self.infomsg("  Ran 'lvcreate' command")
+
+    @classmethod
+    def batch_set_up(cls,layers,max_workers):
+        '''
+        Create the snapshot LVs of many torn down stacks with
+        concurrent 'lvcreate' commands, so a host's DLEs are
+        snapshotted moments apart rather than one stack at a time
+
+        Snapshots that fail are left for the stack's own set-up to
+        retry and report.
+        '''
+        todo = []
+        for layer in layers:
+            try:
+                if layer.orig_exists and not layer.snap_exists:
+                    todo.append(layer)
+            except SystemExit:
+                # e.g. a missing Xen VDI; the stack reports it
+                continue
+        if not todo:
+            return
+
+        cmds = [layer.lvcreate_cmd for layer in todo]
+        with todo[0].span('lv.batch_create', count=len(todo)):
+            created = [todo[i] for (i, (res,stdout,stderr))
+                       in todo[0].run_cmds(cmds, max_running=max_workers)
+                       if res]
+        todo[0].build_lv_index(rebuild=True)
+        for layer in created:
+            layer.invalidate_memo()
+            if layer.snap_exists:
+                layer.debugmsg("  Created snapshot LV '%s'" % layer.device)
+                layer.snapdb.record_snap(layer.device)
         
     def remove_snapshot(self):
         # delete the snapshot
         cmd = [self.lvremove, '-f', self.device]
         (res,stdout,stderr) = self.run_cmd(cmd)
+        self.build_lv_index(rebuild=True)
 
         self.infomsg("  Ran 'lvremove' command")
 
+    @classmethod
+    def find_leaks(cls,collector):
+        '''
+        Snapshot LVs named with the snapshot suffix in all VGs
+        '''
+        layer = LV('', collector.params, None)
+        leaks = []
+        for (vg_name, lvs) in layer.build_lv_index(rebuild=True).items():
+            for (lv_name, rec) in lvs.items():
+                if lv_name.endswith(layer.params.snap_suffix) and \
+                        rec['lv_attr'][:1].lower() == 's':
+                    device = "/dev/%s/%s" % (vg_name, lv_name)
+                    leaks.append(Leak(layer, device, snapdb_device=device))
+        return leaks
+
+    def remove_leak(self,leak):
+        cmd = [self.lvremove, '-f', leak.device]
+        (res,stdout,stderr) = self.run_cmd(cmd)
+        self.build_lv_index(rebuild=True)
+        if not res:
+            self.error("Unable to remove LV '%s':  %s" % (leak.device, stderr))
+
 Stack.register_layer(LV)
+Stack.register_cleanup(LV.clear_lv_index)
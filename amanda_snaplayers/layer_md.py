@@ -2,7 +2,8 @@
 
 import re, os.path
 from stack import Stack
-from layers import Layer
+from layers import Layer, memoized_property
+from garbage import Leak
 
 
 class MD_component_device(Layer):
@@ -17,13 +18,28 @@ class MD_component_device(Layer):
     mdadm = '/sbin/mdadm'
     raid1_re = re.compile(r' level=raid1 ')
     uuid_re = re.compile(r'UUID=([0-9a-f:]+)')
-    md_dev_re = re.compile(r'^md([0-9]+)$')
+    mdstat_re = re.compile(r'^(md[0-9]+) : (\S+)')
+    # array states of md devices that aren't running
+    stopped_states = ('clear', 'inactive')
+    # paths read for array discovery; class attributes so they can be
+    # pointed elsewhere, e.g. at a simulated /proc and /sys
+    mdstat = '/proc/mdstat'
+    sys_block = '/sys/block'
+    udev_data = '/run/udev/data'
+    dev_dir = '/dev'
+
+    # md arrays by device, shared by all instances; see build_md_index()
+    md_index = { 'arrays' : None }
+    # arrays sit on snapshot LVs or attached disks; see garbage.py
+    leak_tier = 3
 
     def __init__(self,arg_str,params,parent_layer):
         super(MD_component_device,self).__init__(arg_str,params,parent_layer)
+        self.reset_state()
+
+    def reset_state(self):
         self.md_dev = None
         self.dev_uuid = None
-        self.dev_db = None
         self.found_md_raid1_device = None
 
     def print_info(self):
@@ -45,64 +61,112 @@ class MD_component_device(Layer):
             return None
         return s.groups()[0]
 
-    def _other_md_device_running(self, md_device,
-                                 return_all_results=False, fail_abort=False):
-        cmd = [self.mdadm, '-D', md_device, '-b']
-        (res,stdout,stderr) = self.run_cmd(
-            cmd, sudo=True, t_f=True, fail_abort=fail_abort)
-        if return_all_results:
-            return (res,stdout,stderr)
-        else:
-            return res
+    @staticmethod
+    def normalize_uuid(uuid):
+        '''
+        mdadm prints array UUIDs as 8:8:8:8 hex digits, while sysfs
+        and blkid use the 8-4-4-4-12 form; compare them without
+        separators
+        '''
+        if uuid is None:
+            return None
+        return re.sub(r'[^0-9a-f]', '', uuid.lower()) or None
+
+    def _read_file(self,path):
+        try:
+            with open(path,'r') as f:
+                return f.read().strip()
+        except IOError:
+            return None
+
+    @classmethod
+    def clear_md_index(cls):
+        cls.md_index['arrays'] = None
+
+    def build_md_index(self, rebuild=False):
+        '''
+        Index md arrays from /proc/mdstat and sysfs, without running
+        mdadm:
+        { md_device : { 'running' : ..., 'uuid' : ..., 'slaves' : [...] } }
+        '''
+        with self.resource_lock('md_index'):
+            if rebuild or self.md_index['arrays'] is None:
+                self.md_index['arrays'] = self._scan_md_arrays()
+            # another run's cleanup may reset the index once unlocked
+            return self.md_index['arrays']
+
+    def _scan_md_arrays(self):
+        mdstat = self._read_file(self.mdstat)
+        if mdstat is None:
+            self.error("Unable to read %s; aborting" % self.mdstat)
+
+        arrays = {}
+        for line in mdstat.splitlines():
+            m = self.mdstat_re.match(line)
+            if m is None:
+                continue
+            (md_name, md_state) = m.groups()
+            sys_dir = os.path.join(self.sys_block, md_name)
+            array_state = self._read_file(
+                os.path.join(sys_dir, 'md', 'array_state'))
+            try:
+                slaves = os.listdir(os.path.join(sys_dir, 'slaves'))
+            except OSError:
+                slaves = []
+            array = {
+                'running' : (md_state == 'active' and
+                             array_state not in self.stopped_states),
+                # the 'uuid' attribute is missing on older kernels
+                'uuid' : self.normalize_uuid(self._read_file(
+                        os.path.join(sys_dir, 'md', 'uuid'))),
+                'slaves' : slaves,
+                }
+            self.debugmsg("     Found md device %s:  %s" % (md_name, array))
+            arrays[os.path.join(self.dev_dir, md_name)] = array
+        return arrays
+
+    @property
+    def component_name(self):
+        # kernel name of the component device, e.g. 'dm-3' for
+        # /dev/vg/lv, as listed in an array's sysfs 'slaves' directory
+        return os.path.basename(os.path.realpath(self.parent_device))
 
     def in_running_md_device(self,recheck=False):
 
         # don't re-run check unless told to
-        if self.md_dev is not None:
+        if self.md_dev is not None and not recheck:
             if self.md_dev == -1:
                 return None
             else:
                 return self.md_dev
 
-        # get md array UUID for matching
-        my_uuid = self.get_uuid
+        # rechecking rescans, to see arrays assembled since the index
+        # was built, e.g. by another process
+        arrays = self.build_md_index(rebuild=recheck)
+        running = sorted([md_dev for (md_dev, array) in arrays.items()
+                          if array['running']])
 
-        # reset dev_db
-        self.dev_db = {}
-
-        for devnum in [int(i[2:]) for i in os.listdir("/dev")
-                       if self.md_dev_re.match(i)]:
-            md_dev = '/dev/md%d' % devnum
-
-            (res, stdout, stderr) = \
-                  self._other_md_device_running(md_dev, return_all_results=True)
-            if res is None:
-                self.dev_db[md_dev] = -1
-                self.debugmsg(
-                    "     failed to check device %s; ignoring" % md_dev)
-                continue
-            if not res:
-                self.dev_db[md_dev] = 0
-                self.debugmsg(
-                    "     Device %s not running; ignoring" % md_dev)
-                continue
-
-            uuid = self._extract_uuid(stdout)
-            if uuid is None:
-                self.dev_db[md_dev] = -1
-                self.debugmsg("     Unable to determine UUID for device %s; "
-                              "ignoring" % md_dev)
-                continue
-            if uuid == my_uuid:
+        # our component device is a member of a running array
+        component_name = self.component_name
+        for md_dev in running:
+            if component_name in arrays[md_dev]['slaves']:
                 self.md_dev = md_dev
-                self.dev_db[md_dev] = 1
                 self.debugmsg("  Target device is member of "
                               "running md device %s" % self.md_dev)
                 return self.md_dev
-        
-            self.debugmsg("     Device %s does not contain our component "
-                          "device; ignoring" % md_dev)
 
+        # otherwise, a running array has our component's array UUID
+        if self.device_exists:
+            my_uuid = self.normalize_uuid(self.get_uuid)
+            for md_dev in running:
+                if arrays[md_dev]['uuid'] == my_uuid:
+                    self.md_dev = md_dev
+                    self.debugmsg("  Target device array UUID matches "
+                                  "running md device %s" % self.md_dev)
+                    return self.md_dev
+
+        self.debugmsg("     No running md device contains our "
+                      "component device")
         self.md_dev = -1
         return None
 
@@ -120,14 +184,36 @@ class MD_component_device(Layer):
 
         return self.found_md_raid1_device
 
+    def _udev_uuid(self):
+        '''
+        Array UUID of the component device recorded by udev's blkid
+        probe, or None
+        '''
+        try:
+            rdev = os.stat(self.parent_device).st_rdev
+        except OSError:
+            return None
+        props = self._read_file(os.path.join(
+                self.udev_data, 'b%d:%d' % (os.major(rdev), os.minor(rdev))))
+        if props is None:
+            return None
+        props = dict([l[2:].split('=',1) for l in props.splitlines()
+                      if l.startswith('E:') and '=' in l])
+        if props.get('ID_FS_TYPE',None) != 'linux_raid_member':
+            return None
+        return props.get('ID_FS_UUID',None)
+
     @property
     def get_uuid(self):
         if self.dev_uuid is not None:
             return self.dev_uuid
 
-        cmd = [self.mdadm, '-Q', '--examine', self.parent_device, '-b']
-        (res,stdout,stderr) = self.run_cmd(cmd)
-        self.dev_uuid = self._extract_uuid(stdout)
+        self.dev_uuid = self._udev_uuid()
+        if self.dev_uuid is None:
+            # no udev record; read the superblock
+            cmd = [self.mdadm, '-Q', '--examine', self.parent_device, '-b']
+            (res,stdout,stderr) = self.run_cmd(cmd)
+            self.dev_uuid = self._extract_uuid(stdout)
         if self.dev_uuid is None:
             self.error("unable to determine md device UUID for %s" %
                        self.parent_device)
@@ -140,31 +226,22 @@ class MD_component_device(Layer):
         if self.in_running_md_device() is not None:
             return self.in_running_md_device()
 
-        # otherwise, find an unused md device
+        # otherwise, find an md device not listed in /proc/mdstat
+        arrays = self.build_md_index()
         for i in xrange(10):
-            candidate_dev = "/dev/md%d" % i
-            if self.dev_db.get(candidate_dev,None) is not None:
-                continue
-            if not self.md_device_exists(candidate_dev):
-                self.md_dev = candidate_dev
-                self.debugmsg("  Selecting unused md device %s" %
-                              candidate_dev)
-                break
-            cand_status = self._other_md_device_running(candidate_dev)
-            if cand_status is None:
-                self.debugmsg("    Ignoring uncheckable md device %s" %
-                              candidate_dev)
-            elif cand_status is True:
+            candidate_dev = os.path.join(self.dev_dir, "md%d" % i)
+            if candidate_dev in arrays:
                 self.debugmsg("    md device %s in use" % candidate_dev)
-            else:
-                self.md_dev = candidate_dev
-                self.debugmsg("    Found unused md device %s" % candidate_dev)
-                break
-        if self.md_dev is None:
+                continue
+            self.md_dev = candidate_dev
+            self.debugmsg("  Selecting unused md device %s" % candidate_dev)
+            break
+        # in_running_md_device() leaves -1 when not part of an array
+        if self.md_dev in (None, -1):
             self.error("Unable to find unused md device node; aborting")
         return self.md_dev
 
-    @property
+    @memoized_property
     def device(self):
         if self.is_setup:
             return self.md_device
@@ -177,19 +254,24 @@ class MD_component_device(Layer):
 
     @property
     def md_device_running(self):
-        return self._other_md_device_running(self.md_dev)
+        array = self.build_md_index().get(self.md_dev,None)
+        return array is not None and array['running']
 
-    @property
+    @memoized_property
     def is_setup(self):
         return self.in_running_md_device(recheck=True) is not None
 
     def assemble_md_device(self):
         cmd = [self.mdadm, '-A', self.md_device, self.parent_device, '--run']
         (res,stdout,stderr) = self.run_cmd(cmd)
+        self.build_md_index(rebuild=True)
+        self.invalidate_memo()
 
     def stop_md_device(self):
         cmd = [self.mdadm, '-S', self.md_device]
         (res,stdout,stderr) = self.run_cmd(cmd)
+        self.build_md_index(rebuild=True)
+        self.invalidate_memo()
         self.infomsg("  Ran 'mdadm -S' command")
         
     def safe_set_up(self):
@@ -202,25 +284,34 @@ class MD_component_device(Layer):
         self.debugmsg("  Sanity check passed:  "
                       "device is an md RAID1 component device")
 
-        # if snapshot device is part of a running md array, nothing to do
-        if self.in_running_md_device():
-            self.infomsg("Device is already part of running md array\n")
-            return
-        self.debugmsg("  Device not already part of any running md array")
-
-        self.assemble_md_device()
-        self.infomsg("  Ran 'mdadm -A %s' command" % self.md_device)
-
-        # check device status
-        if not self.md_device_exists:
-            self.error("md device %s does not exist after assembly; aborting" %
-                       self.md_device)
-        self.debugmsg("  Sanity check passed:  md device exists")
-
-        if not self.md_device_running:
-            self.error("md device %s exists but not running after assembly; "
-                       "aborting" % self.md_device)
-        self.debugmsg("  Sanity check passed:  md device running")
+        # hold the md device allocator lock from scanning for a free md
+        # device until it's assembled, so concurrent stacks don't pick
+        # the same one
+        with self.resource_lock('/dev/md'):
+            # rescan; another stack may have assembled devices since,
+            # and md_device picks a free md device from the new index
+            self.md_dev = None
+            self.invalidate_memo()
+
+            # if snapshot device is part of a running md array, nothing to do
+            if self.in_running_md_device(recheck=True):
+                self.infomsg("Device is already part of running md array\n")
+                return
+            self.debugmsg("  Device not already part of any running md array")
+
+            self.assemble_md_device()
+            self.infomsg("  Ran 'mdadm -A %s' command" % self.md_device)
+
+            # check device status
+            if not self.md_device_exists:
+                self.error("md device %s does not exist after assembly; "
+                           "aborting" % self.md_device)
+            self.debugmsg("  Sanity check passed:  md device exists")
+
+            if not self.md_device_running:
+                self.error("md device %s exists but not running after "
+                           "assembly; aborting" % self.md_device)
+            self.debugmsg("  Sanity check passed:  md device running")
 
         self.infomsg("Successfully started md array\n")
 
@@ -267,9 +358,30 @@ class MD_component_device(Layer):
         self.infomsg("Stopped md array %s\n" % self.in_running_md_device())
 
         # reset attributes in case the object is reused
-        self.md_dev = None
-        self.dev_uuid = None
-        self.dev_db = None
+        self.reset_state()
+
+    @classmethod
+    def find_leaks(cls,collector):
+        '''
+        Running md arrays; only those assembled from other leaks, like
+        snapshot LVs, are ours
+        '''
+        layer = cls('', collector.params, None)
+        return [Leak(layer, md_dev, needs_parent=True,
+                     parents=[os.path.join(layer.dev_dir, slave)
+                              for slave in array['slaves']])
+                for (md_dev, array) in
+                layer.build_md_index(rebuild=True).items()
+                if array['running']]
+
+    def remove_leak(self,leak):
+        cmd = [self.mdadm, '-S', leak.device]
+        (res,stdout,stderr) = self.run_cmd(cmd)
+        self.build_md_index(rebuild=True)
+        if not res:
+            self.error("Unable to stop md array '%s':  %s" %
+                       (leak.device, stderr))
 
 # Register this layer
 Stack.register_layer(MD_component_device)
+Stack.register_cleanup(MD_component_device.clear_md_index)
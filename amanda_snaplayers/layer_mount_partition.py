@@ -1,29 +1,28 @@
 # Mount a volume
 
-import re, os.path, time
+import re, os.path
 
 from stack import Stack,Mount
-from layers import Layer
-from params import Params
-
-
-# Mount parameters
-Params.add_option(
-    "--no_auto_mount", "--no-auto-mount",
-    help=("don't automatically try to automount the final device; "
-          "mount must be specified explicitly"))
+from layers import Layer, memoized_property
+from mounts import MountTable
+from wait import wait_for_path
+from garbage import Leak
 
 
 class MountPartition(Layer,Mount):
     name = 'part'
     mount_cmd = '/bin/mount'
     umount_cmd = '/bin/umount'
+    # mounts sit on all other layers; see garbage.py
+    leak_tier = 4
+    # e.g. /dev/vdb1 or /dev/md0p1
+    partition_re = re.compile(r'^(.*\d)p\d+$|^(.*\D)\d+$')
 
     def __init__(self,arg_str,params,parent_layer):
 
         super(MountPartition,self).__init__(arg_str,params,parent_layer)
 
-        self.mount_db = None
+        self.mount_table = MountTable(self)
 
 
     def print_info(self):
@@ -36,7 +35,7 @@ class MountPartition(Layer,Mount):
         self.infomsg("    real base mount directory = %s" %
                      self.real_mount_base)
 
-    @property
+    @memoized_property
     def parent_device(self):
         if self.arg_str and self.arg_str != '0':
             # partitioned parent device
@@ -52,26 +51,12 @@ class MountPartition(Layer,Mount):
     def mount_base(self):
         return self.params.mount_base
 
-    @property
-    def mount_re(self):
-        if getattr(self,'mount_re_compiled',None) is None:
-            self.mount_re_compiled =  re.compile(
-                r'^([^ ]*) (%s/[^ ]*)' %
-                os.path.realpath(self.real_mount_base))
-        return self.mount_re_compiled
-
     @property
     def real_mount_base(self):
-        return os.path.realpath(self.mount_base)
+        return self.mount_table.realpath(self.mount_base)
 
     def device_exists_wait(self,timeout):
-        res = False
-        for i in xrange(timeout+1):
-            res = os.path.exists(self.parent_device)
-            if res:
-                break
-            time.sleep(0.1)
-        return res
+        return wait_for_path(self.parent_device, timeout=timeout)
 
     @property
     def device_exists(self):
@@ -90,6 +75,8 @@ class MountPartition(Layer,Mount):
             # try to create it
             cmd = ['mkdir', self.mount_point]
             (res,stderr,stdout) = self.run_cmd(cmd)
+            self.mount_table.forget_realpath(self.mount_point)
+            self.invalidate_memo()
             if not res:
                 error("Unable to create mount point '%s':\n%s" %
                       (self.mount_point, stderr))
@@ -100,6 +87,8 @@ class MountPartition(Layer,Mount):
     def remove_mount_point(self):
         if os.path.exists(self.mount_point):
             (res,stderr,stdout) = self.run_cmd(['rmdir', self.mount_point])
+            self.mount_table.forget_realpath(self.mount_point)
+            self.invalidate_memo()
             if not res:
                 error("Unable to remove mount point '%s':\n%s" %
                       (self.mount_point, stderr))
@@ -110,44 +99,22 @@ class MountPartition(Layer,Mount):
     def mount_point_is_directory(self):
         return os.path.isdir(self.mount_point)
 
-    @property
+    @memoized_property
     def real_mount_point(self):
-        return os.path.realpath(self.mount_point)
-
-    def build_mount_db(self, rebuild=False):
-        if not rebuild and self.mount_db is not None:
-            return self.mount_db
-
-        self.mount_db = { 'mount_dev' : {},
-                          'mount_point' : {} }
-
-        try:
-            fd = open('/proc/mounts','r')
-            for line in fd:
-                m = self.mount_re.match(line)
-                if m is None:
-                    continue
-                self.mount_db['mount_dev'][m.groups()[0]] = m.groups()[1]
-                self.mount_db['mount_point'][m.groups()[1]] = m.groups()[0]
-                self.debugmsg("    found mount '%s' -> '%s'" %
-                              m.groups())
-        except:
-            self.error("Unable to read /proc/mounts")
-
-        return self.mount_db
+        return self.mount_table.realpath(self.mount_point)
 
     def mount_point_to_mount_dev(self,mount_point):
-        return self.build_mount_db()['mount_point'].get(mount_point,None)
+        return self.mount_table.mount_point_to_mount_dev(mount_point)
 
     def mount_dev_to_mount_point(self,mount_dev):
-        return self.build_mount_db()['mount_dev'].get(mount_dev,None)
+        return self.mount_table.mount_dev_to_mount_point(mount_dev)
 
-    @property
+    @memoized_property
     def is_mounted(self):
         return self.mount_point_to_mount_dev(self.real_mount_point) == \
                self.parent_device
 
-    @property
+    @memoized_property
     def is_mounted_by_something(self):
         return self.mount_point_to_mount_dev(self.real_mount_point) is not None
 
@@ -161,15 +128,17 @@ class MountPartition(Layer,Mount):
 
     def do_mount(self):
         cmd = [self.mount_cmd, '-r', self.parent_device, self.mount_point]
+        # the kernel flags mountinfo before the command exits, so the
+        # next lookup picks up the change
         (res,stdout,stderr) = self.run_cmd(cmd)
-        self.build_mount_db(rebuild=True)
+        self.invalidate_memo()
         if not res:
             self.error("Mount command failed:  %s" % stderr)
 
     def do_umount(self):
         cmd = [self.umount_cmd, self.mount_point]
         (res,stdout,stderr) = self.run_cmd(cmd)
-        self.build_mount_db(rebuild=True)
+        self.invalidate_memo()
         if not res:
             self.error("Mount command failed:  %s" % stderr)
 
@@ -190,7 +159,7 @@ class MountPartition(Layer,Mount):
 
         # sanity check:  device exists (wait up to two seconds for device
         # to appear)
-        if not self.device_exists_wait(20):
+        if not self.device_exists_wait(2):
             self.error("Cannot mount non-existent device %s" %
                        self.parent_device)
         self.debugmsg("  Sanity check passed:  device exists")
@@ -243,5 +212,160 @@ class MountPartition(Layer,Mount):
         self.infomsg("Device successfully unmounted\n")
 
 
-# Register this layer
+    @classmethod
+    def find_leaks(cls,collector):
+        '''
+        Mounts under the base mount directory
+        '''
+        layer = cls('0', collector.params, None)
+        leaks = []
+        for (dev, point) in layer.mount_table.mounts():
+            if not point.startswith(layer.real_mount_base + '/'):
+                continue
+            parents = [dev]
+            m = cls.partition_re.match(dev)
+            if m is not None:
+                parents.append(m.group(1) or m.group(2))
+            leaks.append(Leak(layer, point, parents=parents,
+                              orphaned=not os.path.exists(dev)))
+        return leaks
+
+    def remove_leak(self,leak):
+        (res,stdout,stderr) = self.run_cmd([self.umount_cmd, leak.device])
+        if not res:
+            self.error("Unable to unmount '%s':  %s" % (leak.device, stderr))
+        (res,stdout,stderr) = self.run_cmd(['rmdir', leak.device])
+        self.mount_table.forget_realpath(leak.device)
+        if not res:
+            self.error("Unable to remove mount point '%s':  %s" %
+                       (leak.device, stderr))
+        # a 'parts' layer's mount point holds one directory per
+        # partition; it goes with the last of them, failing to go
+        # while others remain
+        mount_dir = os.path.dirname(leak.device)
+        if mount_dir.startswith(self.real_mount_base + '/'):
+            self.run_cmd(['rmdir', mount_dir])
+
+
+class PartitionMount(MountPartition):
+    '''
+    One partition of a MountPartitions layer, mounted on a subdirectory
+    of the DLE's mount point named after the partition number
+    '''
+
+    def __init__(self,arg_str,params,parent_layer,mount_dir):
+
+        super(PartitionMount,self).__init__(arg_str,params,parent_layer)
+
+        self.mount_dir = mount_dir
+
+    @property
+    def mount_point(self):
+        return os.path.join(self.mount_dir, self.arg_str)
+
+
+class MountPartitions(Layer,Mount):
+    '''
+    Mount several partitions of one parent device in a single stack,
+    each on a subdirectory of the DLE's mount point, e.g. partitions 1
+    and 2 of an md array on <mount point>/1 and <mount point>/2:
+
+    /v/amanda.mount/lv=vg+lv,raid1,parts=1+2
+
+    The snapshots and devices under the partitions are then set up
+    once for all of them.  The layer holds one reference to its parent
+    device per mounted partition:  it counts as set up while any
+    partition is mounted, and as stale unless all are, so a partly
+    mounted layer is unmounted and mounted afresh; it is torn down,
+    letting the parent device go, once all are unmounted.
+    '''
+
+    name = 'parts'
+
+    def __init__(self,arg_str,params,parent_layer):
+
+        super(MountPartitions,self).__init__(arg_str,params,parent_layer)
+
+        if not arg_str or [p for p in self.args if not p.isdigit()]:
+            self.error("Bad partition list '%s'; use e.g. 'parts=1%s2'" %
+                       (arg_str, params.field_sep))
+        self.mounts = [PartitionMount(part, params, parent_layer,
+                                      self.mount_point)
+                       for part in self.args]
+        self.mount_table = self.mounts[0].mount_table
+
+    def print_info(self):
+        self.infomsg("Initialized multiple partition mount object "
+                     "parameters:")
+        self.infomsg("    mount point = %s" % self.mount_point)
+        for mount in self.mounts:
+            self.infomsg("    partition %s mount point = %s" %
+                         (mount.arg_str, mount.mount_point))
+
+    @property
+    def mount_point(self):
+        return self.params.device
+
+    @property
+    def device(self):
+        if self.is_setup:
+            return self.mount_point
+        else:
+            return None
+
+    @memoized_property
+    def refcount(self):
+        '''
+        Number of partitions mounted on their mount points, whether by
+        this layer or not; each keeps the parent device in use
+        '''
+        return len([m for m in self.mounts if m.is_mounted_by_something])
+
+    @property
+    def is_setup(self):
+        return self.refcount > 0
+
+    @memoized_property
+    def is_stale(self):
+        if [m for m in self.mounts if not m.is_mounted]:
+            return True
+        return self.parent.is_stale
+
+    def safe_set_up(self):
+        self.infomsg("Mounting partitions %s onto %s" %
+                     (', '.join(self.args), self.mount_point))
+        if not os.path.isdir(self.mount_point):
+            (res,stdout,stderr) = self.run_cmd(['mkdir', self.mount_point])
+            if not res:
+                self.error("Unable to create mount point '%s':\n%s" %
+                           (self.mount_point, stderr))
+        for mount in self.mounts:
+            mount.safe_set_up()
+        self.invalidate_memo()
+        if self.refcount != len(self.mounts):
+            self.error("Only %d of %d partitions mounted" %
+                       (self.refcount, len(self.mounts)))
+        self.infomsg("Partitions successfully mounted\n")
+
+    def safe_teardown(self):
+        self.infomsg("Unmounting partitions %s from %s" %
+                     (', '.join(self.args), self.mount_point))
+        for mount in reversed(self.mounts):
+            mount.safe_teardown()
+            # left behind by a partition that wasn't mounted
+            mount.remove_mount_point()
+        self.invalidate_memo()
+        if self.refcount:
+            self.error("%d partitions still mounted; not releasing "
+                       "parent device" % self.refcount)
+        if os.path.isdir(self.mount_point):
+            (res,stdout,stderr) = self.run_cmd(['rmdir', self.mount_point])
+            if not res:
+                self.error("Unable to remove mount point '%s':\n%s" %
+                           (self.mount_point, stderr))
+        self.infomsg("Partitions successfully unmounted\n")
+
+
+# Register these layers
 Stack.register_layer(MountPartition)
+Stack.register_layer(MountPartitions)
@@ -1,6 +1,7 @@
 # RBD volumes
 
-import re,time
+import re, time, threading
+from multiprocessing.pool import ThreadPool
 
 have_rbd = True
 try:
@@ -10,83 +11,282 @@ except:
     have_rbd = False
 
 from stack import Stack
-from layers import SnapLayer
-from params import Params
+from layers import SnapLayer, memoized_property
+from util import Util
+from wait import wait_until
+from statedb import StateDB
+from pending_removals import PendingRemovals
+from garbage import Leak
 
-Params.add_option(
-    "--ceph_conf", "--ceph-conf",
-    default="/etc/ceph/ceph.conf",
-    help=("Ceph configuration file"))
 
-Params.add_option(
-    "--rbd_clone_suffix", "--rbd-clone-suffix",
-    default=".amclone",
-    help=("RBD clone image name suffix"))
+class CephConnectionPool(object):
+    '''
+    Ceph cluster connections, pool I/O contexts and open RBD images,
+    keyed by (ceph_conf, pool, image)
 
+    Connections stay open for the whole stack run and are shared by
+    all Ceph layers and DLE stacks in the process.  Images, which hold
+    watches, are closed at the end of each run by Stack.cleanup(); a
+    daemon keeps the cluster connections until Stack.shutdown().
+    '''
 
-# Decorators for Ceph functions: ensure cluster, ioctx and image are defined
-def ceph_method(func,with_image=False):
-    def wrapper(obj, *args,**kwargs):
-        if obj.ceph_object_counts['cluster'] == 0:
-            obj.ceph_objects['cluster'] = \
-                rados.Rados(conffile=obj.ceph_conf)
-            obj.ceph_objects['cluster'].connect()
-            obj.debugmsg(
-                "      %s:  Set ceph cluster" %
-                func.func_name)
-        obj.ceph_object_counts['cluster'] += 1
+    # shared across instances
+    objects = { 'clusters' : {},
+                'ioctxs' : {},
+                'images' : {},
+                }
+    lock = threading.RLock()
+
+    def __init__(self,util):
+        self.util = util
+
+    def cluster(self,ceph_conf):
+        with self.lock:
+            if ceph_conf not in self.objects['clusters']:
+                with self.util.span('ceph.connect', conf=ceph_conf):
+                    cluster = rados.Rados(conffile=ceph_conf)
+                    cluster.connect()
+                self.objects['clusters'][ceph_conf] = cluster
+                self.util.debugmsg("      Connected to ceph cluster '%s'" %
+                                   ceph_conf)
+            return self.objects['clusters'][ceph_conf]
+
+    def ioctx(self,ceph_conf,pool):
+        with self.lock:
+            key = (ceph_conf, pool)
+            if key not in self.objects['ioctxs']:
+                cluster = self.cluster(ceph_conf)
+                with self.util.span('ceph.open_ioctx', pool=pool):
+                    self.objects['ioctxs'][key] = cluster.open_ioctx(pool)
+                self.util.debugmsg("      Opened ceph ioctx for pool '%s'" %
+                                   pool)
+            return self.objects['ioctxs'][key]
+
+    def image(self,ceph_conf,pool,image):
+        with self.lock:
+            key = (ceph_conf, pool, image)
+            if key not in self.objects['images']:
+                ioctx = self.ioctx(ceph_conf,pool)
+                with self.util.span('ceph.open_image',
+                                    image='%s/%s' % (pool, image)):
+                    self.objects['images'][key] = rbd.Image(ioctx, image)
+                self.util.debugmsg("      Opened ceph image '%s/%s'" %
+                                   (pool, image))
+            return self.objects['images'][key]
+
+    def close_image(self,ceph_conf,pool,image):
+        '''
+        Close an open image; an open image holds a watch, which
+        prevents removing it
+        '''
+        with self.lock:
+            img = self.objects['images'].pop((ceph_conf, pool, image), None)
+            if img is not None:
+                img.close()
+                self.util.debugmsg("      Closed ceph image '%s/%s'" %
+                                   (pool, image))
+
+    def close_images(self):
+        with self.lock:
+            for img in self.objects['images'].values():
+                img.close()
+            self.objects['images'].clear()
+
+    def shutdown(self):
+        with self.lock:
+            self.close_images()
+            for ioctx in self.objects['ioctxs'].values():
+                ioctx.close()
+            for cluster in self.objects['clusters'].values():
+                cluster.shutdown()
+            for objs in self.objects.values():
+                objs.clear()
+
+
+class RBDReaper(Util):
+    '''
+    Remove the RBD clones and snapshots whose removal was deferred to
+    the pending_removals table because watchers kept them busy
+
+    The OSDs drop a stale watch osd_client_watch_timeout seconds after
+    its client's last ping, so while an image still has watchers, the
+    next attempt is made when that time has passed since the removal
+    first failed; otherwise attempts back off exponentially.  A
+    background thread per state file works through the table while it
+    has entries, until Stack.shutdown().
+    '''
+
+    # seconds between attempts, doubling up to max_retry_interval
+    retry_interval = 1
+    max_retry_interval = 60
+    # default osd_client_watch_timeout
+    default_watch_timeout = 30
+    # look for newly deferred removals at least this often
+    max_sleep = 5
+
+    # background threads by state file
+    threads = {}
+    threads_lock = threading.Lock()
+    stopping = threading.Event()
+
+    def __init__(self,state_file,debug=False):
+        super(RBDReaper,self).__init__(debug=debug)
+        self.state_file = state_file
+        self.ceph_pool_objects = CephConnectionPool(self)
+
+    @property
+    def pending(self):
+        return PendingRemovals(StateDB.open(self.state_file, self))
+
+    def watch_timeout(self,ceph_conf):
+        cluster = self.ceph_pool_objects.cluster(ceph_conf)
         try:
-            if obj.ceph_object_counts['ioctx'] == 0:
-                obj.ceph_objects['ioctx'] = \
-                    obj.ceph_objects['cluster'].open_ioctx(obj.ceph_pool)
-                obj.debugmsg(
-                    "      %s:  Set ceph ioctx" %
-                    func.func_name)
-            obj.ceph_object_counts['ioctx'] += 1
-            try:
-                if with_image:
-                    if obj.ceph_object_counts['image'] == 0:
-                        obj.ceph_objects['image'] = \
-                            rbd.Image(obj.ceph_objects['ioctx'],
-                                      obj.rbd_volume)
-                        obj.debugmsg(
-                            "      %s:  Set ceph image" %
-                            func.func_name)
-                    obj.ceph_object_counts['image'] += 1
+            return int(cluster.conf_get('osd_client_watch_timeout'))
+        except (AttributeError, TypeError, ValueError, rados.Error):
+            return self.default_watch_timeout
 
-                try:
-                    res = func(obj,*args,**kwargs)
-
-                finally:
-                    if with_image:
-                        obj.ceph_object_counts['image'] -= 1
-                        if obj.ceph_object_counts['image'] == 0:
-                            obj.ceph_objects['image'].close()
-                            obj.debugmsg(
-                                "      %s:  Closed ceph image" %
-                                func.func_name)
-            finally:
-                obj.ceph_object_counts['ioctx'] -= 1
-                if obj.ceph_object_counts['ioctx'] == 0:
-                    obj.ceph_objects['ioctx'].close()
-                    obj.debugmsg(
-                        "      %s:  Closed ceph ioctx" %
-                        func.func_name)
-        except Exception, e:
-            print "exception: %s" % e
-            raise e
+    def has_watchers(self,entry):
+        '''
+        True if the clone has watchers, False if not, or None if
+        unknown; watchers_list() needs Ceph Nautilus
+        '''
+        if entry['snap'] is not None:
+            return None
+        ioctx = self.ceph_pool_objects.ioctx(entry['ceph_conf'],
+                                             entry['pool'])
+        try:
+            # read-only images don't watch the image themselves
+            image = rbd.Image(ioctx, entry['image'], read_only=True)
+        except rbd.Error:
+            return None
+        try:
+            if not hasattr(image,'watchers_list'):
+                return None
+            return bool(list(image.watchers_list()))
         finally:
-            obj.ceph_object_counts['cluster'] -= 1
-            if obj.ceph_object_counts['cluster'] == 0:
-                obj.ceph_objects['cluster'].shutdown()
-                obj.debugmsg(
-                    "      %s:  Closed ceph cluster" %
-                    func.func_name)
-        return res
-    return wrapper
+            image.close()
+
+    def next_attempt(self,entry,now):
+        expiry = entry['first_busy'] + self.watch_timeout(entry['ceph_conf'])
+        if now < expiry and self.has_watchers(entry):
+            # stale watchers will be gone by then
+            return expiry
+        return now + min(self.retry_interval * 2 ** entry['attempts'],
+                         self.max_retry_interval)
+
+    def remove(self,entry):
+        '''
+        Try once to remove a pending clone or snapshot; return True if
+        it's gone
+        '''
+        key = (entry['ceph_conf'], entry['pool'], entry['image'])
+        with self.resource_lock(('ceph',) + key):
+            with self.span('ceph.reap', device=entry['device'],
+                           attempts=entry['attempts']):
+                try:
+                    if entry['snap'] is None:
+                        # our own open image would hold a watch
+                        self.ceph_pool_objects.close_image(*key)
+                        ioctx = self.ceph_pool_objects.ioctx(*key[:2])
+                        rbd.RBD().remove(ioctx, entry['image'])
+                    else:
+                        image = self.ceph_pool_objects.image(*key)
+                        snap = entry['snap']
+                        if snap not in [s['name'] for s in image.list_snaps()]:
+                            return True
+                        # fails while the snapshot still has a clone
+                        if image.is_protected_snap(snap):
+                            image.unprotect_snap(snap)
+                        image.remove_snap(snap)
+                except rbd.ImageNotFound:
+                    pass
+                except rbd.Error, e:
+                    self.debugmsg("      removing '%s' failed @ %s:  %s" %
+                                  (entry['device'], self.timestr, e))
+                    return False
+        self.debugmsg("      removed '%s' @ %s" %
+                      (entry['device'], self.timestr))
+        return True
+
+    def reap(self,entries,force=False):
+        '''
+        Try to remove each pending entry that is due, or all of them if
+        force; return True if all are gone
+        '''
+        pending = self.pending
+        now = time.time()
+        done = True
+        for entry in entries:
+            if not force and entry['not_before'] > now:
+                done = False
+            elif self.remove(entry):
+                pending.delete(entry['device'])
+            else:
+                pending.reschedule(entry['device'],
+                                   self.next_attempt(entry, time.time()))
+                done = False
+        return done
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                with self.threads_lock:
+                    entries = self.pending.all()
+                    if not entries:
+                        del self.threads[self.state_file]
+                        return
+                self.reap(entries)
+                next_due = min([e['not_before'] for e in self.pending.all()]
+                               or [time.time() + self.max_sleep])
+            except SystemExit:
+                # e.g. the state db is unreadable; try again later
+                next_due = time.time() + self.max_sleep
+            self.stopping.wait(
+                max(0, min(next_due - time.time(), self.max_sleep)))
+        with self.threads_lock:
+            self.threads.pop(self.state_file,None)
+
+    @classmethod
+    def start(cls,state_file,debug=False):
+        '''
+        Start the state file's reaper thread, if not running
+        '''
+        with cls.threads_lock:
+            thread = cls.threads.get(state_file,None)
+            if thread is not None and thread.is_alive():
+                return
+            reaper = cls(state_file, debug=debug)
+            thread = threading.Thread(target=reaper.run,
+                                      name='rbd-reaper')
+            thread.daemon = True
+            cls.threads[state_file] = thread
+            thread.start()
+
+    @classmethod
+    def stop(cls):
+        '''
+        Stop the reaper threads; removals still pending stay in the
+        state db for the next process
+        '''
+        cls.stopping.set()
+        with cls.threads_lock:
+            threads = cls.threads.values()
+        for thread in threads:
+            thread.join()
+        cls.stopping.clear()
+
 
+# Decorator for RBD image methods:  operations on an open image, such as
+# set_snap(), change its state, so serialize access to each image; each
+# call is traced
 def rbd_method(func):
-    return ceph_method(func,True)
+    def wrapper(obj, *args,**kwargs):
+        with obj.resource_lock(('ceph',) + obj.image_key):
+            with obj.span('ceph.%s' % func.func_name,
+                          image='%s/%s' % obj.image_key[1:]):
+                return func(obj, *args,**kwargs)
+    wrapper.func_name = func.func_name
+    return wrapper
 
 
 class CephSnapLayer(SnapLayer):
@@ -94,37 +294,26 @@ class CephSnapLayer(SnapLayer):
     Common class inherited by RBDSnapLayer and RBDCloneLayer
     '''
 
-    ceph_object_counts = {'cluster':0, 'ioctx':0, 'image':0}
-    ceph_objects = {}
+    # Objects from the connection pool
+    @property
+    def ceph_pool_objects(self):
+        return CephConnectionPool(self)
 
-    # Methods used by the rbd_method decorator wrapper
     @property
     def cluster(self):
-        return self.ceph_objects.get('cluster',None)
+        return self.ceph_pool_objects.cluster(self.ceph_conf)
 
     @property
     def ioctx(self):
-        return self.ceph_objects.get('ioctx',None)
+        return self.ceph_pool_objects.ioctx(self.ceph_conf, self.ceph_pool)
 
     @property
-    def image(self):
-        return self.ceph_objects.get('image',None)
-
-    def set_ceph_objects(self,cluster,ioctx,image=None):
-        if image is None:
-            attr = 'ceph_objects'
-        else:
-            attr = 'rbd_objects'
-            setattr(self,attr,
-                    {'cluster' : cluster,
-                     'ioctx' : ioctx,
-                     'image' : image })
+    def image_key(self):
+        return (self.ceph_conf, self.ceph_pool, self.rbd_volume)
 
-    def clear_ceph_objects(self):
-        self.ceph_objects = {}
-
-    def clear_rbd_objects(self):
-        self.rbd_objects = {}
+    @property
+    def image(self):
+        return self.ceph_pool_objects.image(*self.image_key)
 
     @property
     def ceph_conf(self):
@@ -138,6 +327,85 @@ class CephSnapLayer(SnapLayer):
     def snap_name(self):
         return self.params.snap_suffix
 
+    @property
+    def reaper(self):
+        return RBDReaper(self.params.snaplayers_state_file, self.debug)
+
+    @property
+    def removal_pending(self):
+        '''
+        True if the device waits for the reaper; it counts as removed
+        '''
+        return self.reaper.pending.get(self.device) is not None
+
+    def defer_removal(self,snap=None):
+        '''
+        Leave removing the device to the reaper thread
+        '''
+        self.infomsg("    Deferring removal of '%s' to the reaper" %
+                     self.device)
+        reaper = self.reaper
+        now = time.time()
+        entry = { 'device' : self.device,
+                  'ceph_conf' : self.ceph_conf,
+                  'pool' : self.ceph_pool,
+                  'image' : self.rbd_volume,
+                  'snap' : snap,
+                  'first_busy' : now,
+                  'attempts' : 0 }
+        reaper.pending.add(self.device, self.ceph_conf, self.ceph_pool,
+                           self.rbd_volume, snap, now,
+                           reaper.next_attempt(entry, now))
+        RBDReaper.start(self.params.snaplayers_state_file, self.debug)
+
+    def rbd_images(self):
+        '''
+        (pool, image) of all RBD images in all pools of the cluster
+        '''
+        images = []
+        for pool in self.cluster.list_pools():
+            ioctx = self.ceph_pool_objects.ioctx(self.ceph_conf, pool)
+            try:
+                images += [(pool, name) for name in rbd.RBD().list(ioctx)]
+            except rbd.Error, e:
+                # e.g. not an RBD pool
+                self.debugmsg("      unable to list RBD images of pool "
+                              "'%s':  %s" % (pool, e))
+        return images
+
+    def remove_leak(self,leak):
+        entry = { 'device' : leak.device,
+                  'ceph_conf' : self.ceph_conf,
+                  'pool' : leak.pool,
+                  'image' : leak.image,
+                  'snap' : leak.snap,
+                  'attempts' : 0 }
+        if not self.reaper.remove(entry):
+            self.error("Unable to remove '%s'; still in use" % leak.device)
+
+    def wait_pending_removals(self):
+        '''
+        Before creating a snapshot or clone, finish any deferred
+        removal still occupying its name
+        '''
+        reaper = self.reaper
+        entries = [e for e in [reaper.pending.get(d)
+                               for d in self.pending_devices]
+                   if e is not None]
+        if not entries:
+            return
+        self.infomsg("    Waiting for deferred removal of %s" %
+                     ', '.join(["'%s'" % e['device'] for e in entries]))
+        def reap():
+            return reaper.reap(
+                [e for e in [reaper.pending.get(e['device'])
+                             for e in entries] if e is not None],
+                force=True)
+        with self.span('ceph.wait_reap', image=self.device):
+            if not wait_until(reap, RBDCloneLayer.clone_removal_timeout):
+                self.error("Deferred removal of '%s' failed:  "
+                           "still has watchers" % self.device)
+
 
 class RBDSnapLayer(CephSnapLayer):
     '''
@@ -151,6 +419,8 @@ class RBDSnapLayer(CephSnapLayer):
 
     name = 'rbd_snap'
     rbd_snap_re = re.compile(r'^[^/@]+/[^/@]+@[^/@]+$')
+    # snapshots sit on nothing else; see garbage.py
+    leak_tier = 0
 
     def __init__(self, *args):
         super(RBDSnapLayer, self).__init__(*args)
@@ -180,8 +450,19 @@ class RBDSnapLayer(CephSnapLayer):
             (self.ceph_pool, self.rbd_volume, self.snap_name)
 
     @property
+    def pending_devices(self):
+        # the snapshot's clone goes first
+        return ['%s/%s%s' % (self.ceph_pool, self.rbd_volume,
+                             self.params.rbd_clone_suffix),
+                self.device]
+
+    @memoized_property
     @rbd_method
     def snap_exists(self):
+        if self.removal_pending:
+            self.debugmsg("      RBD snapshot '%s' awaits the reaper" %
+                          self.device)
+            return False
         for s in self.image.list_snaps():
             if s['name'] == self.snap_name:
                 self.debugmsg(
@@ -194,7 +475,8 @@ class RBDSnapLayer(CephSnapLayer):
 
     @rbd_method
     def _orig_exists(self):
-        pass
+        # opening the image raises ImageNotFound if it doesn't exist
+        self.image
 
     @property
     def orig_exists(self):
@@ -221,6 +503,7 @@ class RBDSnapLayer(CephSnapLayer):
     def create_snapshot(self):
         self.debugmsg("  Creating RBD snapshot '%s' for image '%s'" %
                       (self.orig_device,self.snap_name))
+        self.wait_pending_removals()
         self._create()
         self.debugmsg("  Protecting RBD snapshot")
         self._protect()
@@ -268,6 +551,10 @@ class RBDSnapLayer(CephSnapLayer):
         
     @rbd_method
     def remove_snapshot(self):
+        if self.reaper.pending.get(self.pending_devices[0]) is not None:
+            # its clone awaits the reaper
+            self.defer_removal(snap=self.snap_name)
+            return
         if self._is_protected:
             self._unprotect()
             if self._is_protected:
@@ -275,14 +562,18 @@ class RBDSnapLayer(CephSnapLayer):
                            self.orig_device)
         self._remove()
         
-    @property
+    @memoized_property
     @rbd_method
     def snap_children(self):
         '''
         Check snapshot children
         '''
         self.image.set_snap(self.snap_name)
-        res = self.image.list_children()
+        try:
+            res = self.image.list_children()
+        finally:
+            # the image is shared; return it to the image head
+            self.image.set_snap(None)
         if res:
             for c in res:
                 self.debugmsg(
@@ -292,24 +583,102 @@ class RBDSnapLayer(CephSnapLayer):
                           self.device)
         return res
         
-    @ceph_method
     def clone(self,child_name):
         self.debugmsg(
             "    Cloning snapshot '%s@%s' into image '%s', pool '%s'" %
             (self.rbd_volume, self.snap_name, child_name, self.ceph_pool))
         rbd_inst = rbd.RBD()
-        with self.cluster.open_ioctx(self.ceph_pool) as child_ioctx:
-            with self.cluster.open_ioctx(self.ceph_pool) as parent_ioctx:
-                rbd_inst.clone(parent_ioctx, self.rbd_volume, self.snap_name,
-                               child_ioctx, child_name,
-                               rbd.RBD_FEATURE_LAYERING)
+        ioctx = self.ioctx
+        with self.span('ceph.clone', image=child_name):
+            rbd_inst.clone(ioctx, self.rbd_volume, self.snap_name,
+                           ioctx, child_name,
+                           rbd.RBD_FEATURE_LAYERING)
 
-    # Set up the RBD objects once for all operations in safe_set_up
+    # Hold the image for all operations in safe_set_up
     @rbd_method
     def safe_set_up(self):
         super(CephSnapLayer,self).safe_set_up()
 
-    # Set up the RBD objects once for all operations in safe_teardown
+    @classmethod
+    def find_leaks(cls,collector):
+        '''
+        Snapshots named with the snapshot suffix on RBD images of all
+        pools; those awaiting the reaper are left to it
+        '''
+        layer = cls('', collector.params, None)
+        pending = layer.reaper.pending
+        leaks = []
+        for (pool, name) in layer.rbd_images():
+            if name.endswith(layer.params.rbd_clone_suffix):
+                continue
+            ioctx = layer.ceph_pool_objects.ioctx(layer.ceph_conf, pool)
+            try:
+                image = rbd.Image(ioctx, name, read_only=True)
+            except rbd.ImageNotFound:
+                continue
+            try:
+                snaps = [snap['name'] for snap in image.list_snaps()]
+            finally:
+                image.close()
+            device = '%s/%s@%s' % (pool, name, layer.snap_name)
+            if layer.snap_name in snaps and pending.get(device) is None:
+                leaks.append(Leak(layer, device, snapdb_device=device,
+                                  pool=pool, image=name,
+                                  snap=layer.snap_name))
+        return leaks
+
+    @classmethod
+    def batch_set_up(cls,layers,max_workers):
+        '''
+        Snapshot the images of many torn down stacks at once:  create
+        all snapshots in one tight parallel loop, then protect and
+        record them concurrently, so a VM's images are snapshotted
+        moments apart rather than one stack at a time
+
+        Images that fail are left for the stack's own set-up to retry.
+        RBD group snapshots can't be protected and cloned, so each
+        image gets its own snapshot.
+        '''
+        context = layers[0].thread_context()
+        def run_all(method,layers):
+            def run_layer(layer):
+                layer.set_thread_context(context)
+                try:
+                    with layer.span('ceph.batch_%s' % method.func_name,
+                                    **layer.span_attrs):
+                        method(layer)
+                    return True
+                except (SystemExit, rbd.Error), e:
+                    layer.infomsg("Batch set-up of '%s' failed:  %s" %
+                                  (layer.device, e))
+                    return False
+            pool = ThreadPool(max(1, min(max_workers, len(layers))))
+            try:
+                return pool.map(run_layer, layers)
+            finally:
+                pool.close()
+                pool.join()
+
+        def create(layer):
+            layer.debugmsg("  Creating RBD snapshot '%s'" % layer.device)
+            layer.wait_pending_removals()
+            layer._create()
+        def protect(layer):
+            layer.debugmsg("  Protecting RBD snapshot '%s'" % layer.device)
+            try:
+                layer._protect()
+            except rbd.Error:
+                # an unprotected snapshot can't be cloned; drop it
+                layer._remove()
+                raise
+            layer.snapdb.record_snap(layer.device)
+
+        results = run_all(create, layers)
+        created = [l for (l,res) in zip(layers,results) if res]
+        if created:
+            run_all(protect, created)
+
+    # Hold the image for all operations in safe_teardown
     @rbd_method
     def safe_teardown(self):
         super(CephSnapLayer,self).safe_teardown()
@@ -318,6 +687,9 @@ class RBDSnapLayer(CephSnapLayer):
 # Register this layer
 if have_rbd:
     Stack.register_layer(RBDSnapLayer)
+    Stack.register_cleanup(CephConnectionPool(Util()).close_images)
+    Stack.register_shutdown(RBDReaper.stop)
+    Stack.register_shutdown(CephConnectionPool(Util()).shutdown)
 
 
 class RBDCloneLayer(CephSnapLayer):
@@ -333,6 +705,10 @@ class RBDCloneLayer(CephSnapLayer):
 
     name = 'rbd_clone'
     insert_parent = 'rbd_snap'
+    # clones sit on snapshots; see garbage.py
+    leak_tier = 1
+    # seconds to retry removing a clone with stale watchers
+    clone_removal_timeout = 35
     rbd_snap_re = re.compile(r'^[^/@]+/[^/@]+@[^/@]+$')
 
     @property
@@ -365,7 +741,15 @@ class RBDCloneLayer(CephSnapLayer):
         return '%s/%s' % (self.ceph_pool, self.rbd_volume)
 
     @property
+    def pending_devices(self):
+        return [self.device]
+
+    @memoized_property
     def snap_exists(self):
+        if self.removal_pending:
+            self.debugmsg("      RBD image '%s' awaits the reaper" %
+                          self.device)
+            return False
         res = (self.ceph_pool, self.rbd_volume) in self.parent.snap_children
         if res:
             self.debugmsg(
@@ -390,14 +774,19 @@ class RBDCloneLayer(CephSnapLayer):
     def create_snapshot(self):
         self.debugmsg("  Cloning RBD snapshot '%s' into '%s'" %
                       (self.orig_device,self.device))
+        self.wait_pending_removals()
         self.parent.clone(self.rbd_volume)
 
-    @ceph_method
     def _remove_clone(self):
         # Internal function to remove snapshot; return True or False
+
+        # our own open image would hold a watch
+        self.ceph_pool_objects.close_image(*self.image_key)
         rbd_inst = rbd.RBD()
+        ioctx = self.ioctx
         try:
-            rbd_inst.remove(self.ioctx, self.rbd_volume)
+            with self.span('ceph.remove', image=self.device):
+                rbd_inst.remove(ioctx, self.rbd_volume)
             self.debugmsg("      clone removed successfully @ %s" %
                           self.timestr)
             return True
@@ -411,22 +800,59 @@ class RBDCloneLayer(CephSnapLayer):
         # For debugging, list lockers
         self._lockers
         
+        if self.params.defer_removal:
+            # don't hold up the hook while stale watchers time out
+            if not self._remove_clone():
+                self.defer_removal()
+            return
+
         # Try to remove snapshot; if there were watchers that didn't
         # exit gracefully, it could take 30 seconds to release the
-        # watch, so retry every 5 seconds for 30 seconds
-
-        if self._remove_clone():
+        # watch, so retry with backoff for 35 seconds
+
+        with self.span('ceph.remove_clone', image=self.device) as span:
+            span['retries'] = -1
+            def remove_clone():
+                span['retries'] += 1
+                return self._remove_clone()
+            removed = wait_until(remove_clone, self.clone_removal_timeout)
+        if removed:
             self.debugmsg("  Clone removed successfully")
             return
-        for t in range(0,6):
-            self.debugmsg("  Remove clone failed; retrying in 5 seconds")
-            time.sleep(5)
-            if self._remove_clone():
-                self.debugmsg("  Clone removed successfully")
-                return
         self.error("Remove clone failed:  '%s' still has watchers" %
                    self.device)
 
+    @classmethod
+    def find_leaks(cls,collector):
+        '''
+        RBD images named with the clone suffix in all pools; those
+        awaiting the reaper are left to it
+        '''
+        layer = cls('', collector.params, None)
+        pending = layer.reaper.pending
+        leaks = []
+        for (pool, name) in layer.rbd_images():
+            device = '%s/%s' % (pool, name)
+            if not name.endswith(layer.clone_suffix) or \
+                    pending.get(device) is not None:
+                continue
+            ioctx = layer.ceph_pool_objects.ioctx(layer.ceph_conf, pool)
+            try:
+                image = rbd.Image(ioctx, name, read_only=True)
+            except rbd.ImageNotFound:
+                continue
+            try:
+                parents = ['%s/%s@%s' % image.parent_info()]
+            except rbd.ImageNotFound:
+                # no parent
+                parents = []
+            finally:
+                image.close()
+            leaks.append(Leak(layer, device, parents=parents,
+                              snapdb_device=device,
+                              pool=pool, image=name, snap=None))
+        return leaks
+
     @property
     @rbd_method
     def _lockers(self):
@@ -443,16 +869,6 @@ class RBDCloneLayer(CephSnapLayer):
                     "    No RBD snapshot lockers found")
         return res
         
-    # Set up the RBD objects once for all operations in safe_set_up
-    @ceph_method
-    def safe_set_up(self):
-        super(CephSnapLayer,self).safe_set_up()
-
-    # Set up the RBD objects once for all operations in safe_teardown
-    @ceph_method
-    def safe_teardown(self):
-        super(CephSnapLayer,self).safe_teardown()
-        
 
 # Register this layer
 if have_rbd:
@@ -1,7 +1,12 @@
 # Xen VDI snapshots
 
+import time, threading
+from contextlib import contextmanager
+
 from stack import Stack
 from layer_lv import LV
+from layers import memoized_property
+from util import Util
 
 have_xenserver = True
 try:
@@ -9,6 +14,118 @@ try:
 except:
     have_xenserver = False
 
+
+class XenAPISessionPool(object):
+    '''
+    xapi sessions shared by all Xen VDI layers and DLE stacks in the
+    process
+
+    A XenAPI session isn't thread-safe, so each call checks a session
+    out of the pool, logging in another only when all are in use.
+    Sessions stay logged in until Stack.shutdown() logs them out,
+    rather than piling up in xapi until it evicts them; those in use
+    then, like the event watcher's, are logged out when released.  A call failing
+    with SESSION_INVALID, e.g. after xapi restarted, is retried once
+    on a new session.
+    '''
+
+    # shared across instances; sessions by id(), since comparing
+    # XenAPI sessions, which proxy any attribute to xapi, calls xapi
+    objects = { 'sessions' : {},
+                'idle' : [],
+                # sessions to log out when released
+                'logout' : set(),
+                }
+    lock = threading.Lock()
+
+    def __init__(self,util):
+        self.util = util
+
+    def login(self):
+        with self.util.span('xenapi.login'):
+            session = XenAPI.xapi_local()
+            session.xenapi.login_with_password('root', '')
+            #session = XenAPI.Session('http://%s' % self.hostname)
+            #session.xenapi.login_with_password(self.username, self.password)
+        with self.lock:
+            self.objects['sessions'][id(session)] = session
+        self.util.debugmsg("      Logged in to xapi")
+        return session
+
+    @contextmanager
+    def session(self):
+        session = None
+        with self.lock:
+            if self.objects['idle']:
+                session = self.objects['sessions'][self.objects['idle'].pop()]
+        if session is None:
+            session = self.login()
+        try:
+            yield session
+        finally:
+            with self.lock:
+                logout = id(session) in self.objects['logout']
+                if logout:
+                    # the pool was shut down meanwhile
+                    self.objects['logout'].discard(id(session))
+                    self.objects['sessions'].pop(id(session),None)
+                elif id(session) in self.objects['sessions']:
+                    # not if discarded meanwhile
+                    self.objects['idle'].append(id(session))
+            if logout:
+                self.logout(session)
+
+    def discard(self,session):
+        '''
+        Forget a session that xapi no longer knows
+        '''
+        with self.lock:
+            self.objects['sessions'].pop(id(session),None)
+            self.objects['logout'].discard(id(session))
+
+    @staticmethod
+    def session_invalid(e):
+        return isinstance(e, XenAPI.Failure) and \
+            e.details[:1] == ['SESSION_INVALID']
+
+    def call(self,method,*args):
+        '''
+        Call a XenAPI method by name, e.g. 'VDI.get_record'
+        '''
+        for retry in (False, True):
+            with self.session() as session:
+                func = session.xenapi
+                for name in method.split('.'):
+                    func = getattr(func,name)
+                try:
+                    return func(*args)
+                except Exception, e:
+                    if retry or not self.session_invalid(e):
+                        raise
+                    self.util.debugmsg("      xapi session invalid; "
+                                       "logging in again")
+                    self.discard(session)
+
+    def logout(self,session):
+        try:
+            session.xenapi.logout()
+        except Exception, e:
+            self.util.debugmsg("      xapi logout failed:  %s" % e)
+
+    def shutdown(self):
+        '''
+        Log out of the idle sessions; sessions in use, like the event
+        watcher's, are logged out when they're released
+        '''
+        with self.lock:
+            idle = [self.objects['sessions'].pop(i)
+                    for i in self.objects['idle']]
+            del self.objects['idle'][:]
+            self.objects['logout'].update(self.objects['sessions'].keys())
+        for session in idle:
+            self.logout(session)
+
+
 class XenVDISnapLayer(LV):
     '''
     Given a VDI name-label and snapshot name, create a snapshot
@@ -17,6 +134,19 @@ class XenVDISnapLayer(LV):
     '''
 
     name = 'xenvdi'
+    # VDI and SR records by VDI name-label, shared across instances;
+    # entries are dropped on xapi events for their VDI or SR, and at
+    # the end of each run unless the event watcher keeps them current
+    vdi_index = {}
+    vdi_index_lock = threading.Lock()
+    event_watch = { 'thread' : None,
+                    # woken when new VDIs are indexed
+                    'wakeup' : threading.Event(),
+                    'stopping' : threading.Event() }
+    # seconds each event.from call waits for events
+    event_timeout = 30.0
+    # pause before retrying after an event stream error
+    event_retry_interval = 5
 
     def __init__(self,arg_str,params,parent_layer):
 
@@ -26,44 +156,185 @@ class XenVDISnapLayer(LV):
             self.error("Tried to init XenVDISnapLayer, but XenAPI libs "
                        "not available")
 
-        self.init_xenapi_session()
+        self.xenapi = XenAPISessionPool(self)
 
     def print_info(self):
         super(XenVDISnapLayer,self).print_info()
         self.infomsg("    VDI name-label = %s" % self.vdi_name_label)
 
-        
-    def init_xenapi_session(self):
-        self.session = XenAPI.xapi_local()
-        self.session.xenapi.login_with_password('root', '')
-        #self.session = XenAPI.Session('http://%s' % self.hostname)
-        #session.xenapi.login_with_password(self.username, self.password)
 
     @property
     def vdi_name_label(self):
         return self.arg_str
 
+    @classmethod
+    def clear_vdi_index(cls):
+        if cls.event_watch['thread'] is not None:
+            return
+        with cls.vdi_index_lock:
+            cls.vdi_index.clear()
+
+    def index_vdi(self):
+        '''
+        Look up the VDI by name-label and its SR, with one small call
+        each rather than a dump of all of the pool's VDI records
+        '''
+        try:
+            with self.span('xenapi.VDI.get_by_name_label',
+                           vdi=self.vdi_name_label):
+                refs = self.xenapi.call('VDI.get_by_name_label',
+                                        self.vdi_name_label)
+            if not refs:
+                return None
+            vdi = self.xenapi.call('VDI.get_record', refs[0])
+        except Exception, e:
+            self.error("Unable to get VDI '%s':  %s" %
+                       (self.vdi_name_label, e))
+        try:
+            sr = self.xenapi.call('SR.get_record', vdi['SR'])
+        except Exception, e:
+            self.error("Unable to get SR:  %s" % e)
+        return { 'vdi_ref' : refs[0], 'vdi' : vdi, 'sr' : sr }
+
+    @memoized_property
+    def vdi_entry(self):
+        with self.vdi_index_lock:
+            entry = self.vdi_index.get(self.vdi_name_label,None)
+        if entry is None:
+            entry = self.index_vdi()
+            if entry is None:
+                # not indexed; the VDI may be created later
+                return None
+            with self.vdi_index_lock:
+                self.vdi_index[self.vdi_name_label] = entry
+            if self.params.xenapi_events:
+                self.start_event_watch()
+                self.event_watch['wakeup'].set()
+        return entry
+
     @property
     def vdi_record(self):
-        for (key, val) in self.session.xenapi.VDI.get_all_records().items():
-            if val['name_label'] == self.vdi_name_label:
-                return val
-        return None
+        entry = self.vdi_entry
+        return entry and entry['vdi']
 
     @property
     def sr_record(self):
-        try:
-            sr = self.session.xenapi.SR.get_record(self.vdi_record['SR'])
-        except Exception, e:
-            self.error("Unable to get SR:  %s" % e)
-        return sr
+        entry = self.vdi_entry
+        if entry is None:
+            self.error("Unable to get SR:  VDI '%s' not found" %
+                       self.vdi_name_label)
+        return entry['sr']
 
     @property
     def orig_device(self):
         return '/dev/VG_XenStorage-%s/VHD-%s' % ( self.sr_record['uuid'],
                                                   self.vdi_record['uuid'] )
-    
+
+    #
+    # Event stream
+    #
+    @classmethod
+    def watched_classes(cls):
+        '''
+        event.from() subscriptions for the indexed VDIs and their SRs
+        '''
+        with cls.vdi_index_lock:
+            entries = cls.vdi_index.values()
+        classes = set()
+        for entry in entries:
+            classes.add('vdi/%s' % entry['vdi_ref'])
+            classes.add('sr/%s' % entry['vdi']['SR'])
+        return sorted(classes)
+
+    @classmethod
+    def drop_event_ref(cls,event):
+        '''
+        Drop index entries of a VDI or SR changed or destroyed
+        '''
+        with cls.vdi_index_lock:
+            for (label, entry) in cls.vdi_index.items():
+                if (event['class'] == 'vdi' and
+                    entry['vdi_ref'] == event['ref']) or \
+                   (event['class'] == 'sr' and
+                    entry['vdi']['SR'] == event['ref']):
+                    del cls.vdi_index[label]
+
+    def start_event_watch(self):
+        '''
+        Watch the xapi event stream of the indexed VDIs and SRs in a
+        daemon thread, on its own session
+        '''
+        with self.vdi_index_lock:
+            if self.event_watch['thread'] is not None:
+                return
+            thread = threading.Thread(target=self.watch_events,
+                                      name='xenapi-events')
+            thread.daemon = True
+            self.event_watch['thread'] = thread
+            self.event_watch['stopping'].clear()
+        thread.start()
+
+    @classmethod
+    def stop_event_watch(cls):
+        '''
+        Have the event watcher exit once its current event.from()
+        call returns, and wait for that, so it releases its session to
+        be logged out before the process exits
+        '''
+        thread = cls.event_watch['thread']
+        cls.event_watch['stopping'].set()
+        cls.event_watch['wakeup'].set()
+        if thread is not None:
+            thread.join(cls.event_timeout)
+
+    def watch_events(self):
+        # the first call returns the current records; only later
+        # calls report changes
+        token = ''
+        wakeup = self.event_watch['wakeup']
+        stopping = self.event_watch['stopping']
+        try:
+            while not stopping.is_set():
+                wakeup.clear()
+                classes = self.watched_classes()
+                if not classes:
+                    wakeup.wait(self.event_timeout)
+                    continue
+                try:
+                    # event.from() blocks its session; keep it checked
+                    # out of the pool while it waits
+                    with self.xenapi.session() as session:
+                        try:
+                            # 'from' is a Python keyword
+                            result = getattr(session.xenapi.event, 'from')(
+                                classes, token, self.event_timeout)
+                        except Exception, e:
+                            if self.xenapi.session_invalid(e):
+                                self.xenapi.discard(session)
+                            raise
+                        if stopping.is_set():
+                            # shutting down; the pool logs the
+                            # session out on release
+                            break
+                except Exception, e:
+                    self.debugmsg("      xapi event stream failed:  %s" % e)
+                    token = ''
+                    # events may have been missed
+                    with self.vdi_index_lock:
+                        self.vdi_index.clear()
+                    stopping.wait(self.event_retry_interval)
+                    continue
+                if token:
+                    for event in result['events']:
+                        self.drop_event_ref(event)
+                token = result['token']
+        finally:
+            self.event_watch['thread'] = None
+
 
 # Register this layer
 if have_xenserver:
     Stack.register_layer(XenVDISnapLayer)
+    Stack.register_cleanup(XenVDISnapLayer.clear_vdi_index)
+    Stack.register_shutdown(XenVDISnapLayer.stop_event_watch)
+    Stack.register_shutdown(XenAPISessionPool(Util()).shutdown)
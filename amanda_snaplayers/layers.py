@@ -1,11 +1,11 @@
 # Base Layer class and Snapper subclass
 
-import sys, os.path, pickle
+from collections import MutableMapping
 from datetime import datetime, timedelta
-from pprint import pformat
 
 from util import Util
 from params import Params
+from statedb import StateDB
 
 
 # Snapshot parameters
@@ -27,41 +27,64 @@ Params.add_option(
     help=("snapshot suffix"))
 
 
-class Snapdb(dict):
+class Snapdb(MutableMapping):
     '''
-    pickled dict of snapshot creation timestamps persisted to a file
+    dict of snapshot creation timestamps persisted to the state
+    database, one row per snapshot device
     '''
 
     epoch = datetime(1971,01,01)
 
-    def __init__(self,debug=False,state_file=None):
-        self.state_file = state_file
-        self.util = Util()
-        if os.path.exists(self.state_file):
-            try:
-                self.update(pickle.load(open(self.state_file, 'r')))
-            except:
-                self.util.error("Error reading snapshot db '%s': %s" %
-                      (self.state_file, sys.exc_info()[0]))
-        self.util.debugmsg("Read pickled DB: %s" % pformat(self))
-
-    def save(self):
-        try:
-            pickle.dump(self,open(self.state_file, 'w'))
-        except:
-            self.util.error("Error writing snapshot db '%s':\n%s" %
-                            (self.state_file, sys.exc_info()[0]))
+    def __init__(self,params,state_file=None):
+        self.state_file = state_file or params.snaplayers_state_file
+        # errors, e.g. importing an old state file, are reported like
+        # the layers'
+        self.util = Util(debug=params.debug)
+        self.util.params = params
+        self.db = StateDB.open(self.state_file, self.util)
+        self.util.debugmsg("Opened snapshot DB '%s'" % self.state_file)
+
+    def __getitem__(self,device):
+        rows = self.db.execute(
+            'SELECT timestamp FROM snaps WHERE device = ?', (device,))
+        if not rows:
+            raise KeyError(device)
+        if rows[0][0] is None:
+            return {}
+        return { 'timestamp' : rows[0][0] }
+
+    def __setitem__(self,device,val):
+        self.db.execute(
+            'INSERT OR REPLACE INTO snaps (device, timestamp) VALUES (?, ?)',
+            (device, val.get('timestamp',None)))
+
+    def __delitem__(self,device):
+        if device not in self:
+            raise KeyError(device)
+        self.db.execute('DELETE FROM snaps WHERE device = ?', (device,))
+
+    def __contains__(self,device):
+        return bool(self.db.execute(
+            'SELECT 1 FROM snaps WHERE device = ?', (device,)))
+
+    def __iter__(self):
+        return iter([r[0] for r in
+                     self.db.execute('SELECT device FROM snaps')])
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM snaps')[0][0]
+
+    def has_key(self,device):
+        return device in self
 
     def record_snap(self,snap_device):
-        self.setdefault(snap_device,{})['timestamp'] = datetime.now()
-        self.save()
+        self[snap_device] = { 'timestamp' : datetime.now() }
 
     def delete_snap(self,snap_device):
-        self[snap_device] = {}
-        self.save()
+        self.pop(snap_device,None)
 
     def timestamp(self,device,set_default=False):
-        if self.setdefault(device,{}).has_key('timestamp'):
+        if 'timestamp' in self.get(device,{}):
             return self[device]['timestamp']
         else:
             if set_default:
@@ -75,11 +98,32 @@ class Snapdb(dict):
         else:
             return (datetime.now() - timedelta(seconds=stale_seconds)) > \
                    self.timestamp(device,True)
-           
+
+
+def memoized_property(func):
+    '''
+    Decorator for layer properties that are expensive to evaluate,
+    e.g. by running commands or API calls:  the value is remembered
+    for the rest of the current stack phase (see Stack.memo_phase()),
+    until a layer changes system state and calls invalidate_memo()
+    '''
+    def getter(self):
+        memo = self.memo
+        if memo is None:
+            return func(self)
+        key = (self, func.func_name)
+        if key not in memo:
+            memo[key] = func(self)
+        return memo[key]
+    return property(getter, doc=func.__doc__)
+
 
 class Layer(Util):
     params = None
     class_params = {}
+    # property values memoized during a stack phase, shared by all
+    # layers of the stack; None outside of phases
+    memo = None
 
     def __init__(self, arg_str, params, parent_layer):
 
@@ -105,13 +149,34 @@ class Layer(Util):
     def parent_device(self):
         return self.parent.device
 
-    @property
+    @memoized_property
     def is_stale(self):
         if self.parent_device is None:
             self.error("class %s does not implement is_stale method" %
                        self.__class__.__name__)
         return self.parent.is_stale
     
+    @property
+    def span_attrs(self):
+        return { 'layer' : self.name,
+                 'args' : self.arg_str }
+
+    def reset_state(self):
+        '''
+        Forget device state cached in the layer object outside of the
+        memo, e.g. by a check(), so it is looked up again; layers
+        caching such state override this
+        '''
+        pass
+
+    def invalidate_memo(self):
+        '''
+        Forget all memoized property values of the stack; call after
+        changing system state, e.g. creating a snapshot or mounting
+        '''
+        if self.memo is not None:
+            self.memo.clear()
+
     def device_partition(self,part_num):
         '''
         Return the device string for a partition; some layers may
@@ -131,7 +196,8 @@ class SnapLayer(Layer):
     
     name = None
     class_params = {
-        'snapdb' : None,
+        # Snapdb objects by state file
+        'snapdbs' : {},
         }
 
     # inheriting classes must implement at least these methods:
@@ -157,11 +223,12 @@ class SnapLayer(Layer):
 
     @property
     def snapdb(self):
-        if self.class_params['snapdb'] is None:
-            self.class_params['snapdb'] = \
-                Snapdb(debug = self.debug,
-                       state_file = self.params.snaplayers_state_file)
-        return self.class_params['snapdb']
+        state_file = self.params.snaplayers_state_file
+        with self.resource_lock('snapdb'):
+            if state_file not in self.class_params['snapdbs']:
+                self.class_params['snapdbs'][state_file] = \
+                    Snapdb(self.params, state_file)
+        return self.class_params['snapdbs'][state_file]
 
     @property
     def stale_seconds(self):
@@ -171,11 +238,11 @@ class SnapLayer(Layer):
     def size(self):
         return self.params.size
 
-    @property
+    @memoized_property
     def is_stale(self, nodefault=False):
         return self.snapdb.is_expired(self.device, self.stale_seconds)
 
-    @property
+    @memoized_property
     def in_snapdb(self):
         return self.snapdb.is_expired(self.device,
                                       self.stale_seconds,
@@ -194,6 +261,7 @@ class SnapLayer(Layer):
 
         # freshen up the layer
         self.freshen()
+        self.invalidate_memo()
 
         # sanity check:  the original disk should exist
         if not self.orig_exists:
@@ -237,6 +305,7 @@ class SnapLayer(Layer):
         # Create snapshot if it doesn't exist (or was expired)
         if not_exist or not self.snap_exists:
             self.create_snapshot()
+            self.invalidate_memo()
             # Check one last time
             if not self.snap_exists:
                 self.error("Failed to create snapshot; aborting")
@@ -245,6 +314,7 @@ class SnapLayer(Layer):
                               "Snapshot successfully created")
             # Record snapshot
             self.snapdb.record_snap(self.device)
+            self.invalidate_memo()
 
         self.infomsg("Snapshot successfully set up\n")
 
@@ -255,6 +325,7 @@ class SnapLayer(Layer):
 
         # freshen up the layer
         self.freshen()
+        self.invalidate_memo()
 
         # sanity check:  snapshot should exist
         if not self.snap_exists:
@@ -269,6 +340,7 @@ class SnapLayer(Layer):
 
         # Remove snapshot
         self.remove_snapshot()
+        self.invalidate_memo()
 
         # Check one last time
         if self.snap_exists:
@@ -278,4 +350,5 @@ class SnapLayer(Layer):
 
         # Record removal
         self.snapdb.delete_snap(self.device)
+        self.invalidate_memo()
 
@@ -0,0 +1,78 @@
+# Hook entry point, run by script-snaplayers or the snaplayers daemon
+
+from params import Params
+from stack import Stack
+from multi_stack import MultiStack
+from garbage import GarbageCollector
+from util import Util
+
+
+set_up_entry_points = ['pre-dle-amcheck', 'pre-dle-estimate',
+                       'pre-dle-backup', 'pre-host-amcheck',
+                       'pre-host-estimate', 'pre-host-backup']
+tear_down_entry_points = ['post-dle-amcheck', 'post-dle-estimate',
+                          'post-dle-backup', 'post-host-amcheck',
+                          'post-host-estimate', 'post-host-backup']
+
+# the sudo helper lives as long as the process, e.g. the daemon
+Stack.register_shutdown(Util.stop_sudo_helper)
+
+
+def run(argv=None):
+    '''
+    Run one hook invocation for the command line arguments argv
+    (default sys.argv[1:]) and return the exit status; errors exit
+    through Util.error()
+    '''
+
+    # command line option processing
+    params = Params(set_up_entry_points,
+                    tear_down_entry_points,
+                    argv)
+
+    # print debug info
+    if params.debug:
+        params.print_params()
+
+    # pull util object out for easy access
+    util = params.util
+
+    if params.params.snaplayers_trace_file:
+        util.start_trace(params.params.snaplayers_trace_file,
+                         entry_point=params.entry_point,
+                         config=params.config, host=params.host,
+                         disk=params.disk, devices=params.devices)
+
+    Stack.start_run()
+    try:
+        if params.gc_mode:
+            util.infomsg("\nEntry point = gc; garbage collection mode\n")
+            GarbageCollector(params).collect()
+            return 0
+
+        # set up stack object; *-host-* entry points get one stack per DLE
+        if params.host_mode:
+            stack = MultiStack(params)
+        else:
+            stack = Stack(params)
+
+        # setting up
+        if params.set_up_mode:
+            util.infomsg("\nEntry point = %s; set-up mode\n" %
+                         params.entry_point)
+            stack.ensure_set_up()
+
+        elif params.tear_down_mode:
+            util.infomsg("\nEntry point = %s; tear-down mode\n" %
+                         params.entry_point)
+            stack.ensure_torn_down()
+
+        else:
+            util.error("Unable to determine what to do.  Aborting.")
+    finally:
+        # drop caches that only hold for this run, unless other runs
+        # in the process, like the daemon's, are still using them
+        Stack.end_run()
+        util.stop_trace()
+
+    return 0
@@ -0,0 +1,102 @@
+# Layer manifest
+#
+# Maps layer names to the modules defining them, and declares each
+# module's command line options.  Layer modules, and the libraries they
+# need, like libvirt, lxml, rados, rbd and XenAPI, are only imported
+# when a stack uses one of their layers; see Stack.layer_class().
+
+from params import Params
+from stack import Stack
+# the base layer classes are light, and declare the snapshot options
+import layers
+
+
+# LVM snapshots
+Stack.register_layer_module('lv', 'layer_lv')
+
+# Xen VDI snapshots
+Stack.register_layer_module('xenvdi', 'layer_xenvdi')
+
+Params.add_option(
+    "--xenapi_events", "--xenapi-events",
+    type="int", default=0,
+    help=("watch the xapi event stream to keep looked up VDI and SR "
+          "records current across runs instead of looking them up "
+          "again each run; meant for the daemon, since a hook process "
+          "waits up to 30 seconds at exit for the watcher to log out; "
+          "param is 0 or 1"))
+
+# md RAID1 component devices
+Stack.register_layer_module('md', 'layer_md')
+
+# Mounts
+Stack.register_layer_module('part', 'layer_mount_partition')
+Stack.register_layer_module('parts', 'layer_mount_partition')
+
+Params.add_option(
+    "--no_auto_mount", "--no-auto-mount",
+    help=("don't automatically try to automount the final device; "
+          "mount must be specified explicitly"))
+
+# RBD snapshots and clones
+Stack.register_layer_module('rbd_snap', 'layer_rbd')
+Stack.register_layer_module('rbd_clone', 'layer_rbd')
+
+Params.add_option(
+    "--ceph_conf", "--ceph-conf",
+    default="/etc/ceph/ceph.conf",
+    help=("Ceph configuration file"))
+
+Params.add_option(
+    "--rbd_clone_suffix", "--rbd-clone-suffix",
+    default=".amclone",
+    help=("RBD clone image name suffix"))
+# the deferred removals table must be in the state db schema before
+# the first connection to the db
+import pending_removals
+
+# Libvirt volumes attached to the Amanda server VM
+Stack.register_layer_module('libvirt', 'layer_libvirt')
+# its target name reservations table must be in the state db schema
+# before the first connection to the db
+import device_targets
+
+Params.add_option(
+    "--qemu_url", "--qemu-url",
+    default="qemu:///system",
+    help=("qemu URL"))
+
+Params.add_option(
+    "--libvirt_auth_file", "--libvirt-auth-file",
+    default="/var/lib/amanda/libvirt-authfile",
+    help=("Libvirt authentication file"))
+
+Params.add_option(
+    "--libvirt_vm_hostname", "--libvirt-vm-hostname",
+    help=("Amanda server VM name"))
+
+Params.add_option(
+    "--ceph_auth_user", "--ceph-auth-user",
+    default="admin",
+    help=("Ceph user"))
+
+Params.add_option(
+    "--libvirt_secret_uuid", "--libvirt-secret-uuid",
+    help=("Libvirt storage secret UUID"))
+
+Params.add_option(
+    "--disk_device_prefix", "--disk-device-prefix",
+    default='/dev/vd',
+    help=("Attached disk device filename prefix; default '/dev/vd'"))
+
+Params.add_option(
+    "--libvirt_attach_timeout", "--libvirt-attach-timeout",
+    type="int", default=30,
+    help=("Maximum time to wait for a libvirt volume to be attached "
+          "to the backup VM"))
+
+Params.add_option(
+    "--libvirt_events", "--libvirt-events",
+    type="int", default=0,
+    help=("watch libvirt device events to keep the backup VM's disk "
+          "list current instead of re-reading its XML; param is 0 or 1"))
@@ -0,0 +1,150 @@
+# Process-wide mount table
+
+import re, os.path, select, threading
+
+
+class MountTable(object):
+    '''
+    Index of mounted filesystems, parsed from /proc/self/mountinfo
+
+    The index is shared by all instances in the process.  The kernel
+    flags mountinfo with POLLPRI/POLLERR whenever the mount namespace
+    changes, so the file is only re-read after a mount or umount
+    rather than on every lookup, and only the lines added or removed
+    since the last read are applied to the index.
+    '''
+
+    mountinfo = '/proc/self/mountinfo'
+    unescape_re = re.compile(r'\\([0-7]{3})')
+
+    # parameters shared across instances
+    state = { 'file' : None,
+              'poll' : None,
+              # mountinfo line -> (mount_dev, mount_point)
+              'lines' : {},
+              # mount_dev -> [mount_point]
+              'mount_dev' : {},
+              # mount_point -> [mount_dev], later mounts covering
+              # earlier ones
+              'mount_point' : {},
+              # path -> os.path.realpath(path)
+              'real_paths' : {},
+              'lock' : threading.Lock(),
+              }
+
+    def __init__(self,util):
+        self.util = util
+
+    def _open(self):
+        self.state['file'] = open(self.mountinfo,'r')
+        self.state['poll'] = select.poll()
+        self.state['poll'].register(self.state['file'],
+                                    select.POLLPRI | select.POLLERR)
+
+    @property
+    def changed(self):
+        '''
+        True if the mount namespace changed since the last check
+        '''
+        return bool(self.state['poll'].poll(0))
+
+    def _unescape(self,field):
+        # mountinfo octal-escapes spaces, tabs, newlines and backslashes
+        return self.unescape_re.sub(lambda m: chr(int(m.group(1),8)), field)
+
+    def _parse_line(self,line):
+        fields = line.split()
+        # the optional fields end with a lone '-', followed by the
+        # fs type and mount source
+        try:
+            sep = fields.index('-',6)
+            return (self._unescape(fields[sep+2]),
+                    self._unescape(fields[4]))
+        except (ValueError, IndexError):
+            return None
+
+    def _add(self,line):
+        mount = self._parse_line(line)
+        self.state['lines'][line] = mount
+        if mount is None:
+            return
+        (dev, point) = mount
+        self.state['mount_dev'].setdefault(dev,[]).append(point)
+        self.state['mount_point'].setdefault(point,[]).append(dev)
+
+    def _remove(self,line):
+        mount = self.state['lines'].pop(line)
+        if mount is None:
+            return
+        (dev, point) = mount
+        for (index, key, val) in (('mount_dev', dev, point),
+                                  ('mount_point', point, dev)):
+            vals = self.state[index][key]
+            vals.remove(val)
+            if not vals:
+                del self.state[index][key]
+
+    def _update(self,text):
+        # lines start with the mount ID, so each mount's line is
+        # unique and unchanged for as long as it stays mounted
+        lines = text.splitlines()
+        current = set(lines)
+        for line in [l for l in self.state['lines'] if l not in current]:
+            self._remove(line)
+        for line in lines:
+            if line not in self.state['lines']:
+                self._add(line)
+
+    def refresh(self,force=False):
+        with self.state['lock']:
+            try:
+                if self.state['file'] is None:
+                    self._open()
+                    self.state['lines'].clear()
+                    self.state['mount_dev'].clear()
+                    self.state['mount_point'].clear()
+                elif not force and not self.changed:
+                    return
+                self.state['file'].seek(0)
+                self._update(self.state['file'].read())
+            except (IOError, select.error), e:
+                self.util.error("Unable to read %s:  %s" %
+                                (self.mountinfo, e))
+
+    def realpath(self,path):
+        '''
+        os.path.realpath(path), resolved once per process; call
+        forget_realpath() after creating or removing the path
+        '''
+        real = self.state['real_paths'].get(path,None)
+        if real is None:
+            real = os.path.realpath(path)
+            self.state['real_paths'][path] = real
+        return real
+
+    def forget_realpath(self,path):
+        self.state['real_paths'].pop(path,None)
+
+    def mount_point_to_mount_dev(self,mount_point):
+        self.refresh()
+        devs = self.state['mount_point'].get(mount_point,None)
+        return devs and devs[-1] or None
+
+    def mount_dev_to_mount_points(self,mount_dev):
+        self.refresh()
+        return list(self.state['mount_dev'].get(mount_dev,[]))
+
+    def mount_dev_to_mount_point(self,mount_dev):
+        points = self.mount_dev_to_mount_points(mount_dev)
+        if points:
+            return points[0]
+        else:
+            return None
+
+    def mounts(self):
+        '''
+        List of (mount_dev, mount_point) pairs
+        '''
+        self.refresh()
+        return [(devs[-1], point)
+                for (point, devs) in self.state['mount_point'].items()]
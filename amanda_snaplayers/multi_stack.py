@@ -0,0 +1,177 @@
+# The MultiStack class:  set up and tear down many DLEs concurrently
+
+import traceback
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from util import Util
+from stack import Stack
+from plan import StackPlan
+
+
+class MultiStack(Util):
+    '''
+    One Stack per DLE device, checked, set up and torn down
+    concurrently in a bounded pool of worker threads
+
+    Set-up and tear-down run through a StackPlan, so layers that
+    several DLEs' stacks have in common are set up and torn down
+    once.  Layers serialize their own races for shared resources, like
+    md and attached disk device names, with Util.resource_lock().
+    '''
+
+    def __init__(self,params):
+        super(MultiStack, self).__init__(debug=params.debug)
+
+        self.params = params
+
+        # build one stack per DLE
+        self.stacks = [Stack(params.for_device(device))
+                       for device in params.devices]
+
+    @property
+    def max_workers(self):
+        return max(1, min(self.params.max_workers, len(self.stacks)))
+
+    def run_stack_method(self,stack,method):
+        '''
+        Run a method on one stack, returning True on success
+
+        Util.error() exits; in a worker thread, catch that here so the
+        other stacks carry on and the failure can be reported at the end.
+        Other exceptions, e.g. from librbd, fail just this stack too.
+        '''
+        try:
+            getattr(stack,method)()
+        except SystemExit, e:
+            return e.code in (None, 0)
+        except Exception, e:
+            stack.infomsg("%s of %s failed:  %s: %s" %
+                          (method, stack.params.device,
+                           e.__class__.__name__, e))
+            stack.debugmsg(traceback.format_exc())
+            return False
+        return True
+
+    def map_stacks(self,method,stacks):
+        '''
+        Run a method on each of the stacks in the worker pool; return
+        a list of True or False for each stack's success
+        '''
+        if not stacks:
+            return []
+        # workers log to the same place as this thread
+        context = self.thread_context()
+        def run_stack(stack):
+            self.set_thread_context(context)
+            return self.run_stack_method(stack,method)
+
+        pool = ThreadPool(self.max_workers)
+        try:
+            return pool.map(run_stack, stacks)
+        finally:
+            pool.close()
+            pool.join()
+
+    def failed_stacks(self,stacks,results):
+        return [stack for (stack,res) in zip(stacks,results) if not res]
+
+    def report_failures(self,method,failed):
+        if failed:
+            self.error("%s failed for %d of %d DLEs:\n  %s" %
+                       (method, len(failed), len(self.stacks),
+                        '\n  '.join([s.params.device for s in failed])))
+
+    def run_all(self,method):
+        self.report_failures(method, self.failed_stacks(
+                self.stacks, self.map_stacks(method, self.stacks)))
+
+    @contextmanager
+    def stack_locks(self):
+        '''
+        With --reuse-snapshots, hold all stacks' resource locks, in
+        device order so concurrent hooks can't deadlock
+        '''
+        locks = []
+        if self.params.reuse_snapshots == 1:
+            locks = [self.resource_lock(('stack', device))
+                     for device in sorted(set(self.params.devices))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def check(self):
+        self.run_all('check')
+
+    def ensure_set_up(self):
+        '''
+        Set up the stacks through StackPlans, so layers that stacks
+        share are set up once:  stale or partially set up stacks are
+        first torn down in one plan, then set up in another along with
+        the torn down stacks
+        '''
+        self.infomsg("Setting up %d DLE stacks with %d workers\n" %
+                     (len(self.stacks), self.max_workers))
+        failed = self.failed_stacks(
+            self.stacks, self.map_stacks('check', self.stacks))
+        checked = [stack for stack in self.stacks if stack not in failed]
+        recreate = [stack for stack in checked if stack.needs_tear_down]
+        if recreate:
+            self.infomsg("Tearing down %d stale or partially set up DLE "
+                         "stacks\n" % len(recreate))
+            # layers shared with stacks that are set up, or failed the
+            # check, stay
+            plan = StackPlan(self.params, self.stacks, self.max_workers)
+            failed += self.failed_stacks(self.stacks,
+                                         plan.tear_down(recreate))
+            if self.params.reuse_snapshots == 1:
+                for stack in recreate:
+                    if stack not in failed:
+                        stack.stack_refs.delete(stack.params.device)
+
+        ready = [stack for stack in checked if stack not in failed and
+                 (stack in recreate or stack.top_set_up_layer is None)]
+        if ready:
+            plan = StackPlan(self.params, ready, self.max_workers)
+            for (stack,res) in zip(ready,plan.set_up()):
+                stack.planned = res
+            # stacks the plan failed aren't retried one by one, racing
+            # each other for their shared layers
+            failed += [stack for stack in ready if not stack.planned]
+
+        # nothing left to set up; just count the stacks' users
+        for stack in checked:
+            if stack not in failed and \
+                    not self.run_stack_method(stack,'ensure_set_up'):
+                failed.append(stack)
+        self.report_failures('ensure_set_up', failed)
+        self.infomsg("Successfully set up all DLE stacks")
+
+    def ensure_torn_down(self):
+        '''
+        Tear down all stacks in one StackPlan, so layers that stacks
+        share are torn down once, after all layers on them; with
+        --reuse-snapshots, layers of stacks kept set up stay
+        '''
+        self.infomsg("Tearing down %d DLE stacks with %d workers\n" %
+                     (len(self.stacks), self.max_workers))
+        with self.stack_locks():
+            # stacks failing the check, like those kept set up, keep
+            # the layers they share with others
+            failed = self.failed_stacks(
+                self.stacks, self.map_stacks('check_tear_down', self.stacks))
+            checked = [stack for stack in self.stacks
+                       if stack not in failed and not stack.kept]
+            plan = StackPlan(self.params, self.stacks, self.max_workers)
+            failed += self.failed_stacks(self.stacks,
+                                         plan.tear_down(checked))
+            if self.params.reuse_snapshots == 1:
+                for stack in checked:
+                    if stack not in failed:
+                        stack.stack_refs.delete(stack.params.device)
+        self.report_failures('ensure_torn_down', failed)
+        self.infomsg("Successfully tore down all DLE stacks\n")
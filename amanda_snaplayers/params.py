@@ -1,5 +1,6 @@
 # CLI parameters
 
+import sys, copy, threading
 from optparse import OptionParser
 from time import localtime, strftime
 from util import Util
@@ -8,18 +9,39 @@ from util import Util
 LOG_FILE_PAT = '/var/log/amanda/amandad/lvsnap.' \
     '%(timestamp)s.%(disk)s.%(entry_point)s.debug'
 
+# Default snaplayers daemon socket; script-snaplayers has a copy
+DAEMON_SOCKET = '/var/lib/amanda/snaplayers.sock'
+
+
+class ParamsOptionParser(OptionParser):
+    '''
+    OptionParser printing help and errors to the output streams of the
+    current daemon request, if any
+    '''
+
+    def print_help(self, file=None):
+        OptionParser.print_help(self, file or Util().stdout)
+
+    def error(self, msg):
+        stderr = Util().stderr
+        self.print_usage(stderr)
+        stderr.write("%s: error: %s\n" % (self.get_prog_name(), msg))
+        sys.exit(2)
+
 
 class Params(object):
 
     required_params = ['mount_base', 'device']
     optional_params = ['debug', 'log_to_stdout', 'config', 'host', 'disk',
-                       'layer_param_field_sep', 'level', 'execute_where']
+                       'layer_param_field_sep', 'level', 'execute_where',
+                       'devices', 'max_workers', 'command_timeout',
+                       'sudo_helper']
     interesting_params = ['device', 'disk', 'mount_base',
                           'debug', 'log_to_stdout',
                           'layer_param_field_sep']
 
     # Make this a class property so other modules can add options
-    options = OptionParser(
+    options = ParamsOptionParser(
         usage="usage:  %prog [execute-on]+ [options]",
         description="Amanda backup script plugin for backing up " \
             "volume snapshots",
@@ -27,6 +49,9 @@ class Params(object):
             "https://github.com/zultron/amanda-snapshot-layers " \
             "for more information"
         )
+    core_options_added = False
+    # OptionParser.parse_args() isn't thread-safe
+    parse_lock = threading.Lock()
 
     @property
     def all_params(self):
@@ -57,10 +82,14 @@ class Params(object):
 
     def __init__(self,
                  set_up_entry_points,
-                 tear_down_entry_points):
+                 tear_down_entry_points,
+                 argv=None):
 
         self.set_up_entry_points = set_up_entry_points
         self.tear_down_entry_points = tear_down_entry_points
+        # command line arguments, without the program name; default
+        # sys.argv[1:]
+        self.argv = argv
 
         # basic command line option parsing and sanity checks
         self.parse_options()
@@ -73,50 +102,86 @@ class Params(object):
                          log_to_stdout = self.log_to_stdout)
 
 
-    def parse_options(self):
+    @classmethod
+    def add_core_options(cls):
+        # only once; the option parser is shared by all instances
+        if cls.core_options_added:
+            return
+        cls.core_options_added = True
+
         # custom properties
-        self.options.add_option(
+        cls.options.add_option(
             "--mount_base", "--mount-base",
             help=("base directory to mount snapshot"))
-        self.options.add_option(
+        cls.options.add_option(
             "--debug", type="int",
             help=("Print debug output; param is 0 or 1"))
-        self.options.add_option(
+        cls.options.add_option(
             "--log_to_stdout", "--log-to-stdout",
             action="store_true", default=False,
             help=("output to stdout for debugging"))
-        self.options.add_option(
+        cls.options.add_option(
             "--layer_param_field_sep", "--layer-param-field-sep",
             default=',=+',
             help=("separator charactors for layers, params and fields "
                   "(default ',=+')"))
-        self.options.add_option(
+        cls.options.add_option(
             "--snaplayers_log_pattern", "--snaplayers-log-pattern",
             default=LOG_FILE_PAT,
             help=("snapshot log file pattern; default: %s" % LOG_FILE_PAT))
+        cls.options.add_option(
+            "--max_workers", "--max-workers", type="int", default=8,
+            help=("maximum number of DLE stacks set up or torn down "
+                  "concurrently in *-host-* entry points; default 8"))
+        cls.options.add_option(
+            "--command_timeout", "--command-timeout", type="int", default=0,
+            help=("kill commands like lvremove or mdadm running longer "
+                  "than this many seconds; default 0, no timeout"))
+        cls.options.add_option(
+            "--sudo_helper", "--sudo-helper",
+            help=("path of snaplayers-sudo-helper, started once with "
+                  "'sudo -n' to run root commands instead of running "
+                  "'sudo -n' for each; default none"))
+        cls.options.add_option(
+            "--snaplayers_socket", "--snaplayers-socket",
+            default=DAEMON_SOCKET,
+            help=("snaplayers daemon socket; hooks run in-process when "
+                  "no daemon is listening; default: %s" % DAEMON_SOCKET))
+        cls.options.add_option(
+            "--snaplayers_trace_file", "--snaplayers-trace-file",
+            help=("append timing spans of each run to this JSON-lines "
+                  "file; see snaplayers-trace-summary"))
 
         # standard properties
-        self.options.add_option(
-            "--device",
+        cls.options.add_option(
+            "--device", action="append", dest="devices",
             help=("mount directory with embedded device layering scheme: "
-                  "<mount_base>/(lvm=<vg+lv>|raid1|part=<part#>)[,<...>]/"))
-        self.options.add_option(
+                  "<mount_base>/(lvm=<vg+lv>|raid1|part=<part#>)[,<...>]/; "
+                  "*-host-* entry points accept this once per DLE"))
+        cls.options.add_option(
             "--config",
             help="amanda configuration")
-        self.options.add_option(
+        cls.options.add_option(
             "--host",
             help="client host")
-        self.options.add_option(
+        cls.options.add_option(
             "--disk",
             help="disk to back up")
-        self.options.add_option(
+        cls.options.add_option(
             "--level", type="int",
             help="dump level")
-        self.options.add_option(
+        cls.options.add_option(
             "--execute_where", "--execute-where",
             help="where this script is executed")
 
-        (self.params, self.args) = self.options.parse_args()
+    def parse_options(self):
+        self.add_core_options()
+        with self.parse_lock:
+            (self.params, self.args) = self.options.parse_args(self.argv)
+
+        # a single DLE's device is the last one given; *-host-* entry
+        # points use the whole list
+        self.params.device = (self.params.devices or [None])[-1]
 
         # link params into this object for convenience
         for p in self.all_params:
@@ -133,19 +198,36 @@ class Params(object):
 
     def check_required_params(self):
         for param in self.required_params:
+            if param == 'device' and self.gc_mode:
+                # gc looks for leftovers of all DLEs
+                continue
             if not getattr(self.params, param):
                 self.options.error("Required parameter '%s' missing" % param)
 
     def check_device_param(self):
-        if not self.device.startswith(
-            self.params.mount_base + "/"):
-            self.options.error("device path must begin with "
-                               "the base mount directory")
+        for device in self.devices or []:
+            if not device.startswith(
+                self.params.mount_base + "/"):
+                self.options.error("device path must begin with "
+                                   "the base mount directory")
+
+    def for_device(self,device):
+        '''
+        Return a copy of these params for a single DLE device, as used
+        by the *-host-* entry points to build one stack per DLE
+        '''
+        dle_params = copy.copy(self)
+        dle_params.params = copy.copy(self.params)
+        dle_params.params.device = dle_params.device = device
+        dle_params.params.devices = dle_params.devices = [device]
+        return dle_params
 
     def print_params(self):
         self.util.infomsg("\nCommand line argument parsing results:")
         for p in self.interesting_params:
             self.util.infomsg(" %25s: %s" % (p, getattr(self,p,None)))
+        if self.params.device is None:
+            return
         self.util.infomsg("\nScheme:")
         for layer in self.scheme:
             if len(layer) == 2:
@@ -198,6 +280,16 @@ class Params(object):
     def pre_post(self):
         return self.entry_point_split[1]
 
+    @property
+    def gc_mode(self):
+        # 'gc', run by hand or from cron to remove stale leftovers
+        return self.entry_point == 'gc'
+
+    @property
+    def host_mode(self):
+        # e.g. 'pre-host-backup', run once for all of a host's DLEs
+        return self.entry_point_split[1] == 'host'
+
     @property
     def logfile(self):
         return self.params.snaplayers_log_pattern % \
@@ -0,0 +1,77 @@
+# RBD clones and snapshots waiting to be removed by the reaper
+
+from params import Params
+from statedb import StateDB
+
+
+Params.add_option(
+    "--defer_removal", "--defer-removal", type="int", default=0,
+    help=("when watchers keep an RBD clone from being removed, leave "
+          "it to a background reaper instead of waiting in the "
+          "post-dle hook; param is 0 or 1"))
+
+StateDB.schema['pending_removals'] = (
+    'CREATE TABLE IF NOT EXISTS pending_removals ('
+    'device TEXT PRIMARY KEY, '
+    'ceph_conf TEXT, '
+    'pool TEXT, '
+    'image TEXT, '
+    'snap TEXT, '
+    'first_busy REAL, '
+    'not_before REAL, '
+    'attempts INTEGER)')
+
+
+class PendingRemovals(object):
+    '''
+    RBD clones and snapshots whose removal was deferred, kept in the
+    state database until the reaper removes them
+
+    'device' is the clone, 'pool/image', or the snapshot,
+    'pool/image@snap'; 'snap' is None for clones.  'first_busy' is
+    when removal first failed, and 'not_before' when to try next.
+    '''
+
+    columns = ('device', 'ceph_conf', 'pool', 'image', 'snap',
+               'first_busy', 'not_before', 'attempts')
+
+    def __init__(self,state_db):
+        self.db = state_db
+
+    def select(self,where='',args=()):
+        rows = self.db.execute(
+            'SELECT %s FROM pending_removals %s ORDER BY not_before' %
+            (', '.join(self.columns), where), args)
+        return [dict(zip(self.columns,row)) for row in rows]
+
+    def add(self,device,ceph_conf,pool,image,snap,first_busy,not_before):
+        self.db.execute(
+            'INSERT OR REPLACE INTO pending_removals (%s) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, 0)' % ', '.join(self.columns),
+            (device, ceph_conf, pool, image, snap, first_busy, not_before))
+
+    def get(self,device):
+        rows = self.select('WHERE device = ?', (device,))
+        if rows:
+            return rows[0]
+        return None
+
+    def of_image(self,ceph_conf,pool,image):
+        '''
+        Pending removals of an image and its snapshots
+        '''
+        return self.select('WHERE ceph_conf = ? AND pool = ? AND image = ?',
+                           (ceph_conf, pool, image))
+
+    def all(self):
+        return self.select()
+
+    def reschedule(self,device,not_before):
+        self.db.execute(
+            'UPDATE pending_removals SET not_before = ?, '
+            'attempts = attempts + 1 WHERE device = ?',
+            (not_before, device))
+
+    def delete(self,device):
+        self.db.execute('DELETE FROM pending_removals WHERE device = ?',
+                        (device,))
@@ -0,0 +1,216 @@
+# The StackPlan class:  the layers of many stacks as one DAG
+
+import Queue, traceback
+from multiprocessing.pool import ThreadPool
+
+from util import Util
+from tracing import traced
+
+
+class PlanNode(object):
+    '''
+    One layer shared by all stacks whose schemes agree up to and
+    including it, e.g. the RBD snapshot under the partitions of one
+    VM image mounted as several DLEs
+
+    'layer' is the layer object of 'stack', the first of those
+    stacks; the others' equivalent layer objects are left alone, but
+    for resetting their state before set-up, see StackPlan.set_up().
+    '''
+
+    def __init__(self,key,stack,layer,parent):
+        self.key = key
+        self.stack = stack
+        self.layer = layer
+        self.parent = parent
+        self.children = []
+        # all stacks containing this node
+        self.stacks = []
+
+    @property
+    def descr(self):
+        return ','.join(['='.join([n for n in k if n]) for k in self.key])
+
+
+class StackPlan(Util):
+    '''
+    The layers of a host's DLE stacks compiled into one DAG, in which
+    a layer that several stacks have in common, with the same layers
+    under it, is a single node
+
+    Each node is set up once, after its parent; nodes in independent
+    branches run concurrently in a bounded pool of worker threads.
+    Tear-down runs in reverse:  a node is torn down once all of its
+    children are.  When a node fails, the nodes depending on it are
+    skipped, and all stacks containing any of them fail.
+    '''
+
+    def __init__(self,params,stacks,max_workers):
+        super(StackPlan, self).__init__(debug=params.debug)
+
+        self.params = params
+        self.stacks = stacks
+        self.max_workers = max_workers
+
+        # nodes in topological order, parents before children
+        self.nodes = []
+        # stack -> its nodes, bottom up
+        self.stack_nodes = {}
+        by_key = {}
+        for stack in stacks:
+            (key, parent) = ((), None)
+            self.stack_nodes[stack] = []
+            for layer in stack.layers:
+                key += ((layer.name, layer.arg_str),)
+                node = by_key.get(key,None)
+                if node is None:
+                    node = PlanNode(key, stack, layer, parent)
+                    by_key[key] = node
+                    self.nodes.append(node)
+                    if parent is not None:
+                        parent.children.append(node)
+                node.stacks.append(stack)
+                self.stack_nodes[stack].append(node)
+                parent = node
+
+    @property
+    def span_attrs(self):
+        return { 'stacks' : len(self.stacks),
+                 'nodes' : len(self.nodes) }
+
+    def run_node(self,node,method):
+        '''
+        Set up or tear down one node, in a stack phase of its stack;
+        return True on success
+
+        Nodes running at the same time are never on the same stack,
+        so they don't share layer objects or memos.
+        '''
+        layer = node.layer
+        try:
+            with node.stack.memo_phase():
+                with layer.span('layer.%s' % method, **layer.span_attrs):
+                    if method == 'set_up':
+                        layer.safe_set_up()
+                    else:
+                        layer.safe_teardown()
+        except SystemExit, e:
+            return e.code in (None, 0)
+        except Exception, e:
+            # e.g. from librbd; fail the node like an error
+            layer.infomsg("%s of '%s' failed:  %s: %s" %
+                          (method, node.descr, e.__class__.__name__, e))
+            layer.debugmsg(traceback.format_exc())
+            return False
+        return True
+
+    def run_nodes(self,nodes,method,waits_for):
+        '''
+        Run a method on nodes, each once the nodes waits_for(node)
+        returns have succeeded; return the set of failed nodes,
+        including those skipped
+        '''
+        nodes = set(nodes)
+        waiting = dict([(node, set(waits_for(node)) & nodes)
+                        for node in nodes])
+        failed = set()
+        done = Queue.Queue()
+
+        # workers log to the same place as this thread
+        context = self.thread_context()
+        def run(node):
+            self.set_thread_context(context)
+            return (node, self.run_node(node,method))
+
+        pool = ThreadPool(max(1, min(self.max_workers, len(nodes))))
+        try:
+            running = 0
+            while waiting or running:
+                ready = [n for (n, deps) in waiting.items() if not deps]
+                for node in ready:
+                    del waiting[node]
+                    pool.apply_async(run, (node,), callback=done.put)
+                    running += 1
+                if not running:
+                    # left waiting on failed nodes
+                    for node in waiting:
+                        self.infomsg("Skipping %s of '%s'; a layer it "
+                                     "depends on failed" %
+                                     (method, node.descr))
+                    failed.update(waiting)
+                    break
+                (node, ok) = done.get()
+                running -= 1
+                if not ok:
+                    failed.add(node)
+                    continue
+                for deps in waiting.values():
+                    deps.discard(node)
+        finally:
+            pool.close()
+            pool.join()
+        return failed
+
+    def batch_set_up(self):
+        '''
+        Let layer classes with a batch_set_up() class method set up
+        their nodes in one pass, e.g. to snapshot all of the host's RBD
+        images at once; set_up() then sets up all nodes in turn
+        '''
+        batches = {}
+        for node in self.nodes:
+            if hasattr(node.layer.__class__, 'batch_set_up'):
+                batches.setdefault(node.layer.__class__,[]).append(
+                    node.layer)
+        for (layer_class, layers) in batches.items():
+            self.infomsg("Setting up %d '%s' layers in one batch\n" %
+                         (len(layers), layer_class.name))
+            layer_class.batch_set_up(layers, self.max_workers)
+
+    def stack_results(self,failed):
+        return [not failed.intersection(self.stack_nodes[stack])
+                for stack in self.stacks]
+
+    @traced('plan.set_up')
+    def set_up(self):
+        '''
+        Set up all nodes of the stacks; nodes already set up, e.g.
+        shared with a stack kept set up, are checked by their layers'
+        set-up.  Return a list of True or False for each stack's
+        success
+        '''
+        self.infomsg("Setting up %d layers of %d DLE stacks\n" %
+                     (len(self.nodes), len(self.stacks)))
+        # a shared node sets up only its first stack's layer object;
+        # the other stacks' layers on it must not use state cached by
+        # their check(), like an md device that wasn't running yet
+        for stack in self.stacks:
+            for layer in stack.layers:
+                layer.reset_state()
+        self.batch_set_up()
+        failed = self.run_nodes(self.nodes, 'set_up',
+                                lambda node: [node.parent])
+        return self.stack_results(failed)
+
+    @traced('plan.tear_down')
+    def tear_down(self,stacks):
+        '''
+        Tear down the set up layers of the checked stacks, except for
+        nodes that other stacks of the plan contain; return a list of
+        True or False for each stack's success, True for the others
+        '''
+        nodes = set()
+        for stack in stacks:
+            if stack.top_set_up_layer is None:
+                continue
+            top = stack.layers.index(stack.top_set_up_layer)
+            nodes.update(self.stack_nodes[stack][:top+1])
+        kept = [stack for stack in self.stacks if stack not in stacks]
+        for stack in kept:
+            nodes.difference_update(self.stack_nodes[stack])
+
+        self.infomsg("Tearing down %d layers of %d DLE stacks\n" %
+                     (len(nodes), len(stacks)))
+        failed = self.run_nodes(nodes, 'tear_down',
+                                lambda node: node.children)
+        return self.stack_results(failed)
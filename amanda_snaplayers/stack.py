@@ -1,18 +1,113 @@
 # The Stack class
 
+import threading
+from importlib import import_module
+from contextlib import contextmanager
+
 from util import Util
+from tracing import traced
+from statedb import StateDB
+from stack_refs import StackRefs
+
+def stack_phase(func):
+    '''
+    Decorator for Stack methods running one phase, like a check(), in
+    which the layers memoize their expensive properties
+    '''
+    def wrapper(self,*args,**kwargs):
+        with self.memo_phase():
+            return func(self,*args,**kwargs)
+    wrapper.func_name = func.func_name
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
 
 class Stack(Util):
 
     dispatch_hash = {}
+    # layer name -> module registering it, imported on first use
+    layer_modules = {}
+    layer_modules_lock = threading.RLock()
+    cleanup_hooks = []
+    shutdown_hooks = []
+    # hook runs in progress in the process, e.g. the daemon's requests
+    active_runs = { 'count' : 0 }
+    active_runs_lock = threading.Lock()
 
     @classmethod
     def register_layer(my_class,layer_class):
         my_class.dispatch_hash[layer_class.name] = layer_class
 
+    @classmethod
+    def register_layer_module(my_class,name,module):
+        my_class.layer_modules[name] = module
+
+    @classmethod
+    def layer_class(my_class,name):
+        '''
+        Look up a layer class by name, importing the module that
+        registers it if needed; None if there's no such layer
+        '''
+        with my_class.layer_modules_lock:
+            if name not in my_class.dispatch_hash and \
+                    name in my_class.layer_modules:
+                # e.g. 'amanda_snaplayers.layer_lv'
+                package = __name__.rpartition('.')[0]
+                module = my_class.layer_modules[name]
+                import_module(package and '%s.%s' % (package, module)
+                              or module)
+        return my_class.dispatch_hash.get(name,None)
+
+    @classmethod
+    def register_cleanup(my_class,func):
+        '''
+        Register a function to drop per-run caches and resources at
+        the end of each hook run; run by cleanup()
+        '''
+        my_class.cleanup_hooks.append(func)
+
+    @classmethod
+    def register_shutdown(my_class,func):
+        '''
+        Register a function to release resources kept open across
+        runs, like cluster connections; run by shutdown()
+        '''
+        my_class.shutdown_hooks.append(func)
+
+    @classmethod
+    def cleanup(my_class):
+        for func in my_class.cleanup_hooks:
+            func()
+
+    @classmethod
+    def start_run(my_class):
+        '''
+        Count a hook run starting; pair with end_run()
+        '''
+        with my_class.active_runs_lock:
+            my_class.active_runs['count'] += 1
+
+    @classmethod
+    def end_run(my_class):
+        '''
+        Count a hook run ending, and run cleanup() once no other run
+        in the process still uses the caches it drops
+        '''
+        with my_class.active_runs_lock:
+            my_class.active_runs['count'] -= 1
+            if my_class.active_runs['count'] == 0:
+                # runs starting meanwhile wait for the lock
+                my_class.cleanup()
+
+    @classmethod
+    def shutdown(my_class):
+        my_class.cleanup()
+        for func in my_class.shutdown_hooks:
+            func()
+
     def insert_layer(self,name,args):
         # Look up layer class
-        layer_class = self.dispatch_hash.get(name,None)
+        layer_class = self.layer_class(name)
         if layer_class is None:
             self.error("Unrecognized layer name '%s'" % name)
 
@@ -50,6 +145,13 @@ class Stack(Util):
         # after a check(), this will be the top layer found to be set up
         self.top_set_up_layer = None
 
+        # True once a StackPlan set up this stack along with other
+        # stacks sharing its layers
+        self.planned = False
+
+        # after a release(), True if the stack is to be kept set up
+        self.kept = False
+
         # build layer stack
         self.layers = []
         for layer in params.scheme:
@@ -63,6 +165,30 @@ class Stack(Util):
             self.layers[-1].print_info()
             self.infomsg('')
 
+    @property
+    def span_attrs(self):
+        return { 'device' : self.params.device }
+
+    @contextmanager
+    def memo_phase(self):
+        '''
+        Give the layers one shared memo of property values for the
+        enclosed phase; nested phases share the outer memo
+        '''
+        if self.layers[0].memo is not None:
+            yield
+            return
+        memo = {}
+        for layer in self.layers:
+            layer.memo = memo
+        try:
+            yield
+        finally:
+            for layer in self.layers:
+                layer.memo = None
+
+    @traced('stack.check')
+    @stack_phase
     def check(self):
         self.is_stale = False
         self.is_setup = True
@@ -92,6 +218,8 @@ class Stack(Util):
             self.check()
         return self.top_set_up_layer is None
 
+    @traced('stack.tear_down')
+    @stack_phase
     def tear_down(self):
         if self.is_setup is None:
             self.error("Stack tear_down() method called before "
@@ -99,14 +227,171 @@ class Stack(Util):
         while self.top_set_up_layer is not None:
             layer = self.top_set_up_layer
             self.top_set_up_layer = layer.parent
-            layer.safe_teardown()
+            with layer.span('layer.tear_down',**layer.span_attrs):
+                layer.safe_teardown()
 
+    @traced('stack.set_up')
+    @stack_phase
     def set_up(self):
         if self.is_setup is None:
             self.error("Stack set_up() method called before "
                        "check(); aborting")
         for layer in self.layers:
-            layer.safe_set_up()
+            with layer.span('layer.set_up',**layer.span_attrs):
+                layer.safe_set_up()
+
+    @property
+    def reuse_snapshots(self):
+        return self.params.reuse_snapshots == 1
+
+    @property
+    def stack_refs(self):
+        state_db = StateDB.open(self.params.snaplayers_state_file, self)
+        return StackRefs(state_db)
+
+    @property
+    def run_key(self):
+        return (self.params.config or '', self.params.timestamp or '')
+
+    @traced('stack.ensure_set_up')
+    def ensure_set_up(self):
+        '''
+        Check the stack and set it up, first tearing down any partially
+        set up or stale stack
+
+        With --reuse-snapshots, a stack already set up earlier in the
+        same run is kept, and counted as in use by this hook
+        '''
+        if not self.reuse_snapshots:
+            return self.set_up_stack()
+
+        device = self.params.device
+        with self.resource_lock(('stack', device)):
+            run_key = self.stack_refs.run_key(device)
+            if run_key is not None and run_key != self.run_key:
+                self.infomsg("Stack set up by run %s of config %s; "
+                             "recreating\n" % (run_key[1], run_key[0]))
+                self.tear_down_stack()
+                self.stack_refs.delete(device)
+            self.set_up_stack()
+            self.stack_refs.acquire(device, *self.run_key)
+
+    @traced('stack.ensure_torn_down')
+    def ensure_torn_down(self):
+        '''
+        Check the stack and tear down whatever is set up
+
+        With --reuse-snapshots, the stack is kept for later phases of
+        the run unless this is the backup phase or the stack is stale,
+        and always while other hooks are still using it
+        '''
+        if not self.reuse_snapshots:
+            return self.tear_down_stack()
+
+        device = self.params.device
+        with self.resource_lock(('stack', device)):
+            self.release()
+            if self.kept:
+                return
+            self.tear_down_stack()
+            self.stack_refs.delete(device)
+
+    def release(self):
+        '''
+        With --reuse-snapshots, count one less hook using the stack,
+        and set 'kept' if the stack is to stay set up; call with the
+        stack's resource lock held
+        '''
+        self.kept = False
+        refcount = self.stack_refs.release(self.params.device)
+        if refcount > 0:
+            self.infomsg("Stack in use by %d other hooks; "
+                         "not tearing down\n" % refcount)
+            self.kept = True
+        elif self.params.action != 'backup':
+            self.check()
+            if not self.is_stale:
+                self.infomsg("Keeping stack set up for the rest of "
+                             "the run\n")
+                self.kept = True
+
+    def check_tear_down(self):
+        '''
+        Check the stack for a StackPlan to tear it down along with
+        other stacks; with --reuse-snapshots, release() it first
+        '''
+        if self.reuse_snapshots:
+            self.release()
+            if self.kept:
+                return
+        if self.is_setup is None:
+            self.check()
+
+    @property
+    def needs_tear_down(self):
+        '''
+        After a check(), True if the stack must be torn down before it
+        is set up:  it is partially set up or stale, or, with
+        --reuse-snapshots, was set up by another run
+        '''
+        if self.reuse_snapshots and \
+                self.stack_refs.run_key(self.params.device) not in \
+                (None, self.run_key):
+            return True
+        return self.top_set_up_layer is not None and \
+            (not self.is_setup or self.is_stale)
+
+    def set_up_stack(self):
+        if self.planned:
+            self.planned = False
+            self.infomsg("Stack set up along with other DLEs' stacks")
+            return
+
+        self.check()
+        if not self.is_setup:
+            if self.is_torn_down:
+                self.infomsg("Stack not set up\n")
+            else:
+                self.infomsg("Stack partially set up to %s; tearing down\n" %
+                             self.top_set_up_layer.name)
+                # tear it down
+                self.tear_down()
+                # confirm torn down
+                if not self.is_torn_down:
+                    self.error("Stack not torn down; aborting")
+                self.infomsg("Successfully tore down partially set up stack; "
+                             "rechecking\n")
+                self.check()
+        elif self.is_stale:
+            self.infomsg("Stack is stale; tearing down\n")
+            self.tear_down()
+            # tear it down; confirm torn down
+            if not self.is_torn_down:
+                self.error("Stack not torn down; aborting")
+            self.infomsg("Successfully tore down stale stack; rechecking\n")
+            self.check()
+        else:
+            self.infomsg("Stack is set up; nothing to do")
+            return
+
+        # Set up stack
+        self.set_up()
+
+        self.infomsg("Successfully set up stack")
+
+    def tear_down_stack(self):
+        self.check()
+
+        # if stack is set up, tear it down
+        if not self.is_torn_down:
+            if self.is_setup:
+                self.infomsg("Stack is set up; tearing down\n")
+            else:
+                self.infomsg("Stack partially set up to %s layer; "
+                             "tearing down" % self.top_set_up_layer.name)
+            self.tear_down()
+
+        self.infomsg("Successfully tore down stack\n")
 
 
 class Mount(object):
@@ -0,0 +1,77 @@
+# Reference counts for stacks reused across an Amanda run's phases
+
+from params import Params
+from statedb import StateDB
+
+
+Params.add_option(
+    "--reuse_snapshots", "--reuse-snapshots", type="int", default=0,
+    help=("keep a DLE's stack set up from its pre-dle-amcheck hook "
+          "until post-dle-backup of the same run; param is 0 or 1"))
+Params.add_option(
+    "--timestamp",
+    help=("amanda run timestamp; with --reuse-snapshots, stacks set up "
+          "by a run with another timestamp are recreated"))
+
+StateDB.schema['stack_refs'] = (
+    'CREATE TABLE IF NOT EXISTS stack_refs ('
+    'device TEXT PRIMARY KEY, '
+    'config TEXT, '
+    'run TEXT, '
+    'refcount INTEGER)')
+
+
+class StackRefs(object):
+    '''
+    Reference counts of the hooks using a DLE's stack, kept in the
+    state database with the Amanda config and run timestamp that set
+    the stack up
+
+    With --reuse-snapshots, a stack set up by pre-dle-amcheck survives
+    to be used by the estimate and backup phases of the same run.
+    '''
+
+    def __init__(self,state_db):
+        self.db = state_db
+
+    def run_key(self,device):
+        '''
+        (config, run) that set up the device's stack, or None
+        '''
+        rows = self.db.execute(
+            'SELECT config, run FROM stack_refs WHERE device = ?', (device,))
+        if rows:
+            return tuple(rows[0])
+        return None
+
+    def acquire(self,device,config,run):
+        '''
+        Count one more hook using the stack for this run
+        '''
+        with self.db.transaction():
+            if self.run_key(device) == (config, run):
+                self.db.execute(
+                    'UPDATE stack_refs SET refcount = refcount + 1 '
+                    'WHERE device = ?', (device,))
+            else:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO stack_refs '
+                    '(device, config, run, refcount) VALUES (?, ?, ?, 1)',
+                    (device, config, run))
+
+    def release(self,device):
+        '''
+        Count one less hook using the stack; return the remaining count
+        '''
+        with self.db.transaction():
+            self.db.execute(
+                'UPDATE stack_refs SET refcount = MAX(refcount - 1, 0) '
+                'WHERE device = ?', (device,))
+            rows = self.db.execute(
+                'SELECT refcount FROM stack_refs WHERE device = ?', (device,))
+        if rows:
+            return rows[0][0]
+        return 0
+
+    def delete(self,device):
+        self.db.execute('DELETE FROM stack_refs WHERE device = ?', (device,))
@@ -0,0 +1,177 @@
+# SQLite snaplayers state database
+
+import os, sys, pickle, shutil, sqlite3, threading, fcntl
+from contextlib import contextmanager
+
+from util import Util
+
+
+class PickledSnapdb(dict):
+    '''
+    Stands in for the old Snapdb, a pickled dict subclass, when
+    importing its state file; unlike dict, it takes the instance
+    attributes pickled along with the items
+    '''
+    pass
+
+
+class SnapdbUnpickler(pickle.Unpickler):
+    '''
+    Loads the pickled Snapdb objects of old state files, whatever
+    Snapdb has become since
+    '''
+
+    classes = {
+        ('layers', 'Snapdb') : PickledSnapdb,
+        ('amanda_snaplayers.layers', 'Snapdb') : PickledSnapdb,
+        ('util', 'Util') : Util,
+        ('amanda_snaplayers.util', 'Util') : Util,
+        }
+
+    def find_class(self,module,name):
+        if (module, name) in self.classes:
+            return self.classes[(module, name)]
+        return pickle.Unpickler.find_class(self,module,name)
+
+
+class StateDB(object):
+    '''
+    Snaplayers state persisted in an SQLite database
+
+    Rows are read and written individually, so lookups and updates
+    don't rewrite the whole file; SQLite's locking makes the database
+    safe for many concurrent script processes.  A pickled state file
+    from older versions is imported on first use.
+    '''
+
+    sqlite_magic = 'SQLite format 3\x00'
+    # seconds to wait for another process's write lock
+    timeout = 60
+
+    # table name -> CREATE TABLE statement; modules with their own state
+    # add their tables here
+    schema = {
+        'snaps' : ('CREATE TABLE IF NOT EXISTS snaps ('
+                   'device TEXT PRIMARY KEY, '
+                   'timestamp TIMESTAMP)'),
+        }
+
+    # shared instances by state file; see open()
+    instances = {}
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def open(cls,state_file,util):
+        '''
+        Return the process's StateDB object for a state file
+        '''
+        with cls.instances_lock:
+            if state_file not in cls.instances:
+                cls.instances[state_file] = cls(state_file,util)
+            return cls.instances[state_file]
+
+    def __init__(self,state_file,util):
+        self.state_file = state_file
+        self.util = util
+        # sqlite3 connections can't be shared between threads
+        self.local = threading.local()
+
+        self.import_pickle()
+
+    @property
+    def conn(self):
+        conn = getattr(self.local,'conn',None)
+        if conn is None:
+            try:
+                # isolation_level=None:  each statement commits on its
+                # own unless run in a transaction()
+                conn = sqlite3.connect(
+                    self.state_file, timeout=self.timeout,
+                    detect_types=sqlite3.PARSE_DECLTYPES,
+                    isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                for create_stmt in self.schema.values():
+                    conn.execute(create_stmt)
+            except sqlite3.Error, e:
+                self.util.error("Error opening state db '%s':  %s" %
+                                (self.state_file, e))
+            self.local.conn = conn
+        return conn
+
+    def execute(self,sql,args=()):
+        try:
+            return self.conn.execute(sql,args).fetchall()
+        except sqlite3.Error, e:
+            self.util.error("Error accessing state db '%s':  %s" %
+                            (self.state_file, e))
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Run several statements atomically; the write lock is taken up
+        front so concurrent read-modify-write sequences serialize
+        '''
+        self.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.execute('COMMIT')
+
+    def close(self):
+        conn = getattr(self.local,'conn',None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    @property
+    def is_pickle(self):
+        try:
+            with open(self.state_file,'rb') as f:
+                head = f.read(len(self.sqlite_magic))
+        except IOError:
+            # doesn't exist yet
+            return False
+        return head != '' and head != self.sqlite_magic
+
+    def import_pickle(self):
+        '''
+        Convert an old pickled state file into a database in place,
+        keeping a copy of the pickle in '<state_file>.pickle'
+        '''
+        if not self.is_pickle:
+            return
+
+        lock_file = open(self.state_file + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # another process may have converted it while we waited
+            if not self.is_pickle:
+                return
+            try:
+                with open(self.state_file, 'rb') as f:
+                    snaps = SnapdbUnpickler(f).load()
+            except:
+                self.util.error("Error reading snapshot db '%s': %s" %
+                                (self.state_file, sys.exc_info()[0]))
+
+            tmp_file = self.state_file + '.tmp'
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+            conn = sqlite3.connect(tmp_file)
+            conn.execute(self.schema['snaps'])
+            conn.executemany(
+                'INSERT INTO snaps (device, timestamp) VALUES (?, ?)',
+                [(device, val['timestamp'])
+                 for (device, val) in snaps.items()
+                 if 'timestamp' in val])
+            conn.commit()
+            conn.close()
+
+            shutil.copy2(self.state_file, self.state_file + '.pickle')
+            os.rename(tmp_file, self.state_file)
+            self.util.debugmsg("Imported %d entries from pickled db '%s'" %
+                               (len(snaps), self.state_file))
+        finally:
+            lock_file.close()
@@ -0,0 +1,317 @@
+# Root helper running the commands sudo allows over a pipe
+
+import os, sys, json, time, fnmatch, threading, itertools, collections, Queue
+from subprocess import Popen, PIPE
+
+from commands import Command, CommandEngine
+
+
+class SudoHelperError(Exception):
+    pass
+
+
+class SudoersRules(object):
+    '''
+    The commands a user may run as root, read from the Cmnd_Alias and
+    user specification lines of a sudoers file, such as
+    examples/amandabackup.sudoers
+
+    Commands match as sudo matches them:  the path, resolved in
+    'secure_path' if relative, must be the allowed path, and the
+    arguments joined by spaces must match the allowed arguments as a
+    shell wildcard pattern; an allowed command without arguments may
+    have any, and one with "" none.  Negated ('!') entries can't be
+    enforced here and make the rules invalid.
+    '''
+
+    secure_path = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+
+    def __init__(self,sudoers_file,user):
+        self.sudoers_file = sudoers_file
+        self.user = user
+        # [(path, args pattern or None for any)]
+        self.allowed = []
+        self.read()
+
+    def logical_lines(self,text):
+        line = ''
+        for l in text.splitlines():
+            l = l.split('#',1)[0].rstrip()
+            if l.endswith('\\'):
+                line += l[:-1] + ' '
+                continue
+            line += l
+            if line.strip():
+                yield line.strip()
+            line = ''
+
+    def split_list(self,text):
+        # split at commas not escaped as '\,'
+        items = [i.strip().replace('\0', ',')
+                 for i in text.replace('\\,', '\0').split(',')]
+        return [i for i in items if i]
+
+    def parse_command(self,spec):
+        if spec.startswith('!'):
+            raise SudoHelperError("negated command '%s' in %s" %
+                                  (spec, self.sudoers_file))
+        words = spec.split(None,1)
+        if len(words) == 1:
+            return (words[0], None)
+        args = words[1].strip()
+        if args == '""':
+            args = ''
+        return (words[0], args)
+
+    def read(self):
+        try:
+            with open(self.sudoers_file,'r') as f:
+                text = f.read()
+        except IOError, e:
+            raise SudoHelperError("Unable to read %s:  %s" %
+                                  (self.sudoers_file, e))
+
+        aliases = {}
+        specs = []
+        for line in self.logical_lines(text):
+            if line.startswith('Cmnd_Alias'):
+                (name, cmnds) = line[len('Cmnd_Alias'):].split('=',1)
+                aliases[name.strip()] = self.split_list(cmnds)
+            elif '=' in line and not line.startswith('Defaults'):
+                (who, cmnds) = line.split('=',1)
+                if who.split()[0] == self.user:
+                    specs.append(cmnds)
+
+        for cmnds in specs:
+            # drop the runas list and tags, e.g. '(root) NOPASSWD:'
+            cmnds = cmnds.strip()
+            if cmnds.startswith('('):
+                cmnds = cmnds.split(')',1)[1]
+            for item in self.split_list(cmnds):
+                while ':' in item.split()[0]:
+                    item = item.split(':',1)[1].strip()
+                for spec in aliases.get(item, [item]):
+                    self.allowed.append(self.parse_command(spec))
+        if not self.allowed:
+            raise SudoHelperError("No commands allowed for '%s' in %s" %
+                                  (self.user, self.sudoers_file))
+
+    def resolve(self,path):
+        if os.path.isabs(path):
+            return path
+        for d in self.secure_path.split(':'):
+            candidate = os.path.join(d, path)
+            if os.access(candidate, os.X_OK):
+                return candidate
+        return None
+
+    def same_path(self,allowed_path,path):
+        if fnmatch.fnmatchcase(path, allowed_path):
+            return True
+        # e.g. /bin/mkdir allowed, and /usr/bin/mkdir found in
+        # secure_path on a merged-/usr system; only the root-owned
+        # sudoers path is resolved, never one given by the caller
+        return path == os.path.realpath(allowed_path)
+
+    def check(self,cmd):
+        '''
+        Return cmd with the allowed path from the sudoers file in place
+        of its own, as sudo runs it, if allowed; otherwise None
+        '''
+        path = self.resolve(cmd[0])
+        if path is None:
+            return None
+        args = ' '.join(cmd[1:])
+        for (allowed_path, pattern) in self.allowed:
+            if not self.same_path(allowed_path, path):
+                continue
+            if pattern is None or fnmatch.fnmatchcase(args, pattern):
+                if [c for c in '*?[' if c in allowed_path]:
+                    # as sudo, run the matching path
+                    return [path] + cmd[1:]
+                return [allowed_path] + cmd[1:]
+        return None
+
+
+class SudoHelper(object):
+    '''
+    The root side of the sudo helper, started once through sudo by
+    SudoHelperClient
+
+    Reads one JSON request per line, {"id": ..., "cmd": [...],
+    "timeout": ...}, from stdin; runs each allowed command in its own
+    thread and writes {"id": ..., "exit": ..., "stdout": ...,
+    "stderr": ..., "timed_out": ...} to stdout as it finishes.
+    Commands the invoking user's sudoers rules don't allow fail as
+    sudo would.  Exits once stdin is closed and running commands
+    finish.
+    '''
+
+    # root-owned, so the rules can't be changed by the Amanda user
+    sudoers_file = '/etc/sudoers.d/amandabackup'
+
+    def __init__(self,stdin=sys.stdin,stdout=sys.stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.lock = threading.Lock()
+        user = os.environ.get('SUDO_USER',None)
+        if user is None:
+            raise SudoHelperError("Must be run through sudo")
+        self.rules = SudoersRules(self.sudoers_file, user)
+
+    def reply(self,msg):
+        with self.lock:
+            self.stdout.write(json.dumps(msg) + '\n')
+            self.stdout.flush()
+
+    def fail(self,request,msg):
+        self.reply({ 'id' : request.get('id',None), 'exit' : 1,
+                     'stdout' : '', 'stderr' : msg, 'timed_out' : False })
+
+    def run(self,request):
+        try:
+            cmd = [str(arg) for arg in request['cmd']]
+            allowed = self.rules.check(cmd)
+        except Exception, e:
+            self.fail(request, "sudo: bad request:  %s\n" % e)
+            return
+        if allowed is None:
+            self.fail(request, "sudo: %s not allowed by %s\n" %
+                      (' '.join(cmd), self.sudoers_file))
+            return
+        command = CommandEngine().run(
+            Command(allowed, request.get('timeout',None)))
+        # command output may be any bytes; JSON carries latin-1 text
+        self.reply({ 'id' : request['id'],
+                     'exit' : command.returncode,
+                     'stdout' : command.stdout.decode('latin-1'),
+                     'stderr' : command.stderr.decode('latin-1'),
+                     'timed_out' : command.timed_out })
+
+    def serve(self):
+        self.reply({ 'ready' : True })
+        threads = []
+        for line in iter(self.stdin.readline, ''):
+            try:
+                request = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(request, dict):
+                continue
+            thread = threading.Thread(target=self.run, args=(request,))
+            thread.start()
+            threads = [t for t in threads if t.is_alive()] + [thread]
+        for thread in threads:
+            thread.join()
+
+
+class SudoHelperClient(object):
+    '''
+    Run commands as root through one SudoHelper process started with
+    'sudo -n', instead of starting sudo for each command
+
+    Requests from all threads share the helper's pipes; a reader
+    thread hands each reply to the batch waiting for it.  Once the
+    helper exits, 'alive' is False and commands waiting on it fail.
+    '''
+
+    def __init__(self,helper_cmd):
+        self.helper_cmd = helper_cmd
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # request id -> (command, queue of the batch)
+        self.waiting = {}
+        self.alive = True
+
+        self.proc = Popen(['sudo', '-n'] + helper_cmd,
+                          stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                          close_fds=True)
+        line = self.proc.stdout.readline()
+        try:
+            ready = json.loads(line).get('ready',False)
+        except ValueError:
+            ready = False
+        if not ready:
+            self.proc.stdin.close()
+            self.proc.wait()
+            raise SudoHelperError(
+                (line + self.proc.stderr.read()).strip() or
+                "exit status %s" % self.proc.returncode)
+
+        self.reader = threading.Thread(target=self.read_replies)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_replies(self):
+        for line in iter(self.proc.stdout.readline, ''):
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                continue
+            with self.lock:
+                waiting = self.waiting.pop(reply.get('id',None),None)
+            if waiting is None:
+                # e.g. a malformed request's reply
+                continue
+            (command, done) = waiting
+            command.output('stdout', reply['stdout'].encode('latin-1'))
+            command.output('stderr', reply['stderr'].encode('latin-1'))
+            command.timed_out = reply['timed_out']
+            command.finish(reply['exit'])
+            done.put(command)
+
+        # the helper exited; fail whatever was waiting for it
+        with self.lock:
+            self.alive = False
+            waiting = self.waiting.values()
+            self.waiting.clear()
+        for (command, done) in waiting:
+            command.output('stderr', "sudo helper exited\n")
+            command.finish(1)
+            done.put(command)
+
+    def submit(self,command,done):
+        command.start = time.time()
+        with self.lock:
+            if not self.alive:
+                command.output('stderr', "sudo helper exited\n")
+                command.finish(1)
+                done.put(command)
+                return
+            request_id = self.ids.next()
+            self.waiting[request_id] = (command, done)
+            try:
+                self.proc.stdin.write(json.dumps(
+                        { 'id' : request_id, 'cmd' : command.cmd,
+                          'timeout' : command.timeout }) + '\n')
+                self.proc.stdin.flush()
+            except IOError:
+                # the reader fails the request once it sees the exit
+                pass
+
+    def run_batch(self,commands,max_running=None):
+        '''
+        Run commands in the helper, at most max_running at a time,
+        yielding each command as it finishes, like
+        CommandEngine.run_batch()
+        '''
+        if max_running is None or max_running < 1:
+            max_running = max(1, len(commands))
+        pending = collections.deque(commands)
+        done = Queue.Queue()
+        running = 0
+        while pending or running:
+            while pending and running < max_running:
+                self.submit(pending.popleft(), done)
+                running += 1
+            command = done.get()
+            running -= 1
+            yield command
+
+    def stop(self):
+        with self.lock:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+        self.proc.wait()
@@ -0,0 +1,157 @@
+# Timing spans written to a JSON-lines trace file
+
+import os, time, json, socket, threading, itertools
+from contextlib import contextmanager
+
+
+class Trace(object):
+    '''
+    The trace of one hook run, appended to a JSON-lines trace file
+
+    Each span is written as one line when it ends, with its name, start
+    time, wall time in seconds, the id of its enclosing span and any
+    attributes set while it ran, such as a command's exit status or
+    a retry count.  The first line of each run describes the run.
+    '''
+
+    # span ids, unique within the process
+    ids = itertools.count(1)
+
+    def __init__(self,trace_file,**run_attrs):
+        self.file = open(trace_file,'a')
+        self.lock = threading.Lock()
+        self.run = '%s.%d.%d' % (time.strftime('%Y%m%d%H%M%S'),
+                                 os.getpid(), self.ids.next())
+        # per-thread stack of open spans
+        self.local = threading.local()
+
+        run_attrs.update({ 'type' : 'run',
+                           'host' : socket.gethostname(),
+                           'start' : time.time() })
+        self.write(run_attrs)
+
+    def write(self,record):
+        record['run'] = self.run
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    @property
+    def open_spans(self):
+        return self.local.__dict__.setdefault('spans',[])
+
+    @contextmanager
+    def span(self,name,attrs):
+        '''
+        Time the enclosed block; yields the span's attributes dict,
+        which the block may add to
+        '''
+        spans = self.open_spans
+        record = { 'type' : 'span',
+                   'name' : name,
+                   'id' : self.ids.next(),
+                   'parent' : spans and spans[-1]['id'] or None,
+                   'thread' : threading.current_thread().name,
+                   'start' : time.time() }
+        spans.append(record)
+        try:
+            yield attrs
+        except SystemExit, e:
+            attrs['error'] = 'exit %s' % e.code
+            raise
+        except Exception, e:
+            attrs['error'] = '%s: %s' % (e.__class__.__name__, e)
+            raise
+        finally:
+            spans.pop()
+            record['wall'] = time.time() - record['start']
+            record.update(attrs)
+            self.write(record)
+
+    def add_span(self,name,start,wall,attrs):
+        '''
+        Write a span timed by the caller, e.g. one of several commands
+        run at once, inside the thread's current span
+        '''
+        spans = self.open_spans
+        record = { 'type' : 'span',
+                   'name' : name,
+                   'id' : self.ids.next(),
+                   'parent' : spans and spans[-1]['id'] or None,
+                   'thread' : threading.current_thread().name,
+                   'start' : start,
+                   'wall' : wall }
+        record.update(attrs)
+        self.write(record)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def traced(name):
+    '''
+    Decorator running a Util subclass method in a span; the object's
+    span_attrs are recorded with it
+    '''
+    def decorator(func):
+        def wrapper(obj,*args,**kwargs):
+            with obj.span(name,**obj.span_attrs):
+                return func(obj,*args,**kwargs)
+        wrapper.func_name = func.func_name
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+class TraceSummary(object):
+    '''
+    Wall time percentiles of traced spans across runs, grouped by span
+    name and layer type, or by command for 'cmd' spans
+    '''
+
+    def __init__(self):
+        # group key -> list of wall times
+        self.walls = {}
+        self.runs = set()
+
+    def span_key(self,record):
+        if record['name'] == 'cmd':
+            # e.g. 'sudo -n /sbin/lvcreate ...' -> 'cmd lvcreate'
+            words = [w for w in record.get('cmd','').split()
+                     if w not in ('sudo', '-n')]
+            return 'cmd %s' % os.path.basename(words and words[0] or '')
+        if 'layer' in record:
+            return '%s %s' % (record['name'], record['layer'])
+        return record['name']
+
+    def read(self,trace_file):
+        for line in open(trace_file,'r'):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # e.g. a line cut short by a crash
+                continue
+            if record.get('type') != 'span':
+                continue
+            self.runs.add(record['run'])
+            self.walls.setdefault(self.span_key(record),[]).append(
+                record['wall'])
+
+    @staticmethod
+    def percentile(walls,pct):
+        # nearest-rank percentile of a sorted list
+        rank = max(1, int(round(pct / 100.0 * len(walls))))
+        return walls[rank-1]
+
+    def report(self):
+        lines = ["%d runs" % len(self.runs), "",
+                 "%-40s %6s %9s %9s %9s" %
+                 ('span', 'count', 'p50', 'p95', 'max')]
+        for key in sorted(self.walls):
+            walls = sorted(self.walls[key])
+            lines.append("%-40s %6d %9.3f %9.3f %9.3f" %
+                         (key, len(walls), self.percentile(walls,50),
+                          self.percentile(walls,95), walls[-1]))
+        return '\n'.join(lines)
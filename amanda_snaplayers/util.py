@@ -1,16 +1,31 @@
 # Utility functions
 
-import sys, re, time
+import sys, re, time, threading
 
-from subprocess import Popen, PIPE
 from datetime import datetime
+from contextlib import contextmanager
+
+from tracing import Trace
+from commands import Command, CommandEngine
+from sudo_helper import SudoHelperClient, SudoHelperError
 
 
 class Util(object):
-    sudo_fail_re = re.compile(r'sudo:.*password')
+    # sudo, or the sudo helper, refusing a command
+    sudo_fail_re = re.compile(r'sudo:.*(password|not allowed)')
     # parameters shared across instances
     parms = { 'log' : None,
               'log_set' : False,
+              'locks' : {},
+              'locks_lock' : threading.Lock(),
+              # per-thread logging parameters for daemon requests
+              'context' : threading.local(),
+              # runs commands instead of a subprocess; see set_executor()
+              'executor' : None,
+              # root helper run instead of 'sudo -n' per command; see
+              # sudo_helper()
+              'sudo_helper' : None,
+              'sudo_helper_failed' : False,
               }
 
     def __init__(self, debug=False,
@@ -24,19 +39,49 @@ class Util(object):
         # The following 'parms' keys are shared between instances;
         # don't touch them at all by default, since this method will
         # be called multiple times
-        
+        log_parms = self.log_parms
+
         # By default, log to stdout
         if log_to_stdout:
             # Logging explicitly set to stdout
-            self.parms['log'] = sys.stdout
-            self.parms['log_set'] = True
+            log_parms['log'] = self.stdout
+            log_parms['log_set'] = True
         elif logfile:
             # Logging explicitly set to a file
-            self.parms['log'] = open(logfile, 'w')
-            self.parms['log_set'] = True
-        elif self.parms['log'] is None:
+            log_parms['log'] = open(logfile, 'w')
+            log_parms['log_set'] = True
+        elif log_parms.get('log',None) is None:
             # Default case:  log to stdout
-            self.parms['log'] = sys.stdout
+            log_parms['log'] = self.stdout
+
+    @property
+    def log_parms(self):
+        '''
+        Logging parameters:  the thread's context while it serves a
+        daemon request, otherwise the process-wide 'parms'
+        '''
+        context = self.parms['context'].__dict__
+        if context.get('active',False):
+            return context
+        return self.parms
+
+    @property
+    def stdout(self):
+        return self.log_parms.get('stdout',sys.stdout)
+
+    @property
+    def stderr(self):
+        return self.log_parms.get('stderr',sys.stderr)
+
+    def thread_context(self):
+        '''
+        Copy of this thread's logging context, to hand to worker threads
+        '''
+        return dict(self.parms['context'].__dict__)
+
+    def set_thread_context(self,context):
+        self.parms['context'].__dict__.clear()
+        self.parms['context'].__dict__.update(context)
 
     @property
     def error_prefix(self):
@@ -60,8 +105,9 @@ class Util(object):
             return ''
 
     def infomsg(self,msg):
+        log = self.log_parms['log']
         for line in msg.split('\n'):
-            self.parms['log'].write("%s\n" % line)
+            log.write("%s\n" % line)
 
     def debugmsg(self,msg):
         if self.debug:
@@ -74,10 +120,43 @@ class Util(object):
             prefix = self.success_prefix
         if prefix is None:
             return
+        log = self.log_parms['log']
         for line in [ "%s %s\n" % (prefix, l) for l in msg.split('\n') ]:
-            self.parms['log'].write(line)
-            if self.parms['log'] is not sys.stdout:
-                sys.stdout.write(line)
+            log.write(line)
+            if log is not self.stdout:
+                self.stdout.write(line)
+
+    def start_trace(self,trace_file,**run_attrs):
+        '''
+        Record timing spans for this run in trace_file, until
+        stop_trace()
+        '''
+        self.log_parms['trace'] = Trace(trace_file,**run_attrs)
+
+    def stop_trace(self):
+        trace = self.log_parms.pop('trace',None)
+        if trace is not None:
+            trace.close()
+
+    @property
+    def span_attrs(self):
+        '''
+        Attributes identifying this object in its traced spans
+        '''
+        return {}
+
+    @contextmanager
+    def span(self,name,**attrs):
+        '''
+        Time the enclosed block as a trace span, if tracing; yields
+        a dict of span attributes for the block to add to
+        '''
+        trace = self.log_parms.get('trace',None)
+        if trace is None:
+            yield attrs
+        else:
+            with trace.span(name,attrs) as span:
+                yield span
 
     def error(self,msg):
         self.statusmsg(msg, error=True)
@@ -90,23 +169,119 @@ class Util(object):
             else:
                 self.infomsg(prefix + line)
 
-    def run_cmd(self,cmd,sudo=True,t_f=True,fail_abort=True):
-        # cmd may be a string (bad) or an array (good)
-        if type(cmd) is str:
-            cmd = cmd.split()
-        if sudo:
-            cmd = ['sudo', '-n'] + cmd
+    def add_span(self,name,start,wall,**attrs):
+        '''
+        Record a span timed by the caller, if tracing
+        '''
+        trace = self.log_parms.get('trace',None)
+        if trace is not None:
+            trace.add_span(name,start,wall,attrs)
 
-        # run cmd, capturing stdin, stdout and exit status
-        self.debugmsg("        Running command:  %s" % ' '.join(cmd))
-        popen_obj = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        (stdout, stderr) = popen_obj.communicate()
+    @property
+    def command_timeout(self):
+        # layers kill commands running longer than --command-timeout
+        params = getattr(self,'params',None)
+        return getattr(params,'command_timeout',None) or None
+
+    @property
+    def command_workers(self):
+        return getattr(getattr(self,'params',None),'max_workers',None)
+
+    @property
+    def sudo_helper(self):
+        '''
+        The sudo helper shared by all threads, started on first use
+        when the --sudo-helper option names it; None to run commands
+        with 'sudo -n' each
+        '''
+        helper_cmd = getattr(getattr(self,'params',None),'sudo_helper',None)
+        if not helper_cmd or self.parms['executor'] is not None:
+            return None
+        with self.resource_lock('sudo_helper'):
+            helper = self.parms['sudo_helper']
+            if helper is not None and helper.alive:
+                return helper
+            if self.parms['sudo_helper_failed']:
+                return None
+            try:
+                helper = SudoHelperClient([helper_cmd])
+            except (SudoHelperError, OSError), e:
+                # don't try again for each command
+                self.parms['sudo_helper_failed'] = True
+                self.infomsg("Unable to start sudo helper '%s', running "
+                             "commands with 'sudo -n':  %s" % (helper_cmd, e))
+                return None
+            self.parms['sudo_helper'] = helper
+            return helper
+
+    @classmethod
+    def stop_sudo_helper(cls):
+        helper = cls.parms['sudo_helper']
+        cls.parms['sudo_helper'] = None
+        cls.parms['sudo_helper_failed'] = False
+        if helper is not None:
+            helper.stop()
+
+    def run_cmd(self,cmd,sudo=True,t_f=True,fail_abort=True,timeout=None):
+        for (i, res) in self.run_cmds([cmd],sudo,t_f,fail_abort,timeout):
+            return res
+
+    def run_cmds(self,cmds,sudo=True,t_f=True,fail_abort=True,timeout=None,
+                 max_running=None,on_output=None):
+        '''
+        Run independent commands concurrently, at most max_running
+        (default --max-workers) at a time, yielding (i, (res, stdout,
+        stderr)) for the i'th command as each finishes; results are as
+        from run_cmd()
+
+        Commands running longer than timeout seconds (default
+        --command-timeout) are killed.  'on_output(command, name,
+        data)' is passed each chunk of output as it is read; see
+        commands.Command.
+        '''
+        if timeout is None:
+            timeout = self.command_timeout
+        if max_running is None:
+            max_running = self.command_workers
+
+        # root commands go to the sudo helper if there is one
+        helper = sudo and self.sudo_helper or None
+
+        commands = []
+        for cmd in cmds:
+            # cmd may be a string (bad) or an array (good)
+            if type(cmd) is str:
+                cmd = cmd.split()
+            if sudo and helper is None:
+                cmd = ['sudo', '-n'] + cmd
+            self.debugmsg("        Running command%s:  %s" %
+                          (helper and ' in sudo helper' or '', ' '.join(cmd)))
+            commands.append(Command(cmd,timeout,on_output))
+        index = dict([(id(c), i) for (i, c) in enumerate(commands)])
+
+        engine = helper or CommandEngine(self.parms['executor'])
+        for command in engine.run_batch(commands,max_running):
+            attrs = { 'cmd' : ' '.join(command.cmd),
+                      'exit' : command.returncode }
+            if command.timed_out:
+                attrs['timed_out'] = True
+            self.add_span('cmd', command.start, command.wall, **attrs)
+            if len(commands) > 1:
+                self.debugmsg("        Finished command:  %s" % attrs['cmd'])
+            yield (index[id(command)],
+                   self.cmd_result(command,sudo,t_f,fail_abort))
+
+    def cmd_result(self,command,sudo,t_f,fail_abort):
+        (returncode, stdout, stderr) = command.result
+        if command.timed_out:
+            self.infomsg("Command timed out after %s seconds:  %s" %
+                         (command.timeout, ' '.join(command.cmd)))
 
         # when t_f is True, return True/False; otherwise, integer exit status
         if t_f:
-            res = popen_obj.returncode == 0
+            res = returncode == 0
         else:
-            res = popen_obj.returncode
+            res = returncode
 
         # when running sudo, if the sudo command fails,
         #   if fail_abort is True, print debug messages and error out;
@@ -114,7 +289,7 @@ class Util(object):
         if sudo and self.sudo_fail_re.match(stderr):
             if fail_abort:
                 self.infomsg("Command failed, aborting:")
-                self.infomsg("              exit:  %s" % popen_obj.returncode)
+                self.infomsg("              exit:  %s" % returncode)
                 self._print_io("            stdout:  ", stdout)
                 self._print_io("            stderr:  ", stderr)
                 sys.exit(1)
@@ -123,12 +298,30 @@ class Util(object):
 
         # print debugging info
         self.debugmsg("            exit/return:  %s/%s" %
-                      (popen_obj.returncode,res))
+                      (returncode,res))
         self._print_io("            stdout:  ", stdout, debug=True)
         self._print_io("            stderr:  ", stderr, debug=True)
 
         return (res,stdout,stderr)
 
+    @classmethod
+    def set_executor(cls,executor):
+        '''
+        Run all commands with executor(cmd), returning (returncode,
+        stdout, stderr), instead of in subprocesses, e.g. to simulate
+        the system for benchmarks; None restores subprocesses
+        '''
+        cls.parms['executor'] = executor
+
+    def resource_lock(self,resource):
+        '''
+        Return a process-wide lock for a named resource, such as the
+        /dev/md device allocator, so that stacks running concurrently
+        in threads don't race each other for it
+        '''
+        with self.parms['locks_lock']:
+            return self.parms['locks'].setdefault(resource, threading.RLock())
+
     @property
     def timestr(self):
         return time.strftime('%H:%M:%S',time.localtime())
@@ -0,0 +1,104 @@
+# Waiting for devices to appear or disappear, and for other conditions
+
+import os, os.path, select, time, ctypes, ctypes.util
+
+# inotify(7) constants
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+IN_WATCH_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# fallback polling interval when inotify isn't available
+POLL_INTERVAL = 0.1
+# even with inotify, re-check at least this often in case a change
+# isn't visible in the watched directory, e.g. a symlink target
+MAX_SLEEP = 1.0
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init1
+except (OSError, AttributeError):
+    libc = None
+
+
+def _inotify_init():
+    if libc is None:
+        return None
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+    return fd
+
+def _watch_nearest_dir(fd,path):
+    '''
+    Watch the nearest existing directory above path, e.g. /dev for
+    /dev/vdb, or /dev for /dev/vg/lv if /dev/vg doesn't exist yet;
+    False if there's none, so the caller polls
+    '''
+    # dirname() of a relative path ends at '', not at a directory
+    watch_dir = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(watch_dir):
+        parent = os.path.dirname(watch_dir)
+        if parent == watch_dir:
+            return False
+        watch_dir = parent
+    # adding an existing watch again is harmless
+    return libc.inotify_add_watch(fd, watch_dir, IN_WATCH_MASK) >= 0
+
+def wait_for_path(path,present=True,timeout=10):
+    '''
+    Wait up to timeout seconds for a path, such as a block device
+    node, to appear (or disappear, if present is False)
+
+    Returns True as soon as the path reaches the wanted state,
+    woken by inotify events on its directory when possible, or False
+    on timeout
+    '''
+    deadline = time.time() + timeout
+    fd = _inotify_init()
+    try:
+        while True:
+            if os.path.exists(path) == present:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if fd is None or not _watch_nearest_dir(fd,path):
+                time.sleep(min(POLL_INTERVAL, remaining))
+                continue
+            # re-check now the watch is in place, closing the race with
+            # changes made before it was added
+            if os.path.exists(path) == present:
+                return True
+            (ready,w,x) = select.select(
+                [fd], [], [], min(MAX_SLEEP, remaining))
+            if ready:
+                # drain the events; only the path's state matters
+                try:
+                    os.read(fd, 65536)
+                except OSError:
+                    pass
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def wait_until(check,timeout,interval=0.5,max_interval=5):
+    '''
+    Call check() until it returns True or timeout seconds pass,
+    doubling the wait between calls from interval up to max_interval
+
+    Returns True if check() succeeded, otherwise False
+    '''
+    deadline = time.time() + timeout
+    while True:
+        if check():
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
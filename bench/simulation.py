@@ -0,0 +1,874 @@
+# Simulated LVM, md, mount, Ceph, libvirt and XenAPI backends
+
+import os, sys, json, time, random, shutil, tempfile, threading, types
+from xml.etree import ElementTree
+
+from amanda_snaplayers.util import Util
+from amanda_snaplayers.mounts import MountTable
+
+
+class SimMountinfo(object):
+    '''
+    Stands in for the open /proc/self/mountinfo file
+    '''
+
+    def __init__(self,sim):
+        self.sim = sim
+
+    def seek(self,pos):
+        pass
+
+    def read(self):
+        return self.sim.mountinfo_text()
+
+    def close(self):
+        pass
+
+
+class SimMountinfoPoll(object):
+    '''
+    Stands in for a poll object on mountinfo, flagging POLLPRI once
+    after each simulated mount or umount, like the kernel
+    '''
+
+    def __init__(self,sim):
+        self.sim = sim
+        self.generation = sim.mount_generation
+
+    def register(self,fd,eventmask):
+        pass
+
+    def poll(self,timeout=None):
+        generation = self.sim.mount_generation
+        if generation == self.generation:
+            return []
+        self.generation = generation
+        return [(0, 2)]
+
+
+class XenAPINamespace(object):
+    '''
+    session.xenapi and its classes, e.g. session.xenapi.VDI; calls go
+    to Simulation.xenapi_call()
+    '''
+
+    def __init__(self,sim,session,name=None):
+        self.sim = sim
+        self.session = session
+        self.name = name
+
+    def __getattr__(self,attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return XenAPINamespace(
+            self.sim, self.session,
+            self.name and '%s.%s' % (self.name, attr) or attr)
+
+    def __call__(self,*args):
+        return self.sim.xenapi_call(self.session, self.name, args)
+
+
+class CurrentSimulation(object):
+    '''
+    Forwards to the installed Simulation; the stand-in modules are
+    created once per process, since layer modules keep references to
+    them, and act on whichever simulation is current
+    '''
+
+    def __getattr__(self,attr):
+        return getattr(Simulation.current, attr)
+
+
+class Simulation(object):
+    '''
+    A simulated host for running snaplayers without root, LVM, md,
+    Ceph or libvirt
+
+    Commands run through Util.set_executor() act on an in-memory model
+    of LVs, md arrays and mounts; stand-in 'rados', 'rbd', 'libvirt' and
+    'XenAPI' modules act on a model of RBD images, a backup VM and a
+    XenServer SR.  Block device nodes are files under a scratch root
+    directory, which /dev paths are redirected to, along with
+    /proc/mdstat, /sys/block and /proc/self/mountinfo.
+
+    Each operation, e.g. 'cmd.lvcreate', 'rbd.create_snap',
+    'libvirt.attachDevice' or 'xenapi.VDI.get_all_records', is counted,
+    delayed by its configured latency and fails at its configured
+    rate.  Latencies and failure rates are looked up by full operation
+    name, then by its prefix, e.g. 'cmd', then '*'.
+    '''
+
+    vg_name = 'simvg'
+    ceph_pool = 'simpool'
+    vm_name = 'simvm'
+    sr_uuid = '5e1f0000-0000-4000-8000-000000000000'
+
+    # the installed simulation, and the stand-in modules acting on it
+    current = None
+    modules = {}
+
+    def __init__(self,latency=None,failure_rate=None,seed=0):
+        self.latency = latency or {}
+        self.failure_rate = failure_rate or {}
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.counts = {}
+        self.root = tempfile.mkdtemp(prefix='snaplayers-sim.')
+        self.saved = {}
+        self.saved_modules = {}
+
+        # system model
+        self.lvs = {}             # (vg, lv) -> { 'origin', 'parts', 'md' }
+        self.md_arrays = {}       # md device -> { 'uuid', 'slaves', 'parts' }
+        self.mounts = []          # [ (device, mount point) ]
+        self.mount_generation = 0
+        # (device, mount point) -> mount ID, as in mountinfo
+        self.mount_ids = {}
+        self.images = {}          # (pool, name) -> { 'snaps', 'parent', ... }
+        self.vm_disks = {}        # target dev -> rbd 'pool/name'
+        self.vdis = {}            # ref -> VDI record
+        self.xenapi_sessions = set()  # logged in session refs
+        self.devices = []         # DLE mount points, by populate()
+
+        for d in ('dev', 'proc/self', 'sys/block', 'mnt'):
+            os.makedirs(os.path.join(self.root, d))
+        self.write_mdstat()
+        # the backup VM's own disk
+        self.add_block_device('/dev/vda', 1)
+
+    @property
+    def mount_base(self):
+        return os.path.join(self.root, 'mnt')
+
+    def path(self,path):
+        # where a simulated /dev path lives
+        return os.path.join(self.root, path.lstrip('/'))
+
+    #
+    # Operation accounting
+    #
+    def lookup(self,table,op):
+        for key in (op, op.split('.')[0], '*'):
+            if key in table:
+                return table[key]
+        return 0
+
+    def op(self,op):
+        '''
+        Count an operation and apply its latency; True if it should
+        fail
+        '''
+        with self.lock:
+            self.counts[op] = self.counts.get(op,0) + 1
+            fail = self.random.random() < self.lookup(self.failure_rate,op)
+        delay = self.lookup(self.latency,op)
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = {}
+
+    #
+    # Installation into the running process
+    #
+    def install(self):
+        '''
+        Redirect commands, modules and /dev, /proc and /sys paths into
+        the simulation; undone by uninstall()
+        '''
+        Simulation.current = self
+        if not self.modules:
+            self.modules.update({ 'rados' : self.rados_module(),
+                                  'rbd' : self.rbd_module(),
+                                  'libvirt' : self.libvirt_module(),
+                                  'XenAPI' : self.xenapi_module() })
+        for (name, module) in self.modules.items():
+            self.saved_modules[name] = sys.modules.get(name,None)
+            sys.modules[name] = module
+
+        # import after the stand-in modules are in place
+        from amanda_snaplayers.layer_md import MD_component_device
+
+        self.saved['exists'] = os.path.exists
+        os.path.exists = self.exists
+        self.saved['md'] = dict([(a, getattr(MD_component_device, a))
+                                 for a in ('mdstat', 'sys_block')])
+        MD_component_device.mdstat = self.path('/proc/mdstat')
+        MD_component_device.sys_block = self.path('/sys/block')
+        self.saved['mount_open'] = MountTable.__dict__['_open']
+        def sim_open(table):
+            table.state['file'] = SimMountinfo(self)
+            table.state['poll'] = SimMountinfoPoll(self)
+        MountTable._open = sim_open
+        MountTable.state['file'] = None
+        Util.set_executor(self.execute)
+
+    def uninstall(self):
+        from amanda_snaplayers.layer_md import MD_component_device
+
+        Util.set_executor(None)
+        MountTable._open = self.saved['mount_open']
+        MountTable.state['file'] = None
+        for (attr, val) in self.saved['md'].items():
+            setattr(MD_component_device, attr, val)
+        os.path.exists = self.saved['exists']
+        for (name, module) in self.saved_modules.items():
+            if module is None:
+                sys.modules.pop(name,None)
+            else:
+                sys.modules[name] = module
+        Simulation.current = None
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def exists(self,path):
+        if isinstance(path,basestring) and path.startswith('/dev/'):
+            path = self.path(path)
+        return self.saved['exists'](path)
+
+    #
+    # Simulated block devices
+    #
+    def add_block_device(self,device,parts=0,part_fmt='%s%d'):
+        dev_path = self.path(device)
+        if not os.path.isdir(os.path.dirname(dev_path)):
+            os.makedirs(os.path.dirname(dev_path))
+        for path in [dev_path] + [self.path(part_fmt % (device, i))
+                                  for i in range(1, parts+1)]:
+            open(path,'w').close()
+
+    def remove_block_device(self,device,parts=0,part_fmt='%s%d'):
+        for path in [self.path(device)] + [self.path(part_fmt % (device, i))
+                                           for i in range(1, parts+1)]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    #
+    # Topology for benchmarks
+    #
+    def populate(self,scheme,dles,parts=1,one_mount=False):
+        '''
+        Create the volumes for dles DLEs of a layering scheme, one of
+        'lv', 'lv_md', 'rbd' or 'xenvdi', and list their mount points
+        in self.devices; with parts partitions, each volume's
+        partitions are DLEs of their own, or with one_mount, mounted
+        together by one 'parts' layer
+        '''
+        schemes = {
+            'lv' : ('lv=%s+vol%%d' % self.vg_name, self.add_lv),
+            'lv_md' : ('lv=%s+vol%%d,md' % self.vg_name, self.add_md_lv),
+            'rbd' : ('libvirt=%s+img%%d' % self.ceph_pool, self.add_image),
+            'xenvdi' : ('xenvdi=vdi%d', self.add_vdi),
+            }
+        if scheme not in schemes:
+            raise ValueError("unknown scheme '%s'" % scheme)
+        (dev_pat, add_volume) = schemes[scheme]
+        if one_mount:
+            mounts = ['parts=%s' % '+'.join([str(part) for part
+                                             in range(1, parts+1)])]
+        else:
+            mounts = ['part=%d' % part for part in range(1, parts+1)]
+        for i in range(dles):
+            add_volume(i, parts)
+            for mount in mounts:
+                self.devices.append(os.path.join(
+                        self.mount_base, '%s,%s' % (dev_pat % i, mount)))
+
+    def add_lv(self,i,parts,vg=None,lv=None):
+        (vg, lv) = (vg or self.vg_name, lv or 'vol%d' % i)
+        self.lvs[(vg, lv)] = { 'origin' : '', 'parts' : parts }
+        self.add_block_device('/dev/%s/%s' % (vg, lv), parts)
+
+    def add_md_lv(self,i,parts):
+        # an LV holding one half of a partitioned RAID1 mirror
+        self.add_lv(i, 0)
+        self.lvs[(self.vg_name, 'vol%d' % i)]['md'] = \
+            ('%08x:%08x:%08x:%08x' % (0x5d000000 + i, i, i, i), parts)
+
+    def add_image(self,i,parts):
+        self.images[(self.ceph_pool, 'img%d' % i)] = {
+            'snaps' : {}, 'parent' : None, 'parts' : parts, 'opens' : 0 }
+
+    def add_vdi(self,i,parts):
+        vdi_uuid = '%08x-0000-4000-8000-%012x' % (0x7d000000, i)
+        self.vdis['OpaqueRef:vdi%d' % i] = {
+            'name_label' : 'vdi%d' % i,
+            'uuid' : vdi_uuid,
+            'SR' : 'OpaqueRef:sr0' }
+        self.add_lv(i, parts, vg='VG_XenStorage-%s' % self.sr_uuid,
+                    lv='VHD-%s' % vdi_uuid)
+
+    #
+    # Commands
+    #
+    def execute(self,cmd):
+        if cmd[:2] == ['sudo', '-n']:
+            cmd = cmd[2:]
+        name = os.path.basename(cmd[0])
+        handler = getattr(self, 'cmd_%s' % name, None)
+        if handler is None:
+            return (127, '', "%s: command not found\n" % name)
+        if self.op('cmd.%s' % name):
+            return (1, '', "%s: simulated failure\n" % name)
+        with self.lock:
+            return handler(cmd[1:])
+
+    def cmd_lvs(self,args):
+        lvs = []
+        snapped = set([(vg, rec['origin'])
+                       for ((vg, lv), rec) in self.lvs.items()])
+        for ((vg, lv), rec) in sorted(self.lvs.items()):
+            lvs.append({ 'vg_name' : vg,
+                         'lv_name' : lv,
+                         'lv_attr' : (rec['origin'] and 'swi-a-s---' or
+                                      (vg, lv) in snapped and 'owi-a-----' or
+                                      '-wi-a-----'),
+                         'origin' : rec['origin'] })
+        return (0, json.dumps({ 'report' : [ { 'lv' : lvs } ] }), '')
+
+    def cmd_lvcreate(self,args):
+        snap_name = os.path.basename(args[args.index('-n')+1])
+        (vg, origin) = args[-1].split('/')[-2:]
+        if (vg, origin) not in self.lvs:
+            return (5, '', "Volume group or LV %s not found\n" % args[-1])
+        if (vg, snap_name) in self.lvs:
+            return (5, '', "Logical volume %s already exists\n" % snap_name)
+        rec = dict(self.lvs[(vg, origin)])
+        rec['origin'] = origin
+        self.lvs[(vg, snap_name)] = rec
+        self.add_block_device('/dev/%s/%s' % (vg, snap_name), rec['parts'])
+        return (0, '  Logical volume "%s" created.\n' % snap_name, '')
+
+    def cmd_lvremove(self,args):
+        (vg, lv) = args[-1].split('/')[-2:]
+        rec = self.lvs.pop((vg, lv), None)
+        if rec is None:
+            return (5, '', "Failed to find logical volume %s/%s\n" % (vg, lv))
+        self.remove_block_device('/dev/%s/%s' % (vg, lv), rec['parts'])
+        return (0, '  Logical volume "%s" successfully removed\n' % lv, '')
+
+    def lv_rec(self,device):
+        return self.lvs.get(tuple(device.split('/')[-2:]), None)
+
+    def cmd_mdadm(self,args):
+        if args[0] == '-A':
+            return self.md_assemble(args[1], args[2])
+        if args[0] == '-S':
+            return self.md_stop(args[1])
+        if args[0] == '-Q' and '--examine' in args:
+            device = [a for a in args if a.startswith('/dev/')][0]
+            rec = self.lv_rec(device)
+            if rec is None or not rec.get('md'):
+                return (1, '', "mdadm: No md superblock detected on %s.\n" %
+                        device)
+            return (0, "ARRAY /dev/md/sim  level=raid1 metadata=1.2 "
+                    "num-devices=2 UUID=%s name=sim\n" % rec['md'][0], '')
+        return (1, '', "mdadm: unsupported simulated command\n")
+
+    def md_assemble(self,md_dev,component):
+        rec = self.lv_rec(component)
+        if rec is None or not rec.get('md'):
+            return (1, '', "mdadm: no recogniseable superblock on %s\n" %
+                    component)
+        if md_dev in self.md_arrays:
+            return (1, '', "mdadm: %s is already in use.\n" % md_dev)
+        (uuid, parts) = rec['md']
+        md_name = os.path.basename(md_dev)
+        sys_dir = self.path('/sys/block/%s' % md_name)
+        os.makedirs(os.path.join(sys_dir, 'md'))
+        os.makedirs(os.path.join(sys_dir, 'slaves',
+                                 os.path.basename(component)))
+        open(os.path.join(sys_dir, 'md', 'array_state'),'w').write('clean\n')
+        # sysfs shows the UUID in 8-4-4-4-12 form, mdadm in 8:8:8:8
+        hex_uuid = uuid.replace(':','')
+        open(os.path.join(sys_dir, 'md', 'uuid'),'w').write(
+            '%s-%s-%s-%s-%s\n' % (hex_uuid[0:8], hex_uuid[8:12],
+                                  hex_uuid[12:16], hex_uuid[16:20],
+                                  hex_uuid[20:]))
+        self.md_arrays[md_dev] = { 'uuid' : uuid,
+                                   'slaves' : [component],
+                                   'parts' : parts }
+        self.add_block_device(md_dev, parts, '%sp%d')
+        self.write_mdstat()
+        return (0, '', "mdadm: %s has been started with 1 drive (out of 2).\n"
+                % md_dev)
+
+    def md_stop(self,md_dev):
+        array = self.md_arrays.pop(md_dev, None)
+        if array is None:
+            return (1, '', "mdadm: error opening %s\n" % md_dev)
+        self.write_mdstat()
+        shutil.rmtree(self.path('/sys/block/%s' % os.path.basename(md_dev)))
+        self.remove_block_device(md_dev, array['parts'], '%sp%d')
+        return (0, '', "mdadm: stopped %s\n" % md_dev)
+
+    def write_mdstat(self):
+        lines = ['Personalities : [raid1]']
+        for (md_dev, array) in sorted(self.md_arrays.items()):
+            lines.append('%s : active raid1 %s[0]' %
+                         (os.path.basename(md_dev),
+                          os.path.basename(array['slaves'][0])))
+            lines.append('      1048576 blocks super 1.2 [2/1] [U_]')
+        lines.append('unused devices: <none>')
+        # replace atomically; readers open the file afresh
+        tmp = self.path('/proc/mdstat.tmp')
+        open(tmp,'w').write('\n'.join(lines) + '\n')
+        os.rename(tmp, self.path('/proc/mdstat'))
+
+    def cmd_mount(self,args):
+        (device, point) = args[-2:]
+        point = os.path.realpath(point)
+        if not self.exists(device):
+            return (32, '', "mount: special device %s does not exist\n" %
+                    device)
+        if not os.path.isdir(point):
+            return (32, '', "mount: mount point %s does not exist\n" % point)
+        if point in [p for (d, p) in self.mounts]:
+            return (32, '', "mount: %s already mounted\n" % point)
+        self.mounts.append((device, point))
+        self.mount_ids[(device, point)] = 21 + self.mount_generation
+        self.mount_generation += 1
+        return (0, '', '')
+
+    def cmd_umount(self,args):
+        point = os.path.realpath(args[-1])
+        for (device, p) in self.mounts:
+            if p == point:
+                self.mounts.remove((device, p))
+                del self.mount_ids[(device, p)]
+                self.mount_generation += 1
+                return (0, '', '')
+        return (32, '', "umount: %s: not mounted\n" % point)
+
+    def drop_upper_layers(self):
+        '''
+        Unmount everything and stop all md arrays and attached disks,
+        leaving the snapshots, clones and volumes under them, as after
+        a crash and reboot
+        '''
+        with self.lock:
+            for (device, point) in list(self.mounts):
+                self.cmd_umount([point])
+            for md_dev in list(self.md_arrays):
+                self.md_stop(md_dev)
+            for (target, source) in self.vm_disks.items():
+                del self.vm_disks[target]
+                image = self.images.get(tuple(source.split('/',1)),None)
+                self.remove_block_device('/dev/%s' % target,
+                                         image and image['parts'] or 0)
+
+    def mountinfo_text(self):
+        with self.lock:
+            mounts = [(20, '/dev/root', '/')] + \
+                [(self.mount_ids[m],) + m for m in self.mounts]
+        return ''.join(['%d 1 8:%d / %s rw,relatime shared:1 - ext4 %s rw\n' %
+                        (i, i % 256, point, device)
+                        for (i, device, point) in mounts])
+
+    def cmd_mkdir(self,args):
+        try:
+            os.mkdir(args[-1])
+        except OSError, e:
+            return (1, '', "mkdir: %s\n" % e)
+        return (0, '', '')
+
+    def cmd_rmdir(self,args):
+        try:
+            os.rmdir(args[-1])
+        except OSError, e:
+            return (1, '', "rmdir: %s\n" % e)
+        return (0, '', '')
+
+    #
+    # Stand-in modules
+    #
+    def module(self,name,attrs):
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        return module
+
+    def rados_module(self):
+        sim = CurrentSimulation()
+
+        class Error(Exception):
+            pass
+
+        class Ioctx(object):
+            def __init__(self,pool):
+                self.pool = pool
+            def close(self):
+                sim.op('rados.ioctx_close')
+
+        class Rados(object):
+            def __init__(self,conffile=None):
+                self.conffile = conffile
+            def connect(self):
+                if sim.op('rados.connect'):
+                    raise Error("simulated connection failure")
+            def open_ioctx(self,pool):
+                sim.op('rados.open_ioctx')
+                return Ioctx(pool)
+            def shutdown(self):
+                sim.op('rados.shutdown')
+            def list_pools(self):
+                sim.op('rados.list_pools')
+                with sim.lock:
+                    return sorted(set([p for (p, n) in sim.images]))
+            def conf_get(self,name):
+                return { 'osd_client_watch_timeout' : '30' }.get(name,None)
+
+        return self.module('rados', { 'Rados' : Rados, 'Error' : Error })
+
+    def rbd_module(self):
+        sim = CurrentSimulation()
+
+        class Error(Exception):
+            pass
+        class ImageNotFound(Error):
+            pass
+        class ImageExists(Error):
+            pass
+        class ImageBusy(Error):
+            pass
+        class ImageHasSnapshots(Error):
+            pass
+        class InvalidArgument(Error):
+            pass
+
+        def api(name):
+            if sim.op('rbd.%s' % name):
+                raise ImageBusy("simulated failure of %s" % name)
+
+        class Image(object):
+            def __init__(self,ioctx,name,snapshot=None,read_only=False):
+                api('open')
+                with sim.lock:
+                    self.key = (ioctx.pool, name)
+                    if self.key not in sim.images:
+                        raise ImageNotFound("image %s not found" % name)
+                    # read-only opens don't watch the image
+                    self.watching = not read_only
+                    if self.watching:
+                        sim.images[self.key]['opens'] += 1
+                self.snap = snapshot
+
+            @property
+            def rec(self):
+                return sim.images[self.key]
+
+            def close(self):
+                sim.op('rbd.close')
+                with sim.lock:
+                    if self.watching and self.key in sim.images:
+                        self.rec['opens'] -= 1
+                    self.watching = False
+
+            def list_snaps(self):
+                api('list_snaps')
+                with sim.lock:
+                    return [{ 'name' : name, 'id' : i, 'size' : 1 << 30 }
+                            for (i, name) in enumerate(self.rec['snaps'])]
+
+            def create_snap(self,name):
+                api('create_snap')
+                with sim.lock:
+                    if name in self.rec['snaps']:
+                        raise ImageExists("snap %s exists" % name)
+                    self.rec['snaps'][name] = { 'protected' : False,
+                                                'children' : set() }
+
+            def _snap(self,name):
+                if name not in self.rec['snaps']:
+                    raise ImageNotFound("snap %s not found" % name)
+                return self.rec['snaps'][name]
+
+            def protect_snap(self,name):
+                api('protect_snap')
+                with sim.lock:
+                    self._snap(name)['protected'] = True
+
+            def unprotect_snap(self,name):
+                api('unprotect_snap')
+                with sim.lock:
+                    if self._snap(name)['children']:
+                        raise ImageBusy("snap %s has children" % name)
+                    self._snap(name)['protected'] = False
+
+            def is_protected_snap(self,name):
+                api('is_protected_snap')
+                with sim.lock:
+                    return self._snap(name)['protected']
+
+            def remove_snap(self,name):
+                api('remove_snap')
+                with sim.lock:
+                    if self._snap(name)['protected']:
+                        raise ImageBusy("snap %s is protected" % name)
+                    del self.rec['snaps'][name]
+
+            def set_snap(self,name):
+                api('set_snap')
+                with sim.lock:
+                    if name is not None:
+                        self._snap(name)
+                self.snap = name
+
+            def list_children(self):
+                api('list_children')
+                with sim.lock:
+                    return sorted(self._snap(self.snap)['children'])
+
+            def list_lockers(self):
+                api('list_lockers')
+                return []
+
+            def parent_info(self):
+                api('parent_info')
+                with sim.lock:
+                    if self.rec['parent'] is None:
+                        raise ImageNotFound("image has no parent")
+                    return self.rec['parent']
+
+            def watchers_list(self):
+                api('watchers_list')
+                with sim.lock:
+                    return [{ 'addr' : '192.0.2.1:0/%d' % i, 'id' : i,
+                              'cookie' : i }
+                            for i in range(self.rec['opens'])]
+
+        class RBD(object):
+            def clone(self,p_ioctx,p_name,p_snapname,c_ioctx,c_name,
+                      features=None):
+                api('clone')
+                with sim.lock:
+                    parent = sim.images.get((p_ioctx.pool, p_name), None)
+                    if parent is None:
+                        raise ImageNotFound("image %s not found" % p_name)
+                    snap = parent['snaps'].get(p_snapname, None)
+                    if snap is None or not snap['protected']:
+                        raise InvalidArgument("snap %s not protected" %
+                                              p_snapname)
+                    if (c_ioctx.pool, c_name) in sim.images:
+                        raise ImageExists("image %s exists" % c_name)
+                    snap['children'].add((c_ioctx.pool, c_name))
+                    sim.images[(c_ioctx.pool, c_name)] = {
+                        'snaps' : {}, 'opens' : 0, 'parts' : parent['parts'],
+                        'parent' : (p_ioctx.pool, p_name, p_snapname) }
+
+            def remove(self,ioctx,name):
+                api('remove')
+                with sim.lock:
+                    rec = sim.images.get((ioctx.pool, name), None)
+                    if rec is None:
+                        raise ImageNotFound("image %s not found" % name)
+                    if rec['snaps']:
+                        raise ImageHasSnapshots("image %s has snaps" % name)
+                    if rec['opens']:
+                        raise ImageBusy("image %s has watchers" % name)
+                    if rec['parent'] is not None:
+                        (pool, p_name, p_snap) = rec['parent']
+                        sim.images[(pool, p_name)]['snaps'][p_snap][
+                            'children'].discard((ioctx.pool, name))
+                    del sim.images[(ioctx.pool, name)]
+
+            def list(self,ioctx):
+                api('list')
+                with sim.lock:
+                    return sorted([n for (p, n) in sim.images
+                                   if p == ioctx.pool])
+
+        return self.module('rbd', {
+                'Image' : Image, 'RBD' : RBD, 'Error' : Error,
+                'ImageNotFound' : ImageNotFound, 'ImageExists' : ImageExists,
+                'ImageBusy' : ImageBusy,
+                'ImageHasSnapshots' : ImageHasSnapshots,
+                'InvalidArgument' : InvalidArgument,
+                'RBD_FEATURE_LAYERING' : 1 })
+
+    def libvirt_module(self):
+        sim = CurrentSimulation()
+
+        class libvirtError(Exception):
+            pass
+
+        def api(name):
+            if sim.op('libvirt.%s' % name):
+                raise libvirtError("simulated failure of %s" % name)
+
+        class StorageVol(object):
+            def __init__(self,name):
+                self.name = name
+
+        class StoragePool(object):
+            def __init__(self,name):
+                self.pool = name
+            def refresh(self,flags=0):
+                api('refresh')
+            def listVolumes(self):
+                api('listVolumes')
+                with sim.lock:
+                    return sorted([n for (p, n) in sim.images
+                                   if p == self.pool])
+            def storageVolLookupByName(self,name):
+                api('storageVolLookupByName')
+                with sim.lock:
+                    if (self.pool, name) not in sim.images:
+                        raise libvirtError("Storage volume not found: %s" %
+                                           name)
+                return StorageVol(name)
+
+        class Domain(object):
+            def __init__(self,name):
+                self.name = name
+            def XMLDesc(self,flags=0):
+                api('XMLDesc')
+                with sim.lock:
+                    disks = sorted(sim.vm_disks.items())
+                return ("<domain type='kvm'><name>%s</name><devices>"
+                        "<disk type='file' device='disk'>"
+                        "<source file='/var/lib/libvirt/images/%s.img'/>"
+                        "<target dev='vda' bus='virtio'/></disk>%s"
+                        "</devices></domain>" %
+                        (self.name, self.name, ''.join([
+                            "<disk type='network' device='disk'>"
+                            "<source protocol='rbd' name='%s'/>"
+                            "<target dev='%s' bus='virtio'/></disk>" %
+                            (source, target)
+                            for (target, source) in disks])))
+            def _disk(self,xml):
+                disk = ElementTree.fromstring(xml)
+                return (disk.find('target').get('dev'),
+                        disk.find('source').get('name'))
+            def attachDevice(self,xml):
+                api('attachDevice')
+                (target, source) = self._disk(xml)
+                with sim.lock:
+                    if target in sim.vm_disks or target == 'vda':
+                        raise libvirtError("target %s already exists" %
+                                           target)
+                    image = sim.images.get(tuple(source.split('/',1)),None)
+                    if image is None:
+                        raise libvirtError("rbd image %s not found" % source)
+                    sim.vm_disks[target] = source
+                    sim.add_block_device('/dev/%s' % target, image['parts'])
+                return 0
+            def detachDevice(self,xml):
+                api('detachDevice')
+                (target, source) = self._disk(xml)
+                with sim.lock:
+                    if sim.vm_disks.get(target,None) != source:
+                        raise libvirtError("disk %s not found" % target)
+                    del sim.vm_disks[target]
+                    image = sim.images.get(tuple(source.split('/',1)),None)
+                    sim.remove_block_device('/dev/%s' % target,
+                                            image and image['parts'] or 0)
+                return 0
+
+        class Connection(object):
+            def __init__(self,url):
+                self.url = url
+                self.alive = True
+            def isAlive(self):
+                return self.alive
+            def close(self):
+                api('close')
+                self.alive = False
+            def lookupByName(self,name):
+                api('lookupByName')
+                if name != sim.vm_name:
+                    raise libvirtError("Domain not found: %s" % name)
+                return Domain(name)
+            def storagePoolLookupByName(self,name):
+                api('storagePoolLookupByName')
+                return StoragePool(name)
+
+        def open(url):
+            api('open')
+            return Connection(url)
+
+        return self.module('libvirt', { 'open' : open,
+                                        'libvirtError' : libvirtError })
+
+    def xenapi_module(self):
+        sim = CurrentSimulation()
+
+        class Failure(Exception):
+            def __init__(self,details):
+                Exception.__init__(self, details)
+                self.details = details
+
+        class Session(object):
+            def __init__(self):
+                self.ref = None
+                self.xenapi = XenAPINamespace(sim, self)
+
+        Simulation.xenapi_failure = Failure
+        return self.module('XenAPI', { 'xapi_local' : Session,
+                                       'Session' : lambda url: Session(),
+                                       'Failure' : Failure })
+
+    def xenapi_call(self,session,name,args):
+        if self.op('xenapi.%s' % name):
+            raise self.xenapi_failure(['SIMULATED_FAILURE', name])
+        if name.startswith('login'):
+            with self.lock:
+                session.ref = 'OpaqueRef:session%d' % \
+                    self.counts['xenapi.%s' % name]
+                self.xenapi_sessions.add(session.ref)
+            return session.ref
+        # 'xenapi.evict' failures simulate xapi dropping a session
+        if self.lookup(self.failure_rate,'xenapi.evict') and \
+                self.op('xenapi.evict'):
+            with self.lock:
+                self.xenapi_sessions.discard(session.ref)
+        with self.lock:
+            if session.ref not in self.xenapi_sessions:
+                raise self.xenapi_failure(['SESSION_INVALID', session.ref])
+            if name == 'logout':
+                self.xenapi_sessions.discard(session.ref)
+        handler = getattr(self, 'xenapi_%s' % name.replace('.','_'), None)
+        if handler is None:
+            raise self.xenapi_failure(['MESSAGE_METHOD_UNKNOWN', name])
+        if name == 'event.from':
+            # waits for events; don't hold up other calls
+            return handler(*args)
+        with self.lock:
+            return handler(*args)
+
+    def xenapi_logout(self):
+        # xenapi_call() ends the calling session
+        pass
+
+    def xenapi_VDI_get_all_records(self):
+        return dict([(ref, dict(rec)) for (ref, rec) in self.vdis.items()])
+
+    def xenapi_VDI_get_record(self,ref):
+        if ref not in self.vdis:
+            raise self.xenapi_failure(['HANDLE_INVALID', 'VDI', ref])
+        return dict(self.vdis[ref])
+
+    def xenapi_VDI_get_by_name_label(self,label):
+        return [ref for (ref, rec) in self.vdis.items()
+                if rec['name_label'] == label]
+
+    def xenapi_event_from(self,classes,token,timeout):
+        # the simulated pool never changes:  the first call returns the
+        # watched records, later ones time out without events
+        if token:
+            time.sleep(timeout)
+            return { 'events' : [], 'token' : token,
+                     'valid_ref_counts' : {} }
+        events = []
+        for c in classes:
+            (cls, ref) = c.split('/',1)
+            snapshot = (cls == 'vdi' and self.vdis.get(ref,None) or
+                        { 'uuid' : self.sr_uuid })
+            events.append({ 'class' : cls, 'operation' : 'add',
+                            'ref' : ref, 'snapshot' : snapshot })
+        return { 'events' : events, 'token' : '1', 'valid_ref_counts' : {} }
+
+    def xenapi_SR_get_record(self,ref):
+        if ref != 'OpaqueRef:sr0':
+            raise self.xenapi_failure(['HANDLE_INVALID', 'SR', ref])
+        return { 'uuid' : self.sr_uuid, 'name_label' : 'Local storage' }